@@ -1,3 +1,5 @@
+from typing import List
+
 import numpy as np
 from sklearn.metrics import pairwise_distances
 import warnings
@@ -34,3 +36,57 @@ def compute_diffusion_matrix(X: np.array, sigma: float = 10.0):
     # which is defined as `P = D^{-1} K`, with `D = np.diag(np.sum(K, axis=1))`.
 
     return K
+
+
+def compute_diffusion_matrix_batch(X_list: List[np.array],
+                                   sigma: float = 10.0):
+    '''
+    Batched version of `compute_diffusion_matrix`.
+
+    Given a list of L inputs that share the same number of samples n
+    (e.g., the activations of L layers on the same subset of data points),
+    returns the stacked matrices K of shape [L, n, n].
+    The feature dimension d may differ between the inputs.
+    '''
+    assert len(set([X.shape[0] for X in X_list])) == 1, \
+        '`compute_diffusion_matrix_batch`: all inputs must have the same number of samples.'
+
+    # Construct the squared distance matrices.
+    D_sq = np.stack([pairwise_distances(X)**2 for X in X_list], axis=0)
+
+    # Gaussian kernel
+    G = (1 / (sigma * np.sqrt(2 * np.pi))) * np.exp(-D_sq / (2 * sigma**2))
+
+    # Anisotropic density normalization, i.e., `Deg @ G @ Deg` for each matrix in the stack.
+    deg_inv_sqrt = 1 / np.sum(G, axis=2)**0.5
+    K = deg_inv_sqrt[:, :, None] * G * deg_inv_sqrt[:, None, :]
+
+    return K
+
+
+def compute_gaussian_kernel(X: np.array, sigma: float = 10.0):
+    '''
+    The (unnormalized) Gaussian kernel used in `compute_diffusion_matrix`.
+
+    Useful when the diffusion matrices of many subsets of X are needed:
+    the kernel is computed once, and `normalize_gaussian_kernel` is
+    applied on `G[inds, :][:, inds]` for each subset `inds`.
+    '''
+
+    # Construct the distance matrix.
+    D = pairwise_distances(X)
+
+    # Gaussian kernel
+    G = (1 / (sigma * np.sqrt(2 * np.pi))) * np.exp((-D**2) / (2 * sigma**2))
+
+    return G
+
+
+def normalize_gaussian_kernel(G: np.array):
+    '''
+    Anisotropic density normalization of a Gaussian kernel `G`.
+    Equivalent to `Deg @ G @ Deg` in `compute_diffusion_matrix`.
+    '''
+    deg_inv_sqrt = 1 / np.sum(G, axis=1)**0.5
+    K = deg_inv_sqrt[:, None] * G * deg_inv_sqrt[None, :]
+    return K
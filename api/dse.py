@@ -1,5 +1,5 @@
 import numpy as np
-from information_utils import approx_eigvals, exact_eigvals
+from information_utils import approx_eigvals, exact_eigvals, pack_bin_codes, count_keys, load_vectors, read_rows
 from diffusion import compute_diffusion_matrix
 import os
 import random
@@ -36,6 +36,9 @@ def diffusion_spectral_entropy(embedding_vectors: np.array,
         embedding_vectors: np.array of shape [N, D]
             N: number of data points / samples
             D: number of feature dimensions of the neural representation
+            Can also be a path to a `.npy` file, or any array-like that supports fancy indexing.
+            In that case, only the (at most `max_N`) rows used for computation are read.
+            Can be None if the eigenvalues are loaded from `eigval_save_path`.
 
         gaussian_kernel_sigma: float
             The bandwidth of Gaussian kernel (for computation of the diffusion matrix)
@@ -77,12 +80,17 @@ def diffusion_spectral_entropy(embedding_vectors: np.array,
             Whether or not to print progress to console.
     '''
 
-    # Subsample embedding vectors if number of data sample is too large.
-    if max_N is not None and len(embedding_vectors) > max_N:
-        if random_seed is not None:
-            random.seed(random_seed)
-        rand_inds = np.array(random.sample(range(len(embedding_vectors)), k=max_N))
-        embedding_vectors = embedding_vectors[rand_inds, :]
+    if embedding_vectors is not None:
+        embedding_vectors = load_vectors(embedding_vectors)
+
+        # Subsample embedding vectors if number of data sample is too large.
+        # Only the selected rows are read.
+        if max_N is not None and len(embedding_vectors) > max_N:
+            if random_seed is not None:
+                random.seed(random_seed)
+            rand_inds = np.array(random.sample(range(len(embedding_vectors)), k=max_N))
+            embedding_vectors = read_rows(embedding_vectors, rand_inds)
+        embedding_vectors = np.asarray(embedding_vectors)
 
     if not classic_shannon_entropy:
         # Computing Diffusion Spectral Entropy.
@@ -132,18 +140,13 @@ def diffusion_spectral_entropy(embedding_vectors: np.array,
         # Computing Classic Shannon Entropy.
         if verbose: print('Computing Classic Shannon Entropy...')
 
-        vecs = embedding_vectors.copy()
-
-        # Min-Max scale each dimension.
-        vecs = (vecs - np.min(vecs, axis=0)) / (np.max(vecs, axis=0) -
-                                                np.min(vecs, axis=0))
-
-        # Bin along each dimension.
-        bins = np.linspace(0, 1, num_bins_per_dim + 1)[:-1]
-        vecs = np.digitize(vecs, bins=bins)
+        # Min-Max scale and bin each dimension,
+        # and pack the bins of each vector into a compact key.
+        keys = pack_bin_codes(embedding_vectors,
+                              num_bins_per_dim=num_bins_per_dim)
 
         # Count probability.
-        counts = np.unique(vecs, axis=0, return_counts=True)[1]
+        counts = count_keys(keys)
         prob = counts / np.sum(counts)
 
     prob = prob + np.finfo(float).eps
@@ -194,3 +197,14 @@ if __name__ == '__main__':
     CSE = diffusion_spectral_entropy(embedding_vectors=embedding_vectors,
                                      classic_shannon_entropy=True)
     print('CSE =', CSE)
+
+    print('\n7th run, random vecs, from a .npy file, only reading the subsampled rows.')
+    tmp_path = './test_dse_embedding_vectors.npy'
+    embedding_vectors = np.random.uniform(0, 1, (3000, 256))
+    np.save(tmp_path, embedding_vectors)
+    DSE = diffusion_spectral_entropy(embedding_vectors=tmp_path, max_N=1000)
+    print('DSE (.npy file) =', DSE)
+    DSE = diffusion_spectral_entropy(embedding_vectors=embedding_vectors,
+                                     max_N=1000)
+    print('DSE (in memory) =', DSE)
+    os.remove(tmp_path)
@@ -0,0 +1,234 @@
+'''
+Command-line tool to compute DSE/DSMI over many embedding files.
+
+Example:
+    python dse_cli.py compute \
+        --embeddings '/path/to/embeddings/*/embedding.npy' \
+        --labels '{dir}/label_true.npy' \
+        --output results.csv \
+        --eigval-cache-dir /path/to/eigval_cache/
+
+    One row per file is written to `--output` (.csv or .jsonl).
+'''
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+
+import numpy as np
+from dse import diffusion_spectral_entropy
+from dsmi import diffusion_and_classic_mutual_information
+
+
+def load_array(path: str, npz_key: str):
+    '''
+    `.npy` files are opened as read-only memory maps, so only the rows used are read.
+    `.npz` files are loaded entirely, as their members cannot be memory-mapped.
+    '''
+    if path.endswith('.npz'):
+        return np.load(path)[npz_key]
+    elif path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    else:
+        raise ValueError('`load_array`: file type (%s) not supported.' % path)
+
+
+def resolve_path(path_template: str, embedding_path: str) -> str:
+    '''
+    Fill in `{dir}` and `{stem}` of `path_template` from `embedding_path`.
+    E.g., '{dir}/label_true.npy' for the `EmbeddingStore` folders.
+    '''
+    return path_template.format(
+        dir=os.path.dirname(embedding_path),
+        stem=os.path.splitext(os.path.basename(embedding_path))[0])
+
+
+def eigval_cache_path(eigval_cache_dir: str, embedding_path: str,
+                      args: dict) -> str:
+    '''
+    The eigenvalue cache is keyed by the file (path, size, modification time)
+    and by the args that change the eigenvalues.
+    '''
+    stat = os.stat(embedding_path)
+    key = '%s-%s-%s-%s-%s-%s' % (os.path.abspath(embedding_path),
+                                 stat.st_size, stat.st_mtime_ns,
+                                 args['embedding_key'],
+                                 args['gaussian_kernel_sigma'], args['max_N'])
+    digest = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+    return '%s/%s.npz' % (eigval_cache_dir, digest)
+
+
+def compute_one_file(embedding_path: str, args: dict) -> dict:
+    '''
+    DSE/CSE, and optionally DSMI/CSMI with the labels and the reference, of one embedding file.
+    '''
+    start_time = time.time()
+    row = {'file': embedding_path}
+    try:
+        embedding_vectors = load_array(embedding_path, args['embedding_key'])
+        embedding_vectors = embedding_vectors.reshape(
+            embedding_vectors.shape[0], -1)
+        row['N'], row['D'] = embedding_vectors.shape
+
+        eigval_save_path = None
+        if args['eigval_cache_dir'] is not None:
+            eigval_save_path = eigval_cache_path(args['eigval_cache_dir'],
+                                                 embedding_path, args)
+
+        row['dse'] = diffusion_spectral_entropy(
+            embedding_vectors=embedding_vectors,
+            gaussian_kernel_sigma=args['gaussian_kernel_sigma'],
+            t=args['t'],
+            max_N=args['max_N'],
+            eigval_save_path=eigval_save_path,
+            eigval_save_precision=np.float64)
+        row['cse'] = diffusion_spectral_entropy(
+            embedding_vectors=embedding_vectors,
+            max_N=args['max_N'],
+            classic_shannon_entropy=True,
+            num_bins_per_dim=args['num_bins_per_dim'])
+
+        for name, path_template, npz_key in [
+            ('Y', args['labels'], args['label_key']),
+            ('X', args['reference'], args['reference_key']),
+        ]:
+            if path_template is None:
+                continue
+            reference_vectors = load_array(
+                resolve_path(path_template, embedding_path), npz_key)
+            reference_vectors = reference_vectors.reshape(
+                reference_vectors.shape[0], -1)
+            if name == 'Y':
+                # The labels may be saved as floats (e.g., by `save_numpy`).
+                reference_vectors = reference_vectors.astype(np.int64)
+            row['dsmi_%s' % name], row['csmi_%s' % name], _, _, _ = \
+                diffusion_and_classic_mutual_information(
+                    embedding_vectors=embedding_vectors,
+                    reference_vectors=reference_vectors,
+                    gaussian_kernel_sigma=args['gaussian_kernel_sigma'],
+                    t=args['t'],
+                    n_clusters=args['n_clusters'],
+                    cluster_method=args['cluster_method'],
+                    num_bins_per_dim=args['num_bins_per_dim'],
+                    max_N=args['max_N'])
+
+    except Exception as e:
+        row['error'] = '%s: %s' % (type(e).__name__, e)
+
+    row['seconds'] = time.time() - start_time
+    return row
+
+
+def write_rows(rows, output_path: str, fieldnames: list) -> None:
+    '''
+    Write the rows one by one as they come, to .csv or .jsonl.
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'w', newline='') as f:
+        if output_path.endswith('.csv'):
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+        for row in rows:
+            if output_path.endswith('.csv'):
+                writer.writerow(row)
+            else:
+                f.write(json.dumps(row) + '\n')
+            f.flush()
+            print('%s: %s' % (row['file'], row.get('error', 'done')))
+
+
+def compute(args: dict) -> None:
+    embedding_paths = sorted(glob(args['embeddings']))
+    assert len(embedding_paths) > 0, \
+        '`compute`: no file matches %s.' % args['embeddings']
+    assert args['output'].endswith('.csv') or args['output'].endswith('.jsonl'), \
+        '`compute`: `--output` must be a .csv or .jsonl file.'
+    if args['eigval_cache_dir'] is not None:
+        os.makedirs(args['eigval_cache_dir'], exist_ok=True)
+
+    fieldnames = ['file', 'N', 'D', 'dse', 'cse']
+    if args['labels'] is not None:
+        fieldnames += ['dsmi_Y', 'csmi_Y']
+    if args['reference'] is not None:
+        fieldnames += ['dsmi_X', 'csmi_X']
+    fieldnames += ['seconds', 'error']
+
+    # Separate processes rather than threads, as the DSE/DSMI subsampling uses the global `random` state.
+    with ProcessPoolExecutor(max_workers=args['num_workers']) as executor:
+        rows = executor.map(compute_one_file, embedding_paths,
+                            [args] * len(embedding_paths))
+        write_rows(rows, args['output'], fieldnames)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_compute = subparsers.add_parser(
+        'compute', help='Compute DSE/DSMI for each embedding file.')
+    parser_compute.add_argument(
+        '--embeddings',
+        help='Glob of the embedding files (.npy or .npz), each of shape [N, D].',
+        type=str,
+        required=True)
+    parser_compute.add_argument(
+        '--embedding-key',
+        help='Key of the embeddings in the .npz files.',
+        type=str,
+        default='embedding')
+    parser_compute.add_argument(
+        '--labels',
+        help='Class labels for DSMI(Z; Y). A .npy/.npz path shared by all files, '
+        'or a template with {dir} and {stem} of each embedding file.',
+        type=str,
+        default=None)
+    parser_compute.add_argument('--label-key',
+                                help='Key of the labels in .npz files.',
+                                type=str,
+                                default='label_true')
+    parser_compute.add_argument(
+        '--reference',
+        help='Reference vectors (e.g., input images) for DSMI(Z; X). '
+        'Same format as `--labels`.',
+        type=str,
+        default=None)
+    parser_compute.add_argument('--reference-key',
+                                help='Key of the reference in .npz files.',
+                                type=str,
+                                default='image')
+    parser_compute.add_argument('--output',
+                                help='Result table (.csv or .jsonl).',
+                                type=str,
+                                required=True)
+    parser_compute.add_argument('--num-workers',
+                                help='Number of files processed concurrently.',
+                                type=int,
+                                default=4)
+    parser_compute.add_argument(
+        '--eigval-cache-dir',
+        help='If provided, the DSE eigenvalues are saved to / reused from this folder.',
+        type=str,
+        default=None)
+    parser_compute.add_argument('--gaussian-kernel-sigma',
+                                type=float,
+                                default=10)
+    parser_compute.add_argument('--t', type=int, default=1)
+    parser_compute.add_argument('--max-N', type=int, default=10000)
+    parser_compute.add_argument('--num-bins-per-dim', type=int, default=2)
+    parser_compute.add_argument(
+        '--n-clusters',
+        help='Number of clusters of `--reference` for DSMI(Z; X).',
+        type=int,
+        default=10)
+    parser_compute.add_argument('--cluster-method',
+                                type=str,
+                                default='spectral')
+
+    args = vars(parser.parse_args())
+    if args['command'] == 'compute':
+        compute(args)
@@ -1,6 +1,16 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
 import numpy as np
 from dse import diffusion_spectral_entropy
-from sklearn.cluster import SpectralClustering
+from diffusion import compute_diffusion_matrix_batch, compute_gaussian_kernel, normalize_gaussian_kernel
+from information_utils import approx_eigvals, exact_eigvals, von_neumann_entropy, pack_bin_codes, count_keys, grouped_entropy, load_vectors, read_rows
+from sklearn.cluster import KMeans, MiniBatchKMeans, SpectralClustering
+from sklearn.decomposition import PCA
+from sklearn.neighbors import kneighbors_graph
+import hashlib
+import os
 import random
 
 
@@ -13,6 +23,7 @@ def diffusion_spectral_mutual_information(
         chebyshev_approx: bool = False,
         num_repetitions: int = 5,
         n_clusters: int = 10,
+        cluster_method: str = 'spectral',
         precomputed_clusters: np.array = None,
         classic_shannon_entropy: bool = False,
         num_bins_per_dim: int = 2,
@@ -48,10 +59,13 @@ def diffusion_spectral_mutual_information(
         embedding_vectors: np.array of shape [N, D]
             N: number of data points / samples
             D: number of feature dimensions of the neural representation
+            Can also be a path to a `.npy` file, or any array-like that supports fancy indexing.
+            In that case, only the rows in the subsampled index sets are read.
 
         reference_vectors: np.array of shape [N, D']
             N: number of data points / samples
             D': number of feature dimensions of the neural representation or input/output variable
+            Can also be a path to a `.npy` file. All rows are needed for the clustering.
 
         reference_discrete: bool
             Whether `reference_vectors` is discrete or continuous.
@@ -87,7 +101,16 @@ def diffusion_spectral_mutual_information(
             Number of clusters for `reference_vectors`.
             Only used when `reference_discrete` is False (`reference_vectors` is not discrete).
             If D' == 1 --> will use scalar binning.
-            If D' > 1  --> will use spectral clustering.
+            If D' > 1  --> will use clustering as specified by `cluster_method`.
+
+        cluster_method: str
+            How to cluster `reference_vectors` when D' > 1. One of
+                'spectral': spectral clustering on the nearest neighbor graph (default).
+                'minibatch_kmeans': mini-batch k-means. The fastest option.
+                'pca_kmeans': randomized PCA followed by k-means.
+                'sparse_spectral': randomized PCA, then spectral clustering on a sparse kNN graph.
+            The cluster assignments are memoized in-process by the content of `reference_vectors`,
+            so repeated calls with the same `reference_vectors` will not recompute the clustering.
 
         precomputed_clusters: np.array
             If provided, will directly use it as the cluster assignments for `reference_vectors`.
@@ -108,6 +131,526 @@ def diffusion_spectral_mutual_information(
             Whether or not to print progress to console.
     '''
 
+    #
+    '''STEP 1. Prepare the category/cluster assignments.'''
+    embedding_vectors = load_vectors(embedding_vectors)
+    reference_vectors, precomputed_clusters = compute_reference_clusters(
+        embedding_vectors=embedding_vectors,
+        reference_vectors=reference_vectors,
+        reference_discrete=reference_discrete,
+        n_clusters=n_clusters,
+        cluster_method=cluster_method,
+        precomputed_clusters=precomputed_clusters,
+        verbose=verbose)
+
+    #
+    '''STEP 2. Prepare the index sets for DSE(A | B = b_i) and DSE(A*).'''
+    _, cluster_cnts, index_sets = sample_index_sets(
+        precomputed_clusters=precomputed_clusters,
+        num_repetitions=num_repetitions,
+        random_seed=random_seed)
+
+    #
+    '''STEP 3. Compute DSMI.'''
+    MI_by_class = []
+
+    for cluster_inds, random_inds_list in index_sets:
+        # DSE(A | B = b_i)
+        embeddings_curr_class = read_rows(embedding_vectors, cluster_inds)
+
+        entropy_AgivenB_curr_class = diffusion_spectral_entropy(
+            embedding_vectors=embeddings_curr_class,
+            gaussian_kernel_sigma=gaussian_kernel_sigma,
+            t=t,
+            max_N=None,
+            chebyshev_approx=chebyshev_approx,
+            classic_shannon_entropy=classic_shannon_entropy,
+            num_bins_per_dim=num_bins_per_dim)
+
+        # DSE(A*)
+        entropy_A_estimation_list = []
+        for rand_inds in random_inds_list:
+            embeddings_random_subset = read_rows(embedding_vectors, rand_inds)
+
+            entropy_A_subsample_rep = diffusion_spectral_entropy(
+                embedding_vectors=embeddings_random_subset,
+                gaussian_kernel_sigma=gaussian_kernel_sigma,
+                t=t,
+                max_N=None,
+                chebyshev_approx=chebyshev_approx,
+                classic_shannon_entropy=classic_shannon_entropy,
+                num_bins_per_dim=num_bins_per_dim)
+            entropy_A_estimation_list.append(entropy_A_subsample_rep)
+
+        entropy_A_estimation = np.mean(entropy_A_estimation_list)
+
+        MI_by_class.append((entropy_A_estimation - entropy_AgivenB_curr_class))
+
+    mutual_information = np.sum(cluster_cnts / np.sum(cluster_cnts) *
+                                np.array(MI_by_class))
+
+    return mutual_information, precomputed_clusters
+
+
+def diffusion_spectral_mutual_information_multi(
+        embeddings_list: List[np.array],
+        reference_vectors: np.array,
+        reference_discrete: bool = None,
+        gaussian_kernel_sigma: float = 10,
+        t: int = 1,
+        chebyshev_approx: bool = False,
+        num_repetitions: int = 5,
+        n_clusters: int = 10,
+        cluster_method: str = 'spectral',
+        precomputed_clusters: np.array = None,
+        classic_shannon_entropy: bool = False,
+        num_bins_per_dim: int = 2,
+        random_seed: int = 0,
+        verbose: bool = False):
+    '''
+    DSMI between each of several sets of random variables and one common reference.
+    A typical use case is the layer-wise information plane of a neural network,
+    where `embeddings_list` holds the representations at each layer/block.
+
+    The result is the same as calling `diffusion_spectral_mutual_information`
+    once per entry of `embeddings_list`, but
+        (1) the clustering of `reference_vectors` is performed only once.
+        (2) the per-cluster and random subsample index sets are built only once.
+        (3) for each index set, the diffusion matrices of all embeddings are
+            built and eigendecomposed as one batch.
+
+    args:
+        embeddings_list: List of np.array, each of shape [N, D_l]
+            N: number of data points / samples, shared by all embeddings
+            D_l: number of feature dimensions of the l-th neural representation
+
+        All other args are the same as in `diffusion_spectral_mutual_information`.
+
+    returns:
+        mutual_information_list: List of float, one per entry of `embeddings_list`
+        precomputed_clusters: np.array, the cluster assignments of `reference_vectors`
+    '''
+
+    num_embeddings = len(embeddings_list)
+    embeddings_list = [
+        load_vectors(embedding_vectors) for embedding_vectors in embeddings_list
+    ]
+
+    #
+    '''STEP 1. Prepare the category/cluster assignments.'''
+    reference_vectors, precomputed_clusters = compute_reference_clusters(
+        embedding_vectors=embeddings_list[0],
+        reference_vectors=reference_vectors,
+        reference_discrete=reference_discrete,
+        n_clusters=n_clusters,
+        cluster_method=cluster_method,
+        precomputed_clusters=precomputed_clusters,
+        verbose=verbose)
+
+    #
+    '''STEP 2. Prepare the index sets for DSE(A | B = b_i) and DSE(A*).'''
+    _, cluster_cnts, index_sets = sample_index_sets(
+        precomputed_clusters=precomputed_clusters,
+        num_repetitions=num_repetitions,
+        random_seed=random_seed)
+
+    def entropy_per_embedding(inds: np.array) -> np.array:
+        '''
+        Entropy of each embedding, restricted to the rows in `inds`.
+        '''
+        if classic_shannon_entropy:
+            return np.array([
+                diffusion_spectral_entropy(
+                    embedding_vectors=read_rows(embedding_vectors, inds),
+                    max_N=None,
+                    classic_shannon_entropy=True,
+                    num_bins_per_dim=num_bins_per_dim)
+                for embedding_vectors in embeddings_list
+            ])
+
+        # Note that `K` is a stack of symmetric matrices with the same eigenvalues as the diffusion matrices.
+        K = compute_diffusion_matrix_batch(
+            [read_rows(embedding_vectors, inds) for embedding_vectors in embeddings_list],
+            sigma=gaussian_kernel_sigma)
+        if chebyshev_approx:
+            eigvals_list = [approx_eigvals(K_l) for K_l in K]
+        else:
+            eigvals_list = exact_eigvals(K)
+        return np.array(
+            [von_neumann_entropy(eigvals, t=t) for eigvals in eigvals_list])
+
+    #
+    '''STEP 3. Compute DSMI for all embeddings.'''
+    MI_by_class = np.zeros((len(index_sets), num_embeddings))
+
+    for cluster_i, (cluster_inds, random_inds_list) in enumerate(index_sets):
+        if verbose:
+            print('DSMI (multi): processing cluster %d/%d.' %
+                  (cluster_i + 1, len(index_sets)))
+
+        # DSE(A | B = b_i)
+        entropy_AgivenB_curr_class = entropy_per_embedding(cluster_inds)
+
+        # DSE(A*)
+        entropy_A_estimation = np.mean(
+            [entropy_per_embedding(rand_inds) for rand_inds in random_inds_list],
+            axis=0)
+
+        MI_by_class[cluster_i] = entropy_A_estimation - entropy_AgivenB_curr_class
+
+    mutual_information_list = list(
+        np.sum((cluster_cnts / np.sum(cluster_cnts))[:, None] * MI_by_class,
+               axis=0))
+
+    return mutual_information_list, precomputed_clusters
+
+
+def diffusion_and_classic_mutual_information(
+        embedding_vectors: np.array,
+        reference_vectors: np.array,
+        reference_discrete: bool = None,
+        gaussian_kernel_sigma: float = 10,
+        t: int = 1,
+        chebyshev_approx: bool = False,
+        num_repetitions: int = 5,
+        n_clusters: int = 10,
+        cluster_method: str = 'spectral',
+        precomputed_clusters: np.array = None,
+        num_bins_per_dim: int = 2,
+        compute_entropy: bool = False,
+        max_N: int = 10000,
+        random_seed: int = 0,
+        verbose: bool = False):
+    '''
+    DSMI and CSMI computed together in a single pass.
+
+    The result is the same as calling `diffusion_spectral_mutual_information` twice,
+    once with `classic_shannon_entropy` False and once with True, but the clustering
+    and the per-cluster and random subsample index sets are only prepared once.
+    Therefore, DSMI and CSMI are guaranteed to be computed on the exact same subsamples.
+
+    args:
+        compute_entropy: bool
+            If True, additionally compute DSE and CSE of `embedding_vectors`,
+            both on the same subsample of at most `max_N` data points.
+            The result is the same as calling `diffusion_spectral_entropy`
+            with `classic_shannon_entropy` False and True.
+
+        max_N: int
+            Max number of data points / samples used for each DSE and CSE,
+            both the ones within DSMI and CSMI and, if `compute_entropy`, the ones of `embedding_vectors`.
+
+        All other args are the same as in `diffusion_spectral_mutual_information`.
+
+    returns:
+        DSMI: float
+        CSMI: float
+        DSE: float (None if `compute_entropy` is False)
+        CSE: float (None if `compute_entropy` is False)
+        precomputed_clusters: np.array, the cluster assignments of `reference_vectors`
+    '''
+
+    #
+    '''STEP 1. Prepare the category/cluster assignments.'''
+    embedding_vectors = load_vectors(embedding_vectors)
+    reference_vectors, precomputed_clusters = compute_reference_clusters(
+        embedding_vectors=embedding_vectors,
+        reference_vectors=reference_vectors,
+        reference_discrete=reference_discrete,
+        n_clusters=n_clusters,
+        cluster_method=cluster_method,
+        precomputed_clusters=precomputed_clusters,
+        verbose=verbose)
+
+    #
+    '''STEP 2. Prepare the index sets for DSE(A | B = b_i) and DSE(A*).'''
+    _, cluster_cnts, index_sets = sample_index_sets(
+        precomputed_clusters=precomputed_clusters,
+        num_repetitions=num_repetitions,
+        random_seed=random_seed,
+        max_N=max_N)
+
+    def diffusion_and_classic_entropy(vecs: np.array) -> np.array:
+        return np.array([
+            diffusion_spectral_entropy(
+                embedding_vectors=vecs,
+                gaussian_kernel_sigma=gaussian_kernel_sigma,
+                t=t,
+                max_N=None,
+                chebyshev_approx=chebyshev_approx,
+                classic_shannon_entropy=classic_shannon_entropy,
+                num_bins_per_dim=num_bins_per_dim)
+            for classic_shannon_entropy in [False, True]
+        ])
+
+    #
+    '''STEP 3. Compute DSMI and CSMI.'''
+    # Each row is [DSE-based estimate, CSE-based estimate].
+    MI_by_class = np.zeros((len(index_sets), 2))
+
+    for cluster_i, (cluster_inds, random_inds_list) in enumerate(index_sets):
+        # DSE(A | B = b_i) and CSE(A | B = b_i)
+        entropy_AgivenB_curr_class = diffusion_and_classic_entropy(
+            read_rows(embedding_vectors, cluster_inds))
+
+        # DSE(A*) and CSE(A*)
+        entropy_A_estimation = np.mean([
+            diffusion_and_classic_entropy(read_rows(embedding_vectors, rand_inds))
+            for rand_inds in random_inds_list
+        ],
+                                       axis=0)
+
+        MI_by_class[cluster_i] = entropy_A_estimation - entropy_AgivenB_curr_class
+
+    DSMI, CSMI = np.sum(
+        (cluster_cnts / np.sum(cluster_cnts))[:, None] * MI_by_class, axis=0)
+
+    #
+    '''STEP 4 (optional). Compute DSE and CSE on the same subsample.'''
+    DSE, CSE = None, None
+    if compute_entropy:
+        if max_N is not None and len(embedding_vectors) > max_N:
+            random.seed(0)
+            rand_inds = np.array(
+                random.sample(range(len(embedding_vectors)), k=max_N))
+            embedding_vectors = read_rows(embedding_vectors, rand_inds)
+        DSE, CSE = diffusion_and_classic_entropy(np.asarray(embedding_vectors))
+
+    return DSMI, CSMI, DSE, CSE, precomputed_clusters
+
+
+def diffusion_spectral_mutual_information_permutation_test(
+        embedding_vectors: np.array,
+        reference_vectors: np.array,
+        reference_discrete: bool = None,
+        gaussian_kernel_sigma: float = 10,
+        t: int = 1,
+        num_repetitions: int = 5,
+        n_clusters: int = 10,
+        cluster_method: str = 'spectral',
+        precomputed_clusters: np.array = None,
+        num_permutations: int = 100,
+        null_quantiles: List[float] = [0.05, 0.5, 0.95],
+        num_workers: int = 4,
+        max_N: int = 10000,
+        random_seed: int = 0,
+        verbose: bool = False):
+    '''
+    Permutation test for the significance of DSMI(A; B).
+
+    The null distribution is formed by DSMI(A; pi(B)) over random permutations pi
+    of the cluster/category assignments of `reference_vectors`.
+
+    To avoid rebuilding the kernels for every permutation:
+        (1) The Gaussian kernel over all data points of A is computed only once.
+            The diffusion matrix of any subset is obtained by slicing this kernel
+            and renormalizing it.
+        (2) A permutation does not change the cluster sizes. Hence the random
+            index sets for DSE(A*) are the same for all permutations, and DSE(A*)
+            is only computed once. Only DSE(A | B = b_i) is recomputed.
+    The permutations are evaluated in parallel by `num_workers` threads.
+
+    args:
+        num_permutations: int
+            Number of label permutations used to form the null distribution.
+
+        null_quantiles: List[float]
+            Quantiles of the null distribution to report.
+
+        num_workers: int
+            Number of parallel workers for evaluating the permutations.
+
+        max_N: int
+            Max number of data points / samples used for computation.
+            If exceeded, A and B are subsampled together before the test.
+
+        All other args are the same as in `diffusion_spectral_mutual_information`.
+
+    returns:
+        DSMI: float, the observed DSMI(A; B)
+        null_quantile_values: np.array, the `null_quantiles` of the null distribution
+        p_value: float, the one-sided p-value of observing DSMI(A; B) under the null.
+    '''
+
+    #
+    '''STEP 1. Prepare the category/cluster assignments.'''
+    embedding_vectors = load_vectors(embedding_vectors)
+    reference_vectors, precomputed_clusters = compute_reference_clusters(
+        embedding_vectors=embedding_vectors,
+        reference_vectors=reference_vectors,
+        reference_discrete=reference_discrete,
+        n_clusters=n_clusters,
+        cluster_method=cluster_method,
+        precomputed_clusters=precomputed_clusters,
+        verbose=verbose)
+    precomputed_clusters = np.array(precomputed_clusters).reshape(-1)
+
+    # Subsample A and B together if number of data sample is too large.
+    if max_N is not None and len(embedding_vectors) > max_N:
+        random.seed(0)
+        rand_inds = np.array(
+            random.sample(range(len(embedding_vectors)), k=max_N))
+        embedding_vectors = read_rows(embedding_vectors, rand_inds)
+        precomputed_clusters = precomputed_clusters[rand_inds]
+    embedding_vectors = np.asarray(embedding_vectors)
+
+    #
+    '''STEP 2. Compute the Gaussian kernel once.'''
+    if verbose: print('Computing Gaussian kernel.')
+    G = compute_gaussian_kernel(embedding_vectors, sigma=gaussian_kernel_sigma)
+
+    def entropy_of_subset(inds: np.array) -> float:
+        K = normalize_gaussian_kernel(G[inds, :][:, inds])
+        return von_neumann_entropy(exact_eigvals(K), t=t)
+
+    #
+    '''STEP 3. DSE(A*), shared by the observed and the permuted assignments.'''
+    _, cluster_cnts, index_sets = sample_index_sets(
+        precomputed_clusters=precomputed_clusters,
+        num_repetitions=num_repetitions,
+        random_seed=random_seed,
+        max_N=None)
+    entropy_A_estimation = np.array([
+        np.mean([entropy_of_subset(rand_inds) for rand_inds in random_inds_list])
+        for _, random_inds_list in index_sets
+    ])
+    cluster_weights = cluster_cnts / np.sum(cluster_cnts)
+
+    def mutual_information_given_clusters(clusters: np.array) -> float:
+        _, _, curr_index_sets = sample_index_sets(precomputed_clusters=clusters,
+                                                  num_repetitions=0,
+                                                  max_N=None)
+        entropy_AgivenB = np.array([
+            entropy_of_subset(cluster_inds)
+            for cluster_inds, _ in curr_index_sets
+        ])
+        return np.sum(cluster_weights * (entropy_A_estimation - entropy_AgivenB))
+
+    #
+    '''STEP 4. Observed DSMI and the null distribution.'''
+    DSMI = mutual_information_given_clusters(precomputed_clusters)
+
+    rng = np.random.RandomState(random_seed)
+    permuted_clusters_list = [
+        rng.permutation(precomputed_clusters) for _ in range(num_permutations)
+    ]
+    if verbose: print('Evaluating %d permutations.' % num_permutations)
+    # The eigensolvers release the GIL, so threads can share `G` without copying.
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        null_distribution = np.array(
+            list(
+                executor.map(mutual_information_given_clusters,
+                             permuted_clusters_list)))
+
+    null_quantile_values = np.quantile(null_distribution, null_quantiles)
+    p_value = (1 + np.sum(null_distribution >= DSMI)) / (1 + num_permutations)
+
+    return DSMI, null_quantile_values, p_value
+
+
+def classic_shannon_mutual_information(
+        embedding_vectors: np.array,
+        reference_vectors: np.array,
+        reference_discrete: bool = None,
+        num_repetitions: int = 5,
+        n_clusters: int = 10,
+        cluster_method: str = 'spectral',
+        precomputed_clusters: np.array = None,
+        num_bins_per_dim: int = 2,
+        random_seed: int = 0,
+        verbose: bool = False):
+    '''
+    CSMI computed with a single global binning and one group-by.
+
+    The structure of the estimate is the same as `diffusion_spectral_mutual_information`
+    with `classic_shannon_entropy` True, i.e.,
+        CSMI(A; B) = sum_i [p(B = b_i) (CSE(A*) - CSE(A | B = b_i))],
+    with the same clusters and random subsample index sets. However:
+        (1) `embedding_vectors` is Min-Max scaled and binned once, using the global
+            min and max of each dimension, instead of separately for each subset.
+        (2) Every CSE(A | B = b_i) and every CSE(A*) is derived from the precomputed
+            bin codes with one group-by over (subset, bin code) pairs.
+    Hence the cost is about one pass over the data. Because of (1), the values are
+    not identical to the per-subset rescaled CSMI.
+
+    args:
+        Same as in `diffusion_spectral_mutual_information`.
+
+    returns:
+        CSMI: float
+        precomputed_clusters: np.array, the cluster assignments of `reference_vectors`
+    '''
+
+    #
+    '''STEP 1. Prepare the category/cluster assignments.'''
+    embedding_vectors = load_vectors(embedding_vectors)
+    reference_vectors, precomputed_clusters = compute_reference_clusters(
+        embedding_vectors=embedding_vectors,
+        reference_vectors=reference_vectors,
+        reference_discrete=reference_discrete,
+        n_clusters=n_clusters,
+        cluster_method=cluster_method,
+        precomputed_clusters=precomputed_clusters,
+        verbose=verbose)
+
+    #
+    '''STEP 2. Prepare the index sets for CSE(A | B = b_i) and CSE(A*).'''
+    _, cluster_cnts, index_sets = sample_index_sets(
+        precomputed_clusters=precomputed_clusters,
+        num_repetitions=num_repetitions,
+        random_seed=random_seed)
+
+    #
+    '''STEP 3. Bin the embeddings once.'''
+    keys = pack_bin_codes(embedding_vectors,
+                          num_bins_per_dim=num_bins_per_dim)
+    _, key_ids = count_keys(keys, return_inverse=True)
+
+    #
+    '''STEP 4. All conditional and subsampled entropies in one group-by.'''
+    # Subsets are ordered as [A | B = b_0, (A*)_0, ..., (A*)_R-1, A | B = b_1, ...].
+    subsets = []
+    for cluster_inds, random_inds_list in index_sets:
+        subsets.append(cluster_inds)
+        subsets.extend(random_inds_list)
+    subset_ids = np.concatenate([
+        np.full(len(inds), subset_idx) for subset_idx, inds in enumerate(subsets)
+    ])
+    entropy_by_subset = grouped_entropy(
+        group_ids=subset_ids,
+        key_ids=key_ids[np.concatenate(subsets)],
+        num_groups=len(subsets)).reshape(len(index_sets), 1 + num_repetitions)
+
+    entropy_AgivenB = entropy_by_subset[:, 0]
+    entropy_A_estimation = np.mean(entropy_by_subset[:, 1:], axis=1)
+    MI_by_class = entropy_A_estimation - entropy_AgivenB
+
+    mutual_information = np.sum(cluster_cnts / np.sum(cluster_cnts) *
+                                MI_by_class)
+
+    return mutual_information, precomputed_clusters
+
+
+def compute_reference_clusters(embedding_vectors: np.array,
+                               reference_vectors: np.array,
+                               reference_discrete: bool = None,
+                               n_clusters: int = 10,
+                               cluster_method: str = 'spectral',
+                               precomputed_clusters: np.array = None,
+                               verbose: bool = False):
+    '''
+    Prepare the category/cluster assignments of `reference_vectors`.
+    This is STEP 1 of the DSMI computation.
+
+    See `diffusion_spectral_mutual_information` for the meaning of the args.
+
+    returns:
+        reference_vectors: np.array of shape [N, D']
+        precomputed_clusters: np.array of shape [N, 1] or [N, ]
+    '''
+
+    reference_vectors = np.asarray(load_vectors(reference_vectors))
+
     # Reshape from [N, ] to [N, 1].
     if len(reference_vectors.shape) == 1:
         reference_vectors = reference_vectors.reshape(
@@ -129,9 +672,6 @@ def diffusion_spectral_mutual_information(
             and np.issubdtype(
             reference_vectors.dtype, np.integer)
 
-    #
-    '''STEP 1. Prepare the category/cluster assignments.'''
-
     if reference_discrete:
         # `reference_vectors` is expected to be discrete class labels.
         assert D_reference == 1, \
@@ -153,62 +693,161 @@ def diffusion_spectral_mutual_information(
 
     else:
         # `reference_vectors` is a set of continuous vectors.
-        # Perform spectral clustering if cluster assignments are not provided.
+        # Perform clustering if cluster assignments are not provided.
         if precomputed_clusters is None:
-            cluster_op = SpectralClustering(
+            precomputed_clusters = cluster_reference_vectors(
+                reference_vectors=reference_vectors,
                 n_clusters=n_clusters,
-                affinity='nearest_neighbors',
-                assign_labels='cluster_qr',
-                random_state=0).fit(reference_vectors)
-            precomputed_clusters = cluster_op.labels_
+                cluster_method=cluster_method,
+                verbose=verbose)
 
-    clusters_list, cluster_cnts = np.unique(precomputed_clusters,
-                                            return_counts=True)
+    return reference_vectors, precomputed_clusters
 
-    #
-    '''STEP 2. Compute DSMI.'''
-    MI_by_class = []
 
-    for cluster_idx in clusters_list:
-        # DSE(A | B = b_i)
-        inds = (precomputed_clusters == cluster_idx).reshape(-1)
-        embeddings_curr_class = embedding_vectors[inds, :]
+# In-process memo of the clustering results, keyed by the content of `reference_vectors`.
+# Bounded to the `_cluster_cache_size` most recently used entries, such that long runs
+# (e.g., DSMI every epoch during training) do not keep growing it.
+_cluster_cache = OrderedDict()
+_cluster_cache_size = 8
 
-        entropy_AgivenB_curr_class = diffusion_spectral_entropy(
-            embedding_vectors=embeddings_curr_class,
-            gaussian_kernel_sigma=gaussian_kernel_sigma,
-            t=t,
-            chebyshev_approx=chebyshev_approx,
-            classic_shannon_entropy=classic_shannon_entropy,
-            num_bins_per_dim=num_bins_per_dim)
 
-        # DSE(A*)
+def cluster_reference_vectors(reference_vectors: np.array,
+                              n_clusters: int = 10,
+                              cluster_method: str = 'spectral',
+                              pca_dim: int = 50,
+                              n_neighbors: int = 10,
+                              verbose: bool = False):
+    '''
+    Cluster a set of continuous vectors `reference_vectors` of shape [N, D'].
+
+    The results are memoized by a hash of the content of `reference_vectors`
+    together with `n_clusters`, `cluster_method`, `pca_dim` and `n_neighbors`,
+    for the few most recently used inputs.
+
+    args:
+        cluster_method: str
+            See `diffusion_spectral_mutual_information`.
+
+        pca_dim: int
+            Number of principal components kept by 'pca_kmeans' and 'sparse_spectral'.
+
+        n_neighbors: int
+            Number of nearest neighbors in the graph used by 'sparse_spectral'.
+
+    returns:
+        clusters: np.array of shape [N, ]
+    '''
+
+    reference_vectors = np.ascontiguousarray(reference_vectors)
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(str((reference_vectors.shape, reference_vectors.dtype.str,
+                       n_clusters, cluster_method, pca_dim,
+                       n_neighbors)).encode())
+    hasher.update(reference_vectors.view(np.uint8).reshape(-1))
+    cache_key = hasher.hexdigest()
+
+    if cache_key in _cluster_cache:
+        if verbose: print('Reusing memoized clusters of `reference_vectors`.')
+        _cluster_cache.move_to_end(cache_key)
+        return _cluster_cache[cache_key].copy()
+
+    if verbose: print('Clustering `reference_vectors` with %s.' % cluster_method)
+
+    N, D = reference_vectors.shape
+    if cluster_method in ['pca_kmeans', 'sparse_spectral'] and pca_dim < min(N, D):
+        reduced_vectors = PCA(n_components=pca_dim,
+                              svd_solver='randomized',
+                              random_state=0).fit_transform(reference_vectors)
+    else:
+        reduced_vectors = reference_vectors
+
+    if cluster_method == 'spectral':
+        clusters = SpectralClustering(n_clusters=n_clusters,
+                                      affinity='nearest_neighbors',
+                                      assign_labels='cluster_qr',
+                                      random_state=0).fit(reference_vectors).labels_
+
+    elif cluster_method == 'minibatch_kmeans':
+        clusters = MiniBatchKMeans(n_clusters=n_clusters,
+                                   batch_size=1024,
+                                   n_init=3,
+                                   random_state=0).fit(reference_vectors).labels_
+
+    elif cluster_method == 'pca_kmeans':
+        clusters = KMeans(n_clusters=n_clusters, n_init=10,
+                          random_state=0).fit(reduced_vectors).labels_
+
+    elif cluster_method == 'sparse_spectral':
+        knn_graph = kneighbors_graph(reduced_vectors,
+                                     n_neighbors=n_neighbors,
+                                     include_self=True)
+        clusters = SpectralClustering(n_clusters=n_clusters,
+                                      affinity='precomputed_nearest_neighbors',
+                                      n_neighbors=n_neighbors,
+                                      assign_labels='cluster_qr',
+                                      random_state=0).fit(knn_graph).labels_
+
+    else:
+        raise ValueError(
+            '`cluster_reference_vectors`: cluster_method (%s) not supported.' %
+            cluster_method)
+
+    _cluster_cache[cache_key] = clusters
+    if len(_cluster_cache) > _cluster_cache_size:
+        # Evict the least recently used entry.
+        _cluster_cache.popitem(last=False)
+    return clusters.copy()
+
+
+def sample_index_sets(precomputed_clusters: np.array,
+                      num_repetitions: int = 5,
+                      random_seed: int = 0,
+                      max_N: int = 10000):
+    '''
+    Prepare the index sets used for DSE(A | B = b_i) and DSE(A*).
+    This is STEP 2 of the DSMI computation.
+
+    For each cluster b_i, we record
+        (1) the indices of the data points in {B = b_i}.
+        (2) `num_repetitions` sets of random indices, each of size len(B = b_i).
+
+    Any index set larger than `max_N` is subsampled in the same way as
+    `diffusion_spectral_entropy` subsamples its input, such that the entropies
+    computed on these index sets are identical to the ones computed before.
+
+    returns:
+        clusters_list: np.array of the unique cluster assignments
+        cluster_cnts: np.array of the number of data points in each cluster
+        index_sets: List of (cluster_inds, [rand_inds for each repetition])
+    '''
+
+    def cap_at_max_N(inds: np.array) -> np.array:
+        if max_N is not None and len(inds) > max_N:
+            random.seed(0)
+            inds = inds[np.array(random.sample(range(len(inds)), k=max_N))]
+        return inds
+
+    clusters_list, cluster_cnts = np.unique(precomputed_clusters,
+                                            return_counts=True)
+
+    index_sets = []
+    for cluster_idx, cluster_cnt in zip(clusters_list, cluster_cnts):
+        cluster_inds = np.argwhere(
+            (precomputed_clusters == cluster_idx).reshape(-1)).reshape(-1)
+        cluster_inds = cap_at_max_N(cluster_inds)
+
         if random_seed is not None:
             random.seed(random_seed)
-        entropy_A_estimation_list = []
+        random_inds_list = []
         for _ in np.arange(num_repetitions):
             rand_inds = np.array(
                 random.sample(range(precomputed_clusters.shape[0]),
-                              k=np.sum(precomputed_clusters == cluster_idx)))
-            embeddings_random_subset = embedding_vectors[rand_inds, :]
+                              k=cluster_cnt))
+            random_inds_list.append(cap_at_max_N(rand_inds))
 
-            entropy_A_subsample_rep = diffusion_spectral_entropy(
-                embedding_vectors=embeddings_random_subset,
-                gaussian_kernel_sigma=gaussian_kernel_sigma,
-                t=t,
-                chebyshev_approx=chebyshev_approx,
-                classic_shannon_entropy=classic_shannon_entropy,
-                num_bins_per_dim=num_bins_per_dim)
-            entropy_A_estimation_list.append(entropy_A_subsample_rep)
+        index_sets.append((cluster_inds, random_inds_list))
 
-        entropy_A_estimation = np.mean(entropy_A_estimation_list)
-
-        MI_by_class.append((entropy_A_estimation - entropy_AgivenB_curr_class))
-
-    mutual_information = np.sum(cluster_cnts / np.sum(cluster_cnts) *
-                                np.array(MI_by_class))
-
-    return mutual_information, precomputed_clusters
+    return clusters_list, cluster_cnts, index_sets
 
 
 if __name__ == '__main__':
@@ -252,3 +891,73 @@ if __name__ == '__main__':
         reference_vectors=class_labels,
         classic_shannon_entropy=True)
     print('CSMI =', CSMI)
+
+    print('\n6th run. DSMI of multiple embeddings vs the same class labels.')
+    embeddings_list = [
+        np.random.uniform(0, 1, (1000, 256)),
+        np.random.uniform(0, 1, (1000, 64)),
+        np.random.uniform(0, 1, (1000, 16)),
+    ]
+    class_labels = np.uint8(np.random.uniform(0, 11, (1000, 1)))
+    DSMI_list, _ = diffusion_spectral_mutual_information_multi(
+        embeddings_list=embeddings_list, reference_vectors=class_labels)
+    for embedding_vectors, DSMI_multi in zip(embeddings_list, DSMI_list):
+        DSMI, _ = diffusion_spectral_mutual_information(
+            embedding_vectors=embedding_vectors,
+            reference_vectors=class_labels)
+        print('DSMI (multi) = %s, DSMI (single) = %s' % (DSMI_multi, DSMI))
+
+    print('\n7th run. DSMI and CSMI in one pass, Classification dataset.')
+    embedding_vectors, class_labels = make_classification(n_samples=1000,
+                                                          n_features=5)
+    DSMI, CSMI, DSE, CSE, _ = diffusion_and_classic_mutual_information(
+        embedding_vectors=embedding_vectors,
+        reference_vectors=class_labels,
+        compute_entropy=True)
+    print('DSMI =', DSMI, ', CSMI =', CSMI, ', DSE =', DSE, ', CSE =', CSE)
+
+    print('\n8th run. DSMI permutation test, Classification dataset.')
+    embedding_vectors, class_labels = make_classification(n_samples=1000,
+                                                          n_features=5)
+    DSMI, null_quantile_values, p_value = diffusion_spectral_mutual_information_permutation_test(
+        embedding_vectors=embedding_vectors,
+        reference_vectors=class_labels,
+        num_permutations=20)
+    print('DSMI =', DSMI, ', null quantiles (5%, 50%, 95%) =',
+          null_quantile_values, ', p-value =', p_value)
+
+    print('\n9th run. DSMI, Embeddings vs Input Image, with all cluster methods.')
+    embedding_vectors = np.random.uniform(0, 1, (1000, 256))
+    input_image = np.random.uniform(-1, 1, (1000, 3, 32, 32))
+    input_image = input_image.reshape(input_image.shape[0], -1)
+    for cluster_method in [
+            'spectral', 'minibatch_kmeans', 'pca_kmeans', 'sparse_spectral'
+    ]:
+        DSMI, _ = diffusion_spectral_mutual_information(
+            embedding_vectors=embedding_vectors,
+            reference_vectors=input_image,
+            cluster_method=cluster_method)
+        print('DSMI (%s) =' % cluster_method, DSMI)
+
+    print('\n10th run. CSMI with global binning in one group-by, Classification dataset.')
+    embedding_vectors, class_labels = make_classification(n_samples=1000,
+                                                          n_features=5)
+    CSMI, _ = classic_shannon_mutual_information(
+        embedding_vectors=embedding_vectors, reference_vectors=class_labels)
+    print('CSMI (global bins) =', CSMI)
+
+    print('\n11th run. DSMI, embeddings and class labels from .npy files.')
+    embedding_path = './test_dsmi_embedding_vectors.npy'
+    label_path = './test_dsmi_class_labels.npy'
+    embedding_vectors, class_labels = make_classification(n_samples=1000,
+                                                          n_features=5)
+    np.save(embedding_path, embedding_vectors)
+    np.save(label_path, class_labels)
+    DSMI, _ = diffusion_spectral_mutual_information(
+        embedding_vectors=embedding_path, reference_vectors=label_path)
+    print('DSMI (.npy files) =', DSMI)
+    DSMI, _ = diffusion_spectral_mutual_information(
+        embedding_vectors=embedding_vectors, reference_vectors=class_labels)
+    print('DSMI (in memory) =', DSMI)
+    os.remove(embedding_path)
+    os.remove(label_path)
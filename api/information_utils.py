@@ -41,8 +41,9 @@ def approx_eigvals(A: np.array, filter_thr: float = 1e-3):
 def exact_eigvals(A: np.array):
     '''
     Compute the exact eigenvalues.
+    Also accepts a stack of matrices of shape [L, N, N].
     '''
-    if np.allclose(A, A.T, rtol=1e-5, atol=1e-8):
+    if np.allclose(A, np.swapaxes(A, -1, -2), rtol=1e-5, atol=1e-8):
         # Symmetric matrix.
         eigenvalues = np.linalg.eigvalsh(A)
     else:
@@ -69,3 +70,163 @@ def exact_eig(A: np.array):
     eigenvectors_P = eigenvectors_P[:, sorted_idx]
 
     return eigenvalues_P, eigenvectors_P
+
+
+def load_vectors(vectors):
+    '''
+    If `vectors` is a path to a `.npy` file, open it as a read-only memory map,
+    such that only the rows that are accessed are read from disk.
+    Otherwise, `vectors` is returned as is.
+    '''
+    if isinstance(vectors, str):
+        return np.load(vectors, mmap_mode='r')
+    return vectors
+
+
+def read_rows(vectors, inds: np.array) -> np.array:
+    '''
+    Equivalent to `vectors[inds]`, for any array-like `vectors` that supports fancy indexing
+    (e.g., a memory-mapped `.npy` file or an h5py dataset).
+
+    If `vectors` is not already in memory, the rows are read once each and in sorted order,
+    which is friendlier to the disk, and then put back into the order of `inds`.
+    '''
+    if type(vectors) is np.ndarray:
+        return vectors[inds]
+    sorted_inds, inverse = np.unique(inds, return_inverse=True)
+    return np.asarray(vectors[sorted_inds])[inverse.reshape(-1)]
+
+
+def von_neumann_entropy(eigs: np.array, t: int = 1):
+    '''
+    von Neumann Entropy over a data graph.
+
+    H(G) = - sum_i [eig_i^t log eig_i^t]
+
+    where each `eig_i` is an eigenvalue of G.
+    '''
+
+    eigenvalues = eigs.copy()
+    eigenvalues = eigenvalues.astype(np.float64)  # mitigates rounding error.
+
+    # Eigenvalues may be negative. Only care about the magnitude, not the sign.
+    eigenvalues = np.abs(eigenvalues)
+
+    # Power eigenvalues to `t` to mitigate effect of noise.
+    eigenvalues = eigenvalues**t
+
+    prob = eigenvalues / eigenvalues.sum()
+    prob = prob + np.finfo(float).eps
+
+    return -np.sum(prob * np.log2(prob))
+
+
+def pack_bin_codes(vecs: np.array,
+                   num_bins_per_dim: int = 2,
+                   vec_min: np.array = None,
+                   vec_max: np.array = None,
+                   chunk_size: int = 4096):
+    '''
+    Bin a set of N vectors, each of D dimensions, and pack the bins of each vector
+    into a compact fixed-width byte key.
+
+    Each dimension is Min-Max scaled and binned into `num_bins_per_dim` bins,
+    exactly as in the Classic Shannon Entropy. Each bin index takes ceil(log2(num_bins_per_dim))
+    bits (1 bit for 2 bins), so two vectors share a key if and only if they fall into the same bin.
+    Rows are processed in chunks of `chunk_size` to avoid materializing a full [N, D] integer matrix.
+
+    args:
+        vec_min, vec_max: np.array of shape [D, ]
+            Bounds used for Min-Max scaling. Computed from `vecs` if not provided.
+
+    returns:
+        keys: np.array of shape [N, W], dtype np.uint8, where W = ceil(D * bits / 8).
+    '''
+    N, D = vecs.shape
+    if vec_min is None:
+        vec_min = np.min(vecs, axis=0)
+    if vec_max is None:
+        vec_max = np.max(vecs, axis=0)
+
+    bins = np.linspace(0, 1, num_bins_per_dim + 1)[:-1]
+    num_bits = max(1, int(np.ceil(np.log2(num_bins_per_dim))))
+
+    keys = np.empty((N, int(np.ceil(D * num_bits / 8))), dtype=np.uint8)
+    for start in range(0, N, chunk_size):
+        chunk = vecs[start:start + chunk_size]
+        # Min-Max scale each dimension.
+        chunk = (chunk - vec_min) / (vec_max - vec_min)
+        # Bin along each dimension. Bin indices range from 0 to `num_bins_per_dim` - 1.
+        # Values outside of fixed bounds go to the first or the last bin.
+        codes = np.clip(np.digitize(chunk, bins=bins) - 1, 0,
+                        num_bins_per_dim - 1)
+        keys[start:start + chunk_size] = pack_codes(codes, num_bits=num_bits)
+
+    return keys
+
+
+def pack_codes(codes: np.array, num_bits: int):
+    '''
+    Pack a [N, D] matrix of small non-negative integers, each using `num_bits` bits,
+    into a [N, ceil(D * num_bits / 8)] matrix of bytes.
+
+    The bits of each integer are written most significant first, such that
+    comparing two packed rows byte by byte gives the lexicographic order of the original rows.
+    '''
+    N, D = codes.shape
+    codes = codes.astype(np.uint8 if num_bits <= 8 else np.uint16)
+    if num_bits > 1:
+        # Split each integer into its bits.
+        codes = np.stack(
+            [(codes >> bit) & 1 for bit in reversed(range(num_bits))],
+            axis=-1).reshape(N, D * num_bits)
+    return np.packbits(codes, axis=1)
+
+
+def count_keys(keys: np.array, return_inverse: bool = False):
+    '''
+    Count the occurrences of each unique row of `keys` produced by `pack_bin_codes`.
+    Each row is viewed as one fixed-width opaque value, so the rows are sorted
+    by memory comparison rather than lexicographically element by element.
+
+    returns:
+        counts: np.array of shape [M, ], M being the number of unique keys.
+        inverse (if `return_inverse`): np.array of shape [N, ], the index of the unique key of each row.
+    '''
+    keys = np.ascontiguousarray(keys)
+    keys_void = keys.view(np.dtype((np.void, keys.shape[1]))).reshape(-1)
+    _, inverse, counts = np.unique(keys_void,
+                                   return_inverse=True,
+                                   return_counts=True)
+    if return_inverse:
+        return counts, inverse.reshape(-1)
+    return counts
+
+
+def grouped_entropy(group_ids: np.array, key_ids: np.array, num_groups: int):
+    '''
+    Shannon entropy of the histogram of `key_ids` within each group, all in one pass.
+
+    args:
+        group_ids: np.array of shape [M, ], integer group of each item, in [0, num_groups).
+        key_ids: np.array of shape [M, ], integer histogram bin of each item (e.g., from `count_keys`).
+
+    returns:
+        entropy_by_group: np.array of shape [num_groups, ]
+    '''
+    group_ids = np.asarray(group_ids, dtype=np.int64)
+    key_ids = np.asarray(key_ids, dtype=np.int64)
+    num_keys = np.max(key_ids) + 1
+
+    # Count each (group, key) pair with one sort.
+    pair_ids, pair_cnts = np.unique(group_ids * num_keys + key_ids,
+                                    return_counts=True)
+    pair_groups = pair_ids // num_keys
+    group_cnts = np.bincount(group_ids, minlength=num_groups)
+
+    prob = pair_cnts / group_cnts[pair_groups]
+    prob = prob + np.finfo(float).eps
+    entropy_by_group = np.bincount(pair_groups,
+                                   weights=-prob * np.log2(prob),
+                                   minlength=num_groups)
+    return entropy_by_group
@@ -0,0 +1,417 @@
+from typing import Dict, Tuple
+
+import numpy as np
+from sklearn.metrics import pairwise_distances
+from information_utils import approx_eigvals, pack_bin_codes, von_neumann_entropy
+
+
+def entropy_from_counts(counts: np.array):
+    '''
+    Shannon entropy of the histogram given by `counts`.
+    '''
+    counts = np.array(counts, dtype=np.float64)
+    prob = counts / np.sum(counts)
+    prob = prob + np.finfo(float).eps
+    return -np.sum(prob * np.log2(prob))
+
+
+class StreamingClassicShannonEntropy(object):
+    '''
+    Classic Shannon Entropy (CSE) and Mutual Information (CSMI) over a stream of batches,
+    without materializing the full [N, D] embedding matrix.
+
+    Two passes over the data are needed, unless the bounds are provided:
+        Pass 1: `update_bounds(batch)` collects the per-dimension min and max.
+        Pass 2: `update(batch, conditions)` bins the batch and updates the hash-count tables.
+
+    Memory usage only depends on the number of occupied bins, not on N.
+
+    `conditions` is a dict of discrete variables (e.g., {'Y': labels, 'X': input_clusters}),
+    each of shape [B, ] and aligned with the batch. For each of them, the counts are also
+    kept per category, such that H(Z | B) and I(Z; B) can be computed.
+
+    NOTE: The bins are defined by the global min and max of each dimension.
+    `diffusion_spectral_entropy` with `classic_shannon_entropy=True` gives the same CSE.
+    The CSMI here is the plug-in estimate H(Z) - H(Z | B), where every conditional entropy
+    uses the same global bins. It is not identical to the CSMI from
+    `diffusion_spectral_mutual_information`, which rescales each subset separately
+    and estimates H(Z) from random subsets of matching size.
+
+    args:
+        num_bins_per_dim: int
+            Number of bins per feature dim.
+
+        vec_min, vec_max: np.array of shape [D, ]
+            Fixed bounds for Min-Max scaling. If provided, pass 1 can be skipped.
+    '''
+
+    def __init__(self,
+                 num_bins_per_dim: int = 2,
+                 vec_min: np.array = None,
+                 vec_max: np.array = None):
+        self.num_bins_per_dim = num_bins_per_dim
+        self.vec_min = vec_min
+        self.vec_max = vec_max
+        self.counts = {}
+        self.conditional_counts = {}
+
+    def update_bounds(self, batch: np.array) -> None:
+        '''
+        Pass 1. Update the per-dimension min and max with a batch of shape [B, D].
+        '''
+        batch_min, batch_max = np.min(batch, axis=0), np.max(batch, axis=0)
+        if self.vec_min is None:
+            self.vec_min, self.vec_max = batch_min, batch_max
+        else:
+            self.vec_min = np.minimum(self.vec_min, batch_min)
+            self.vec_max = np.maximum(self.vec_max, batch_max)
+
+    def update(self, batch: np.array,
+               conditions: Dict[str, np.array] = None) -> None:
+        '''
+        Pass 2. Bin a batch of shape [B, D] and update the counts.
+        '''
+        assert self.vec_min is not None, \
+            '`StreamingClassicShannonEntropy`: bounds not available. Run `update_bounds` first or provide them.'
+
+        keys = pack_bin_codes(batch,
+                              num_bins_per_dim=self.num_bins_per_dim,
+                              vec_min=self.vec_min,
+                              vec_max=self.vec_max)
+        self._add_counts(self.counts, keys)
+
+        if conditions is None:
+            return
+        for name, categories in conditions.items():
+            categories = np.array(categories).reshape(-1)
+            assert len(categories) == len(keys)
+            if name not in self.conditional_counts:
+                self.conditional_counts[name] = {}
+            for category in np.unique(categories):
+                if category not in self.conditional_counts[name]:
+                    self.conditional_counts[name][category] = {}
+                self._add_counts(self.conditional_counts[name][category],
+                                 keys[categories == category])
+
+    def entropy(self) -> float:
+        '''
+        CSE: H(Z).
+        '''
+        return entropy_from_counts(list(self.counts.values()))
+
+    def conditional_entropy(self, name: str) -> float:
+        '''
+        H(Z | B) = sum_i [p(B = b_i) H(Z | B = b_i)], where B is `conditions[name]`.
+        '''
+        table_by_category = self.conditional_counts[name]
+        category_cnts = np.array([
+            np.sum(list(table.values()))
+            for table in table_by_category.values()
+        ])
+        entropy_by_category = np.array([
+            entropy_from_counts(list(table.values()))
+            for table in table_by_category.values()
+        ])
+        return np.sum(category_cnts / np.sum(category_cnts) *
+                      entropy_by_category)
+
+    def mutual_information(self, name: str) -> float:
+        '''
+        CSMI: I(Z; B) = H(Z) - H(Z | B), where B is `conditions[name]`.
+        '''
+        return self.entropy() - self.conditional_entropy(name)
+
+    @staticmethod
+    def _add_counts(table: Dict[bytes, int], keys: np.array) -> None:
+        keys_void = np.ascontiguousarray(keys).view(
+            np.dtype((np.void, keys.shape[1]))).reshape(-1)
+        unique_keys, counts = np.unique(keys_void, return_counts=True)
+        for key, count in zip(unique_keys, counts):
+            key = key.tobytes()
+            table[key] = table.get(key, 0) + int(count)
+
+
+class IncrementalDiffusionSpectralEntropy(object):
+    '''
+    Diffusion Spectral Entropy (DSE) over embeddings fed batch by batch,
+    e.g., as they come off the model during inference.
+
+    `partial_fit(batch)` computes the Gaussian kernel between the new rows and
+    all rows seen so far (the upper-triangular blocks only), and updates the degrees.
+    `finalize()` only has to normalize the kernel and compute the eigenvalues,
+    so the O(N^2 D) distance computation is spread over the inference loop.
+
+    Gives the same DSE as `diffusion_spectral_entropy` with `max_N=None`.
+    Memory usage is O(N^2), hence it is meant for N up to ~10,000.
+
+    Usage:
+        dse_accumulator = IncrementalDiffusionSpectralEntropy(capacity=len(val_loader.dataset))
+        for x, _ in val_loader:
+            dse_accumulator.partial_fit(model.encode(x).cpu().numpy())
+        DSE = dse_accumulator.finalize()
+
+    args:
+        gaussian_kernel_sigma: float
+            Same as in `diffusion_spectral_entropy`.
+
+        t: int
+            Same as in `diffusion_spectral_entropy`.
+
+        chebyshev_approx: bool
+            Same as in `diffusion_spectral_entropy`.
+
+        capacity: int
+            Expected total number of rows. The buffers grow if it is exceeded.
+    '''
+
+    def __init__(self,
+                 gaussian_kernel_sigma: float = 10,
+                 t: int = 1,
+                 chebyshev_approx: bool = False,
+                 capacity: int = None):
+        self.sigma = gaussian_kernel_sigma
+        self.t = t
+        self.chebyshev_approx = chebyshev_approx
+        self.capacity = capacity
+
+        self.num_rows = 0
+        self.embeddings = None  # [capacity, D]
+        self.G = None  # [capacity, capacity], only the upper triangle is filled.
+        self.degrees = None  # [capacity, ]
+
+    def partial_fit(self, batch: np.array) -> None:
+        '''
+        Add a batch of embeddings of shape [B, D].
+        '''
+        batch = np.asarray(batch, dtype=np.float64).reshape(len(batch), -1)
+        n, B = self.num_rows, len(batch)
+        if self.embeddings is None:
+            self._allocate(capacity=max(self.capacity or 0, B),
+                           dim=batch.shape[1])
+        elif n + B > len(self.degrees):
+            self._allocate(capacity=max(n + B, 2 * len(self.degrees)),
+                           dim=batch.shape[1])
+
+        # Gaussian kernel between all rows so far (including the new ones) and the new rows.
+        self.embeddings[n:n + B] = batch
+        D = pairwise_distances(self.embeddings[:n + B], batch)
+        G_new = (1 / (self.sigma * np.sqrt(2 * np.pi))) * np.exp(
+            (-D**2) / (2 * self.sigma**2))
+
+        # Upper-triangular blocks: [old rows, new rows] and [new rows, new rows].
+        self.G[:n + B, n:n + B] = G_new
+
+        # Running degrees. The [new rows, old rows] block is the transpose of the
+        # [old rows, new rows] block, hence it contributes `G_new[:n].sum(axis=0)`.
+        self.degrees[:n] += G_new[:n].sum(axis=1)
+        self.degrees[n:n + B] = G_new.sum(axis=0)
+        self.num_rows += B
+
+    def finalize(self) -> float:
+        '''
+        DSE of all rows seen so far.
+        '''
+        n = self.num_rows
+        assert n > 0, \
+            '`IncrementalDiffusionSpectralEntropy.finalize`: no data. Run `partial_fit` first.'
+
+        # Anisotropic density normalization. The lower triangle stays zero.
+        deg_inv_sqrt = 1 / self.degrees[:n]**0.5
+        K = deg_inv_sqrt[:, None] * self.G[:n, :n] * deg_inv_sqrt[None, :]
+
+        if self.chebyshev_approx:
+            K = K + np.triu(K, k=1).T
+            eigvals = approx_eigvals(K)
+        else:
+            # Only the upper triangle is read.
+            eigvals = np.linalg.eigvalsh(K, UPLO='U')
+
+        return von_neumann_entropy(eigvals, t=self.t)
+
+    def _allocate(self, capacity: int, dim: int) -> None:
+        n = self.num_rows
+        embeddings, G, degrees = self.embeddings, self.G, self.degrees
+        self.embeddings = np.zeros((capacity, dim))
+        self.G = np.zeros((capacity, capacity))
+        self.degrees = np.zeros(capacity)
+        if n > 0:
+            self.embeddings[:n] = embeddings[:n]
+            self.G[:n, :n] = G[:n, :n]
+            self.degrees[:n] = degrees[:n]
+
+
+class WindowedDiffusionSpectralEntropy(object):
+    '''
+    Diffusion Spectral Entropy (DSE) over a sliding window of the most recent embeddings,
+    e.g., to monitor DSE every few training steps instead of once per epoch.
+
+    A ring buffer keeps the last `window_size` embeddings and their Gaussian kernel.
+    Each insertion only recomputes the rows/columns of the overwritten slots.
+    The spectrum is recomputed lazily: every `update_every` calls to `update`,
+    or when `entropy()` is called after an insertion.
+
+    Each recomputed value is appended to a time series, available from `time_series()`.
+
+    Usage:
+        dse_monitor = WindowedDiffusionSpectralEntropy(window_size=1000, update_every=50)
+        for step, (x, _) in enumerate(train_loader):
+            ...
+            dse_monitor.update(z.detach().cpu().numpy(), step=step)
+        steps, dse_values = dse_monitor.time_series()
+
+    args:
+        window_size: int
+            Number of most recent embeddings used for DSE.
+
+        update_every: int
+            Number of calls to `update` between two recomputations of the spectrum.
+
+        gaussian_kernel_sigma: float
+            Same as in `diffusion_spectral_entropy`.
+
+        t: int
+            Same as in `diffusion_spectral_entropy`.
+
+        chebyshev_approx: bool
+            Same as in `diffusion_spectral_entropy`.
+    '''
+
+    def __init__(self,
+                 window_size: int = 1000,
+                 update_every: int = 50,
+                 gaussian_kernel_sigma: float = 10,
+                 t: int = 1,
+                 chebyshev_approx: bool = False):
+        self.window_size = window_size
+        self.update_every = update_every
+        self.sigma = gaussian_kernel_sigma
+        self.t = t
+        self.chebyshev_approx = chebyshev_approx
+
+        self.embeddings = None  # [window_size, D]
+        self.G = np.zeros((window_size, window_size))
+        self.num_filled = 0  # Slots [0, num_filled) are in use.
+        self.next_slot = 0  # Next slot to be overwritten.
+
+        self.num_updates = 0
+        self.latest_entropy = None
+        self.steps, self.values = [], []
+
+    def update(self, batch: np.array, step: int = None) -> float:
+        '''
+        Insert a batch of embeddings of shape [B, D].
+        Returns the DSE if the spectrum is recomputed at this call, otherwise None.
+        '''
+        batch = np.asarray(batch, dtype=np.float64).reshape(len(batch), -1)
+        # Only the most recent `window_size` rows can stay in the window.
+        batch = batch[-self.window_size:]
+        B = len(batch)
+        if self.embeddings is None:
+            self.embeddings = np.zeros((self.window_size, batch.shape[1]))
+
+        slots = (self.next_slot + np.arange(B)) % self.window_size
+        self.next_slot = (self.next_slot + B) % self.window_size
+        self.num_filled = min(self.num_filled + B, self.window_size)
+        self.embeddings[slots] = batch
+
+        # Gaussian kernel between the window and the new rows.
+        D = pairwise_distances(self.embeddings[:self.num_filled], batch)
+        G_new = (1 / (self.sigma * np.sqrt(2 * np.pi))) * np.exp(
+            (-D**2) / (2 * self.sigma**2))
+        self.G[:self.num_filled, slots] = G_new
+        self.G[slots, :self.num_filled] = G_new.T
+        self.latest_entropy = None
+
+        self.num_updates += 1
+        if self.num_updates % self.update_every == 0:
+            entropy = self.entropy()
+            self.steps.append(self.num_updates if step is None else step)
+            self.values.append(entropy)
+            return entropy
+        return None
+
+    def entropy(self) -> float:
+        '''
+        DSE of the current window. Only recomputed if the window has changed.
+        '''
+        assert self.num_filled > 0, \
+            '`WindowedDiffusionSpectralEntropy.entropy`: no data. Run `update` first.'
+
+        if self.latest_entropy is None:
+            n = self.num_filled
+            G = self.G[:n, :n]
+
+            # Anisotropic density normalization.
+            deg_inv_sqrt = 1 / np.sum(G, axis=1)**0.5
+            K = deg_inv_sqrt[:, None] * G * deg_inv_sqrt[None, :]
+
+            if self.chebyshev_approx:
+                eigvals = approx_eigvals(K)
+            else:
+                eigvals = np.linalg.eigvalsh(K)
+            self.latest_entropy = von_neumann_entropy(eigvals, t=self.t)
+
+        return self.latest_entropy
+
+    def time_series(self) -> Tuple[np.array, np.array]:
+        '''
+        The steps and the DSE values recomputed so far.
+        '''
+        return np.array(self.steps), np.array(self.values)
+
+
+if __name__ == '__main__':
+    from dse import diffusion_spectral_entropy
+
+    print('Testing Streaming Classic Shannon Entropy.')
+    embedding_vectors = np.random.uniform(0, 1, (1000, 20))
+    class_labels = np.uint8(np.random.uniform(0, 11, (1000, )))
+    batch_size = 64
+
+    streaming_cse = StreamingClassicShannonEntropy()
+    for i in range(0, len(embedding_vectors), batch_size):
+        streaming_cse.update_bounds(embedding_vectors[i:i + batch_size])
+    for i in range(0, len(embedding_vectors), batch_size):
+        streaming_cse.update(embedding_vectors[i:i + batch_size],
+                             conditions={'Y': class_labels[i:i + batch_size]})
+
+    CSE = diffusion_spectral_entropy(embedding_vectors=embedding_vectors,
+                                     classic_shannon_entropy=True)
+    print('CSE (streaming) =', streaming_cse.entropy(), ', CSE =', CSE)
+    print('CSMI (streaming, plug-in) =', streaming_cse.mutual_information('Y'))
+
+    print('\nTesting Streaming Classic Shannon Entropy with out-of-range values.')
+    # Values outside of the fixed bounds [0, 1] go to the first or the last bin.
+    for num_bins_per_dim in [2, 3]:
+        streaming_cse = StreamingClassicShannonEntropy(
+            num_bins_per_dim=num_bins_per_dim,
+            vec_min=np.zeros(1),
+            vec_max=np.ones(1))
+        streaming_cse.update(np.array([[-0.5], [0.9], [0.1], [1.5]]))
+        clipped_cse = StreamingClassicShannonEntropy(
+            num_bins_per_dim=num_bins_per_dim,
+            vec_min=np.zeros(1),
+            vec_max=np.ones(1))
+        clipped_cse.update(np.array([[0.0], [0.9], [0.1], [1.0]]))
+        assert streaming_cse.counts == clipped_cse.counts
+        print('%d bins: counts =' % num_bins_per_dim, streaming_cse.counts)
+
+    print('\nTesting Incremental Diffusion Spectral Entropy.')
+    dse_accumulator = IncrementalDiffusionSpectralEntropy(capacity=500)
+    for i in range(0, len(embedding_vectors), batch_size):
+        dse_accumulator.partial_fit(embedding_vectors[i:i + batch_size])
+
+    DSE = diffusion_spectral_entropy(embedding_vectors=embedding_vectors)
+    print('DSE (incremental) =', dse_accumulator.finalize(), ', DSE =', DSE)
+
+    print('\nTesting Windowed Diffusion Spectral Entropy.')
+    window_size = 300
+    dse_monitor = WindowedDiffusionSpectralEntropy(window_size=window_size,
+                                                   update_every=4)
+    for i in range(0, len(embedding_vectors), batch_size):
+        dse_monitor.update(embedding_vectors[i:i + batch_size])
+
+    DSE = diffusion_spectral_entropy(
+        embedding_vectors=embedding_vectors[-window_size:])
+    print('DSE (last window) =', dse_monitor.entropy(), ', DSE =', DSE)
+    print('DSE time series =', dse_monitor.time_series())
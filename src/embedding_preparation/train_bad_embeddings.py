@@ -26,7 +26,7 @@ from log_utils import log
 from models import get_model
 from path_utils import update_config_dirs
 from seed import seed_everything
-from save_utils import save_numpy
+from save_utils import EmbeddingStore, save_numpy_to_store
 from scheduler import LinearWarmupCosineAnnealingLR
 
 
@@ -401,6 +401,11 @@ def infer(config: AttributeHashmap) -> None:
         total_by_class = {}
         correct_by_class = {}
 
+        # Save the images, labels, and embeddings for future reference.
+        store = EmbeddingStore('%s/embeddings/%s/' %
+                               (config.output_save_path, checkpoint_name),
+                               capacity=len(val_loader.dataset))
+
         with torch.no_grad():
             for batch_idx, (x, y_true) in enumerate(val_loader):
                 assert config.in_channels in [1, 3]
@@ -409,8 +414,7 @@ def infer(config: AttributeHashmap) -> None:
                     x = x.repeat(1, 3, 1, 1)
                 x, y_true = x.to(device), y_true.to(device)
 
-                h = model.encode(x)
-                y_pred = model(x)
+                y_pred, h = model.forward_with_features(x)
                 y_correct = (torch.argmax(
                     y_pred, dim=-1) == y_true).cpu().detach().numpy()
 
@@ -427,12 +431,11 @@ def infer(config: AttributeHashmap) -> None:
                     if is_correct:
                         correct_by_class[class_true] += 1
 
-                save_numpy(config=config,
-                           batch_idx=batch_idx,
-                           numpy_filename=checkpoint_name,
-                           image_batch=x,
-                           label_true_batch=y_true,
-                           embedding_batch=h)
+                save_numpy_to_store(store=store,
+                                    image_batch=x,
+                                    label_true_batch=y_true,
+                                    embedding_batch=h)
+            store.close()
 
             log('\nCheckpoint: %s' % checkpoint_name,
                 filepath=log_path,
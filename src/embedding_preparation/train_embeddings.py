@@ -19,9 +19,10 @@ from early_stop import EarlyStopping
 from log_utils import log
 from models import get_model
 from path_utils import update_config_dirs
+from probing import encode_probing_features, fit_linear_probe, linear_probing_epoch_on_features
 from seed import seed_everything
-from simclr import NTXentLoss, SingleInstanceTwoView
-from save_utils import save_numpy
+from simclr import NTXentLoss, SingleInstanceTwoView, per_view_batchnorm
+from save_utils import EmbeddingStore, save_numpy_to_store
 from scheduler import LinearWarmupCosineAnnealingLR
 
 
@@ -300,9 +301,8 @@ def train(config: AttributeHashmap) -> None:
 
                 y_pred = model(x)
                 loss = loss_fn_classification(y_pred, y_true)
-                state_dict['train_loss'] += loss.item() * B
-                correct += torch.sum(
-                    torch.argmax(y_pred, dim=-1) == y_true).item()
+                state_dict['train_loss'] += loss.detach() * B
+                correct += torch.sum(torch.argmax(y_pred, dim=-1) == y_true)
                 total_count_loss += B
                 total_count_acc += B
 
@@ -324,11 +324,13 @@ def train(config: AttributeHashmap) -> None:
                     device), y_true.to(device)
 
                 # Train encoder.
-                z1 = model.project(x_aug1)
-                z2 = model.project(x_aug2)
+                # One forward pass on both views.
+                with per_view_batchnorm(model, num_views=2):
+                    z1, z2 = model.project(torch.cat((x_aug1, x_aug2),
+                                                     dim=0)).chunk(2, dim=0)
 
                 loss, pseudo_acc = loss_fn_simclr(z1, z2)
-                state_dict['train_loss'] += loss.item() * B
+                state_dict['train_loss'] += loss.detach() * B
                 state_dict['train_simclr_pseudoAcc'] += pseudo_acc * B
                 total_count_loss += B
 
@@ -336,11 +338,14 @@ def train(config: AttributeHashmap) -> None:
                 loss.backward()
                 opt.step()
 
+        # Read the on-device running sums once per epoch.
         if config.contrastive == 'simclr':
-            state_dict['train_simclr_pseudoAcc'] /= total_count_loss
+            state_dict['train_simclr_pseudoAcc'] = float(
+                state_dict['train_simclr_pseudoAcc']) / total_count_loss
         else:
-            state_dict['train_acc'] = correct / total_count_acc * 100
-        state_dict['train_loss'] /= total_count_loss
+            state_dict['train_acc'] = float(correct) / total_count_acc * 100
+        state_dict['train_loss'] = float(
+            state_dict['train_loss']) / total_count_loss
 
         lr_scheduler.step()
 
@@ -455,26 +460,60 @@ def linear_probing(config: AttributeHashmap,
 
     # Separately train linear classifier.
     model.init_linear()
-    # Note: Need to create another optimizer because the model will keep updating
-    # even after freezing with `requires_grad = False` when `opt` has `momentum`.
-    opt_probing = torch.optim.AdamW(list(model.linear.parameters()),
-                                    lr=float(config.learning_rate_probing),
-                                    weight_decay=float(config.weight_decay))
-
-    lr_scheduler_probing = LinearWarmupCosineAnnealingLR(
-        optimizer=opt_probing,
-        warmup_epochs=min(10, config.probing_epoch // 5),
-        max_epochs=config.probing_epoch)
-
-    for _ in range(config.probing_epoch):
-        probing_acc = linear_probing_epoch(
-            config=config,
+
+    # The L-BFGS / ridge solvers require the cached features.
+    if config.probing_cached_features or config.probing_solver != 'adamw':
+        # Encode the training set once, instead of once per probing epoch.
+        features, labels = encode_probing_features(
             train_loader=train_loader,
             model=model,
             device=device,
-            opt_probing=opt_probing,
-            loss_fn_classification=loss_fn_classification)
-        lr_scheduler_probing.step()
+            in_channels=config.in_channels,
+            num_views=config.probing_num_views)
+
+    if config.probing_solver in ['lbfgs', 'ridge']:
+        # Full-batch fit of the linear classifier, in place of the epochs of AdamW.
+        probing_acc = fit_linear_probe(linear=model.linear,
+                                       features=features,
+                                       labels=labels,
+                                       device=device,
+                                       solver=config.probing_solver,
+                                       l2_reg=config.probing_l2_reg,
+                                       max_iter=config.probing_max_iter)
+    elif config.probing_solver == 'adamw':
+        # Note: Need to create another optimizer because the model will keep updating
+        # even after freezing with `requires_grad = False` when `opt` has `momentum`.
+        opt_probing = torch.optim.AdamW(list(model.linear.parameters()),
+                                        lr=float(config.learning_rate_probing),
+                                        weight_decay=float(config.weight_decay))
+
+        lr_scheduler_probing = LinearWarmupCosineAnnealingLR(
+            optimizer=opt_probing,
+            warmup_epochs=min(10, config.probing_epoch // 5),
+            max_epochs=config.probing_epoch)
+
+        for _ in range(config.probing_epoch):
+            if config.probing_cached_features:
+                probing_acc = linear_probing_epoch_on_features(
+                    linear=model.linear,
+                    features=features,
+                    labels=labels,
+                    device=device,
+                    opt_probing=opt_probing,
+                    loss_fn_classification=loss_fn_classification,
+                    batch_size=config.probing_batch_size)
+            else:
+                probing_acc = linear_probing_epoch(
+                    config=config,
+                    train_loader=train_loader,
+                    model=model,
+                    device=device,
+                    opt_probing=opt_probing,
+                    loss_fn_classification=loss_fn_classification)
+            lr_scheduler_probing.step()
+    else:
+        raise ValueError('`linear_probing`: probing_solver (%s) not supported.' %
+                         config.probing_solver)
 
     _, val_acc = validate_epoch(config=config,
                                 val_loader=val_loader,
@@ -503,23 +542,21 @@ def linear_probing_epoch(config: AttributeHashmap,
         x_aug1, x_aug2, y_true = x_aug1.to(device), x_aug2.to(
             device), y_true.to(device)
 
-        with torch.no_grad():
-            h1, h2 = model.encode(x_aug1), model.encode(x_aug2)
-        y_pred_aug1, y_pred_aug2 = model.linear(h1), model.linear(h2)
-        loss_aug1 = loss_fn_classification(y_pred_aug1, y_true)
-        loss_aug2 = loss_fn_classification(y_pred_aug2, y_true)
-        loss = (loss_aug1 + loss_aug2) / 2
-        correct += torch.sum(
-            torch.argmax(y_pred_aug1, dim=-1) == y_true).item()
-        correct += torch.sum(
-            torch.argmax(y_pred_aug2, dim=-1) == y_true).item()
+        # One forward pass on both views.
+        with torch.no_grad(), per_view_batchnorm(model, num_views=2):
+            h = model.encode(torch.cat((x_aug1, x_aug2), dim=0))
+        y_pred = model.linear(h)
+        y_true = y_true.repeat(2)
+        # Same as the average of the losses of the two views.
+        loss = loss_fn_classification(y_pred, y_true)
+        correct += torch.sum(torch.argmax(y_pred, dim=-1) == y_true)
         total_count_acc += 2 * B
 
         opt_probing.zero_grad()
         loss.backward()
         opt_probing.step()
 
-    probing_acc = correct / total_count_acc * 100
+    probing_acc = float(correct) / total_count_acc * 100
 
     return probing_acc
 
@@ -555,6 +592,11 @@ def infer(config: AttributeHashmap) -> None:
         total_by_class = {}
         correct_by_class = {}
 
+        # Save the images, labels, and embeddings for future reference.
+        store = EmbeddingStore('%s/embeddings/%s/' %
+                               (config.output_save_path, checkpoint_name),
+                               capacity=len(val_loader.dataset))
+
         with torch.no_grad():
             for batch_idx, (x, y_true) in enumerate(val_loader):
                 assert config.in_channels in [1, 3]
@@ -563,8 +605,7 @@ def infer(config: AttributeHashmap) -> None:
                     x = x.repeat(1, 3, 1, 1)
                 x, y_true = x.to(device), y_true.to(device)
 
-                h = model.encode(x)
-                y_pred = model(x)
+                y_pred, h = model.forward_with_features(x)
                 y_correct = (torch.argmax(
                     y_pred, dim=-1) == y_true).cpu().detach().numpy()
 
@@ -581,12 +622,11 @@ def infer(config: AttributeHashmap) -> None:
                     if is_correct:
                         correct_by_class[class_true] += 1
 
-                save_numpy(config=config,
-                           batch_idx=batch_idx,
-                           numpy_filename=checkpoint_name,
-                           image_batch=x,
-                           label_true_batch=y_true,
-                           embedding_batch=h)
+                save_numpy_to_store(store=store,
+                                    image_batch=x,
+                                    label_true_batch=y_true,
+                                    embedding_batch=h)
+            store.close()
 
             log('\nCheckpoint: %s' % checkpoint_name,
                 filepath=log_path,
@@ -605,6 +645,37 @@ if __name__ == '__main__':
                         help='Path to config yaml file.',
                         required=True)
     parser.add_argument('--mode', help='Train or infer?', required=True)
+    parser.add_argument(
+        '--probing-cached-features',
+        action='store_true',
+        help='If turned on, linear probing encodes the training set once '
+        'and trains the linear classifier on the cached features.')
+    parser.add_argument(
+        '--probing-num-views',
+        help='Number of augmented views per image cached for `--probing-cached-features`.',
+        type=int,
+        default=2)
+    parser.add_argument(
+        '--probing-batch-size',
+        help='Batch size of the linear classifier for `--probing-cached-features`.',
+        type=int,
+        default=4096)
+    parser.add_argument(
+        '--probing-solver',
+        help='How to fit the linear classifier in linear probing: [adamw, lbfgs, ridge]. '
+        '`lbfgs` and `ridge` fit it on the cached features in one go.',
+        type=str,
+        default='adamw')
+    parser.add_argument(
+        '--probing-l2-reg',
+        help='L2 regularization of `--probing-solver lbfgs/ridge`.',
+        type=float,
+        default=1e-4)
+    parser.add_argument(
+        '--probing-max-iter',
+        help='Maximum number of iterations of `--probing-solver lbfgs`.',
+        type=int,
+        default=100)
     parser.add_argument('--gpu-id',
                         help='Available GPU index.',
                         type=int,
@@ -620,6 +691,12 @@ if __name__ == '__main__':
     config = AttributeHashmap(yaml.safe_load(open(args.config)))
     config.config_file_name = args.config
     config.gpu_id = args.gpu_id
+    config.probing_cached_features = args.probing_cached_features
+    config.probing_num_views = args.probing_num_views
+    config.probing_batch_size = args.probing_batch_size
+    config.probing_solver = args.probing_solver
+    config.probing_l2_reg = args.probing_l2_reg
+    config.probing_max_iter = args.probing_max_iter
     if args.random_seed is not None:
         config.random_seed = args.random_seed
     config = update_config_dirs(AttributeHashmap(config))
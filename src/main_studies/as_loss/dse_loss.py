@@ -41,11 +41,21 @@ class DSE_Loss(torch.nn.Module):
         self.embedding_vectors = None
 
     def forward(self, x) -> torch.Tensor:
-        assert len(x.shape) == 2, \
-        'DSE_Loss currently only supports tensors with 2 dimensions.'
+        '''
+        x:
+            [N, D] tensor, or [num_sets, N, D] tensor (e.g., the two views in SimCLR)
+            to compute the DSE of each set with one batched eigendecomposition.
+        Returns:
+            DSE: a scalar for [N, D] inputs, a [num_sets] tensor for [num_sets, N, D] inputs.
+        '''
+        assert len(x.shape) in [2, 3], \
+        'DSE_Loss currently only supports tensors with 2 or 3 dimensions.'
 
-        if x.shape[0] < self.min_samples:
-            x = x.repeat(int(self.min_samples // x.shape[0] + 1), 1)
+        N = x.shape[-2]
+        if N < self.min_samples:
+            repeats = [1] * len(x.shape)
+            repeats[-2] = int(self.min_samples // N + 1)
+            x = x.repeat(*repeats)
 
         # Diffusion matrix
         K = diffusion_matrix_with_gradient(x)
@@ -57,10 +67,10 @@ class DSE_Loss(torch.nn.Module):
         # Power eigenvalues to `t` to mitigate effect of noise.
         eigenvalues = eigenvalues**self.t
 
-        prob = eigenvalues / eigenvalues.sum()
+        prob = eigenvalues / eigenvalues.sum(dim=-1, keepdim=True)
         prob = prob + self.eps
 
-        DSE = -torch.sum(prob * torch.log2(prob))
+        DSE = -torch.sum(prob * torch.log2(prob), dim=-1)
 
         return DSE
 
@@ -75,11 +85,11 @@ def diffusion_matrix_with_gradient(X: torch.Tensor,
     Returns a diffusion matrix P.
     Using the "anisotropic" kernel
     Inputs:
-        X: a numpy array of size n x d
+        X: a tensor of size n x d, or b x n x d for a batch of b sets.
         sigma: a float
             conceptually, the neighborhood size of Gaussian kernel.
     Returns:
-        K: a numpy array of size n x n that has the same eigenvalues as the diffusion matrix.
+        K: a tensor of size n x n (or b x n x n) that has the same eigenvalues as the diffusion matrix.
     '''
 
     # Construct the distance matrix.
@@ -90,8 +100,9 @@ def diffusion_matrix_with_gradient(X: torch.Tensor,
         (-D**2) / (2 * sigma**2))
 
     # Anisotropic density normalization.
-    Deg = torch.diag(1 / torch.sum(G, axis=1)**0.5)
-    K = Deg @ G @ Deg
+    # Same as `Deg @ G @ Deg` with `Deg` diagonal, without the matrix products.
+    Deg = 1 / torch.sum(G, axis=-1)**0.5
+    K = Deg[..., :, None] * G * Deg[..., None, :]
 
     # Now K has the exact same eigenvalues as the diffusion matrix `P`
     # which is defined as `P = D^{-1} K`, with `D = np.diag(np.sum(K, axis=1))`.
@@ -16,16 +16,18 @@ from dsmi_loss import DSMI_Loss
 
 import_dir = '/'.join(os.path.realpath(__file__).split('/')[:-4])
 sys.path.insert(0, import_dir + '/api/')
-from dse import diffusion_spectral_entropy
-from dsmi import diffusion_spectral_mutual_information
+from dsmi import diffusion_spectral_mutual_information, diffusion_and_classic_mutual_information
 
 sys.path.insert(0, import_dir + '/src/nn/')
 sys.path.insert(0, import_dir + '/src/utils/')
+from activation_reducer import ActivationReducer
 from attribute_hashmap import AttributeHashmap
+from collector import EmbeddingCollector
 from log_utils import log
 from path_utils import update_config_dirs
+from probing import encode_probing_features, fit_linear_probe, linear_probing_epoch_on_features
 from seed import seed_everything
-from simclr import NTXentLoss, SingleInstanceTwoView
+from simclr import NTXentLoss, SingleInstanceTwoView, per_view_batchnorm
 from scheduler import LinearWarmupCosineAnnealingLR
 from timm_models import build_timm_model
 from extend import ExtendedDataset
@@ -566,9 +568,8 @@ def train(config: AttributeHashmap) -> None:
                     loss = loss + float(config.aux_weight) * loss_fn_DSMI(
                         z, y_true)
 
-                state_dict['train_loss'] += loss.item() * B
-                correct += torch.sum(
-                    torch.argmax(y_pred, dim=-1) == y_true).item()
+                state_dict['train_loss'] += loss.detach() * B
+                correct += torch.sum(torch.argmax(y_pred, dim=-1) == y_true)
                 total_count_loss += B
                 total_count_acc += B
 
@@ -589,17 +590,19 @@ def train(config: AttributeHashmap) -> None:
                 x_aug1, x_aug2, y_true = x_aug1.to(device), x_aug2.to(
                     device), y_true.to(device)
 
-                # Train encoder.
-                z1 = model.project(x_aug1)
-                z2 = model.project(x_aug2)
+                # Train encoder. One forward pass on both views.
+                with per_view_batchnorm(model, num_views=2):
+                    z1, z2 = model.project(torch.cat((x_aug1, x_aug2),
+                                                     dim=0)).chunk(2, dim=0)
 
                 loss, pseudo_acc = loss_fn_simclr(z1, z2)
 
                 assert config.aux_loss == 'dse'
-                loss = loss + float(
-                    config.aux_weight) * (loss_fn_DSE(z1) + loss_fn_DSE(z2))
+                # DSE of each view, with one batched eigendecomposition.
+                loss = loss + float(config.aux_weight) * torch.sum(
+                    loss_fn_DSE(torch.stack((z1, z2), dim=0)))
 
-                state_dict['train_loss'] += loss.item() * B
+                state_dict['train_loss'] += loss.detach() * B
                 state_dict['train_simclr_pseudoAcc'] += pseudo_acc * B
                 total_count_loss += B
 
@@ -607,11 +610,14 @@ def train(config: AttributeHashmap) -> None:
                 loss.backward()
                 opt.step()
 
+        # Read the on-device running sums once per epoch.
         if config.method == 'simclr':
-            state_dict['train_simclr_pseudoAcc'] /= total_count_loss
+            state_dict['train_simclr_pseudoAcc'] = float(
+                state_dict['train_simclr_pseudoAcc']) / total_count_loss
         else:
-            state_dict['train_acc'] = correct / total_count_acc * 100
-        state_dict['train_loss'] /= total_count_loss
+            state_dict['train_acc'] = float(correct) / total_count_acc * 100
+        state_dict['train_loss'] = float(
+            state_dict['train_loss']) / total_count_loss
 
         #
         '''
@@ -748,6 +754,16 @@ timm_model_blocks_map = {
     'xcit': ['blocks', 12],
 }
 
+# Layout of the block activations, for `ActivationReducer`.
+timm_model_layout_map = {
+    'resnet': 'NCHW',
+    'resnext': 'NCHW',
+    'convnext': 'NCHW',
+    'vit': 'NLC',
+    'swin': 'NHWC',
+    'xcit': 'NLC',
+}
+
 
 def validate_epoch(config: AttributeHashmap,
                    val_loader: torch.utils.data.DataLoader,
@@ -758,18 +774,24 @@ def validate_epoch(config: AttributeHashmap,
     correct, total_count_loss, total_count_acc = 0, 0, 0
     val_loss, val_acc = 0, 0
 
-    tensor_X = None  # input
-    tensor_Y = None  # label
-    tensor_Z = None  # latent
+    # Collects input (X), label (Y), latent (Z) and block activations.
+    collector = EmbeddingCollector(capacity=len(val_loader.dataset))
 
     if config.block_by_block:
         '''Get block by block activations'''
         activation = {}
 
         def getActivation(name):
+            # Reduce the activations on device, before moving them to CPU.
+            reducer = ActivationReducer(
+                method=config.block_reducer,
+                layout=timm_model_layout_map[config.model],
+                grid_size=config.block_reducer_grid,
+                projection_dim=config.block_reducer_dim,
+                random_seed=config.random_seed)
 
             def hook(model, input, output):
-                activation[name] = output.detach()
+                activation[name] = reducer(output.detach())
 
             return hook
 
@@ -796,8 +818,6 @@ def validate_epoch(config: AttributeHashmap,
                         getActivation('blocks_' + str(i))))
 
     model.eval()
-    if config.block_by_block:
-        blocks_features = [[] for _ in block_index_list]
     with torch.no_grad():
         for x, y_true in tqdm(val_loader):
             B = x.shape[0]
@@ -807,7 +827,8 @@ def validate_epoch(config: AttributeHashmap,
                 x = x.repeat(1, 3, 1, 1)
             x, y_true = x.to(device), y_true.to(device)
 
-            y_pred = model(x)
+            # Logits and latent (Z) from one pass of the encoder.
+            y_pred, z = model.forward_with_features(x)
             loss = loss_fn_classification(y_pred, y_true)
             val_loss += loss.item() * B
             correct += torch.sum(torch.argmax(y_pred, dim=-1) == y_true).item()
@@ -821,47 +842,36 @@ def validate_epoch(config: AttributeHashmap,
             curr_X = torch.nn.functional.interpolate(
                 x, size=(64, 64)).cpu().numpy().reshape(x.shape[0], -1)
             curr_Y = y_true.cpu().numpy()
-            curr_Z = model.encode(x).cpu().numpy()
-            if tensor_X is None:
-                tensor_X, tensor_Y, tensor_Z = curr_X, curr_Y, curr_Z
-            else:
-                tensor_X = np.vstack((tensor_X, curr_X))
-                tensor_Y = np.hstack((tensor_Y, curr_Y))
-                tensor_Z = np.vstack((tensor_Z, curr_Z))
+            curr_Z = z.cpu().numpy()
 
+            curr_blocks = {}
             if config.block_by_block:
                 # Collect block activations from key layers
                 for i in block_index_list:
                     curr_block_features = activation['blocks_' +
                                                      str(i)].cpu().numpy()
-                    curr_block_features = curr_block_features.reshape(
-                        curr_block_features.shape[0], -1)
-                    blocks_features[i].append(curr_block_features)  # (B, D)
+                    curr_blocks['blocks_' + str(i)] = \
+                        curr_block_features.reshape(
+                        curr_block_features.shape[0], -1)  # (B, D)
+
+            collector.add(X=curr_X, Y=curr_Y, Z=curr_Z, **curr_blocks)
 
+    tensor_X, tensor_Y, tensor_Z = collector['X'], collector['Y'], collector['Z']
     if config.block_by_block:
+        blocks_features = [
+            collector['blocks_' + str(i)] for i in block_index_list
+        ]
         for i in block_index_list:
-            blocks_features[i] = np.vstack(blocks_features[i])
             handlers_list[i].remove()
 
-    dse_Z = diffusion_spectral_entropy(embedding_vectors=tensor_Z)
-    cse_Z = diffusion_spectral_entropy(embedding_vectors=tensor_Z,
-                                       classic_shannon_entropy=True)
-    dsmi_Z_X, precomputed_clusters_X = diffusion_spectral_mutual_information(
-        embedding_vectors=tensor_Z,
-        reference_vectors=tensor_X,
-        precomputed_clusters=precomputed_clusters_X)
-    csmi_Z_X, precomputed_clusters_X = diffusion_spectral_mutual_information(
+    dsmi_Z_X, csmi_Z_X, dse_Z, cse_Z, precomputed_clusters_X = diffusion_and_classic_mutual_information(
         embedding_vectors=tensor_Z,
         reference_vectors=tensor_X,
         precomputed_clusters=precomputed_clusters_X,
-        classic_shannon_entropy=True)
+        compute_entropy=True)
 
-    dsmi_Z_Y, _ = diffusion_spectral_mutual_information(
+    dsmi_Z_Y, csmi_Z_Y, _, _, _ = diffusion_and_classic_mutual_information(
         embedding_vectors=tensor_Z, reference_vectors=tensor_Y)
-    csmi_Z_Y, _ = diffusion_spectral_mutual_information(
-        embedding_vectors=tensor_Z,
-        reference_vectors=tensor_Y,
-        classic_shannon_entropy=True)
 
     dsmi_blockZ_Xs, dsmi_blockZ_Ys = [], []
     if config.block_by_block:
@@ -896,26 +906,60 @@ def linear_probing(config: AttributeHashmap,
 
     # Separately train linear classifier.
     model.init_linear()
-    # Note: Need to create another optimizer because the model will keep updating
-    # even after freezing with `requires_grad = False` when `opt` has `momentum`.
-    opt_probing = torch.optim.AdamW(list(model.linear.parameters()),
-                                    lr=float(config.learning_rate_probing))
-
-    lr_scheduler_probing = LinearWarmupCosineAnnealingLR(
-        optimizer=opt_probing,
-        warmup_epochs=min(10, config.probing_epoch // 5),
-        max_epochs=config.probing_epoch)
 
-    for _ in tqdm(range(config.probing_epoch)):
-        # Because of linear warmup, first step has zero LR. Hence step once before training.
-        lr_scheduler_probing.step()
-        probing_acc = linear_probing_epoch(
-            config=config,
+    # The L-BFGS / ridge solvers require the cached features.
+    if config.probing_cached_features or config.probing_solver != 'adamw':
+        # Encode the training set once, instead of once per probing epoch.
+        features, labels = encode_probing_features(
             train_loader=train_loader,
             model=model,
             device=device,
-            opt_probing=opt_probing,
-            loss_fn_classification=loss_fn_classification)
+            in_channels=config.in_channels,
+            num_views=config.probing_num_views)
+
+    if config.probing_solver in ['lbfgs', 'ridge']:
+        # Full-batch fit of the linear classifier, in place of the epochs of AdamW.
+        probing_acc = fit_linear_probe(linear=model.linear,
+                                       features=features,
+                                       labels=labels,
+                                       device=device,
+                                       solver=config.probing_solver,
+                                       l2_reg=config.probing_l2_reg,
+                                       max_iter=config.probing_max_iter)
+    elif config.probing_solver == 'adamw':
+        # Note: Need to create another optimizer because the model will keep updating
+        # even after freezing with `requires_grad = False` when `opt` has `momentum`.
+        opt_probing = torch.optim.AdamW(list(model.linear.parameters()),
+                                        lr=float(config.learning_rate_probing))
+
+        lr_scheduler_probing = LinearWarmupCosineAnnealingLR(
+            optimizer=opt_probing,
+            warmup_epochs=min(10, config.probing_epoch // 5),
+            max_epochs=config.probing_epoch)
+
+        for _ in tqdm(range(config.probing_epoch)):
+            # Because of linear warmup, first step has zero LR. Hence step once before training.
+            lr_scheduler_probing.step()
+            if config.probing_cached_features:
+                probing_acc = linear_probing_epoch_on_features(
+                    linear=model.linear,
+                    features=features,
+                    labels=labels,
+                    device=device,
+                    opt_probing=opt_probing,
+                    loss_fn_classification=loss_fn_classification,
+                    batch_size=config.probing_batch_size)
+            else:
+                probing_acc = linear_probing_epoch(
+                    config=config,
+                    train_loader=train_loader,
+                    model=model,
+                    device=device,
+                    opt_probing=opt_probing,
+                    loss_fn_classification=loss_fn_classification)
+    else:
+        raise ValueError('`linear_probing`: probing_solver (%s) not supported.' %
+                         config.probing_solver)
 
     _, val_acc, dse_Z, cse_Z, dsmi_Z_X, csmi_Z_X, dsmi_Z_Y, csmi_Z_Y, dsmi_blockZ_Xs, dsmi_blockZ_Ys, _ = validate_epoch(
         config=config,
@@ -946,23 +990,21 @@ def linear_probing_epoch(config: AttributeHashmap,
         x_aug1, x_aug2, y_true = x_aug1.to(device), x_aug2.to(
             device), y_true.to(device)
 
-        with torch.no_grad():
-            h1, h2 = model.encode(x_aug1), model.encode(x_aug2)
-        y_pred_aug1, y_pred_aug2 = model.linear(h1), model.linear(h2)
-        loss_aug1 = loss_fn_classification(y_pred_aug1, y_true)
-        loss_aug2 = loss_fn_classification(y_pred_aug2, y_true)
-        loss = (loss_aug1 + loss_aug2) / 2
-        correct += torch.sum(
-            torch.argmax(y_pred_aug1, dim=-1) == y_true).item()
-        correct += torch.sum(
-            torch.argmax(y_pred_aug2, dim=-1) == y_true).item()
+        # One forward pass on both views.
+        with torch.no_grad(), per_view_batchnorm(model, num_views=2):
+            h = model.encode(torch.cat((x_aug1, x_aug2), dim=0))
+        y_pred = model.linear(h)
+        y_true = y_true.repeat(2)
+        # Same as the average of the losses of the two views.
+        loss = loss_fn_classification(y_pred, y_true)
+        correct += torch.sum(torch.argmax(y_pred, dim=-1) == y_true)
         total_count_acc += 2 * B
 
         opt_probing.zero_grad()
         loss.backward()
         opt_probing.step()
 
-    probing_acc = correct / total_count_acc * 100
+    probing_acc = float(correct) / total_count_acc * 100
 
     return probing_acc
 
@@ -981,6 +1023,53 @@ if __name__ == '__main__':
         '--block-by-block',
         action='store_true',
         help='If turned on, we compute the block-by-block DSE/DSMI.')
+    parser.add_argument(
+        '--block-reducer',
+        help='How to reduce the block activations for `--block-by-block`: '
+        '[flatten, gap, grid, random_projection]',
+        type=str,
+        default='flatten')
+    parser.add_argument(
+        '--block-reducer-grid',
+        help='Grid size of `--block-reducer grid`.',
+        type=int,
+        default=2)
+    parser.add_argument(
+        '--block-reducer-dim',
+        help='Output dimension of `--block-reducer random_projection`.',
+        type=int,
+        default=1024)
+    parser.add_argument(
+        '--probing-cached-features',
+        action='store_true',
+        help='If turned on, linear probing encodes the training set once '
+        'and trains the linear classifier on the cached features.')
+    parser.add_argument(
+        '--probing-num-views',
+        help='Number of augmented views per image cached for `--probing-cached-features`.',
+        type=int,
+        default=2)
+    parser.add_argument(
+        '--probing-batch-size',
+        help='Batch size of the linear classifier for `--probing-cached-features`.',
+        type=int,
+        default=4096)
+    parser.add_argument(
+        '--probing-solver',
+        help='How to fit the linear classifier in linear probing: [adamw, lbfgs, ridge]. '
+        '`lbfgs` and `ridge` fit it on the cached features in one go.',
+        type=str,
+        default='adamw')
+    parser.add_argument(
+        '--probing-l2-reg',
+        help='L2 regularization of `--probing-solver lbfgs/ridge`.',
+        type=float,
+        default=1e-4)
+    parser.add_argument(
+        '--probing-max-iter',
+        help='Maximum number of iterations of `--probing-solver lbfgs`.',
+        type=int,
+        default=100)
     parser.add_argument('--gpu-id',
                         help='Available GPU index.',
                         type=int,
@@ -996,8 +1085,17 @@ if __name__ == '__main__':
     config = AttributeHashmap(yaml.safe_load(open(args.config)))
     config.config_file_name = args.config
     config.gpu_id = args.gpu_id
+    config.probing_cached_features = args.probing_cached_features
+    config.probing_num_views = args.probing_num_views
+    config.probing_batch_size = args.probing_batch_size
+    config.probing_solver = args.probing_solver
+    config.probing_l2_reg = args.probing_l2_reg
+    config.probing_max_iter = args.probing_max_iter
     config.model = args.model
     config.block_by_block = args.block_by_block
+    config.block_reducer = args.block_reducer
+    config.block_reducer_grid = args.block_reducer_grid
+    config.block_reducer_dim = args.block_reducer_dim
     if args.random_seed is not None:
         config.random_seed = args.random_seed
     config = update_config_dirs(AttributeHashmap(config))
@@ -1,7 +1,11 @@
 import argparse
+import multiprocessing
 import os
+import shutil
 import sys
-from typing import Tuple, Dict, Iterable
+import tempfile
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Tuple, Dict, Iterable, List
 from matplotlib import pyplot as plt
 from scipy.stats import pearsonr, spearmanr
 
@@ -15,18 +19,23 @@ from tqdm import tqdm
 import_dir = '/'.join(os.path.realpath(__file__).split('/')[:-4])
 sys.path.insert(0, import_dir + '/api/')
 from dse import diffusion_spectral_entropy
-from dsmi import diffusion_spectral_mutual_information
+from dsmi import diffusion_and_classic_mutual_information, diffusion_spectral_mutual_information_multi
+from streaming import IncrementalDiffusionSpectralEntropy, WindowedDiffusionSpectralEntropy
 
 sys.path.insert(0, import_dir + '/src/nn/')
 sys.path.insert(0, import_dir + '/src/utils/')
+from activation_reducer import ActivationReducer
 from attribute_hashmap import AttributeHashmap
+from collector import EmbeddingCollector, ReservoirCollector
 from log_utils import log
 from path_utils import update_config_dirs
+from probing import encode_probing_features, fit_linear_probe, linear_probing_epoch_on_features
 from seed import seed_everything
-from simclr import NTXentLoss, SingleInstanceTwoView
+from simclr import BatchedTwoViewAugmentation, NTXentLoss, SingleInstanceTwoView, per_view_batchnorm
 from scheduler import LinearWarmupCosineAnnealingLR
 from timm_models import build_timm_model
 from extend import ExtendedDataset
+from image_cache import ResizedImageCache
 
 
 def print_state_dict(state_dict: dict) -> str:
@@ -72,6 +81,30 @@ class CorruptLabelDataLoader(torch.utils.data.DataLoader):
         return self.dataloader.__getattribute__(name)
 
 
+class BatchedAugmentationDataLoader(object):
+    '''
+    Apply a batched augmentation (e.g., `BatchedTwoViewAugmentation`) to each batch
+    of uint8 images, on `device`, in the main process.
+    Yields the same ((x_aug1, x_aug2), y_true) batches as with `SingleInstanceTwoView`.
+    '''
+
+    def __init__(self, dataloader, augmentation, device: torch.device):
+        self.dataloader = dataloader
+        self.augmentation = augmentation
+        self.device = device
+
+    def __iter__(self):
+        for x, y_true in self.dataloader:
+            yield self.augmentation(x.to(self.device,
+                                         non_blocking=True)), y_true
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __getattr__(self, name):
+        return self.dataloader.__getattribute__(name)
+
+
 def get_dataloaders(
     config: AttributeHashmap
 ) -> Tuple[Tuple[
@@ -120,13 +153,26 @@ def get_dataloaders(
     # NOTE: To accommodate the ViT models, we resize all images to 224x224.
     imsize = 224
 
+    # With `config.dataset_cache_dir`, the images are resized once into a uint8 cache
+    # (see `ResizedImageCache`), and the transforms below only operate on tensors.
+    use_cache = config.dataset_cache_dir is not None and config.dataset in [
+        'mnist', 'cifar10', 'stl10', 'tinyimagenet'
+    ]
+    if use_cache:
+        resize = []
+        to_tensor = torchvision.transforms.ConvertImageDtype(torch.float32)
+    else:
+        resize = [
+            torchvision.transforms.Resize(
+                imsize,
+                interpolation=torchvision.transforms.InterpolationMode.BICUBIC)
+        ]
+        to_tensor = torchvision.transforms.ToTensor()
+
     if config.method == 'supervised':
         if config.in_channels == 3:
             transform_train = torchvision.transforms.Compose([
-                torchvision.transforms.Resize(
-                    imsize,
-                    interpolation=torchvision.transforms.InterpolationMode.
-                    BICUBIC),
+                *resize,
                 torchvision.transforms.RandomResizedCrop(
                     imsize,
                     scale=(0.6, 1.6),
@@ -139,48 +185,48 @@ def get_dataloaders(
                 ],
                                                    p=0.4),
                 torchvision.transforms.RandomGrayscale(p=0.2),
-                torchvision.transforms.ToTensor(),
+                to_tensor,
                 torchvision.transforms.Normalize(mean=dataset_mean,
                                                  std=dataset_std)
             ])
         else:
             transform_train = torchvision.transforms.Compose([
-                torchvision.transforms.Resize(
-                    imsize,
-                    interpolation=torchvision.transforms.InterpolationMode.
-                    BICUBIC),
+                *resize,
                 torchvision.transforms.RandomResizedCrop(
                     imsize,
                     scale=(0.6, 1.6),
                     interpolation=torchvision.transforms.InterpolationMode.
                     BICUBIC),
                 torchvision.transforms.RandomHorizontalFlip(p=0.5),
-                torchvision.transforms.ToTensor(),
+                to_tensor,
                 torchvision.transforms.Normalize(mean=dataset_mean,
                                                  std=dataset_std)
             ])
 
     elif config.method == 'simclr':
-        transform_train = SingleInstanceTwoView(imsize=imsize,
-                                                mean=dataset_mean,
-                                                std=dataset_std)
+        if config.batched_augmentation:
+            assert use_cache, \
+                '`get_dataloaders`: `--batched-augmentation` requires `--dataset-cache-dir`.'
+            # The two views are created batch by batch by `BatchedAugmentationDataLoader`.
+            transform_train = None
+        else:
+            transform_train = SingleInstanceTwoView(imsize=imsize,
+                                                    mean=dataset_mean,
+                                                    std=dataset_std,
+                                                    pre_resized=use_cache)
 
     elif config.method == 'wronglabel':
         transform_train = torchvision.transforms.Compose([
-            torchvision.transforms.Resize(imsize,
-                                          interpolation=torchvision.transforms.
-                                          InterpolationMode.BICUBIC),
-            torchvision.transforms.ToTensor(),
+            *resize,
+            to_tensor,
             torchvision.transforms.Normalize(mean=dataset_mean,
                                              std=dataset_std)
         ])
 
     transform_val = torchvision.transforms.Compose([
-        torchvision.transforms.Resize(
-            imsize,
-            interpolation=torchvision.transforms.InterpolationMode.BICUBIC),
+        *resize,
         torchvision.transforms.CenterCrop(imsize),
-        torchvision.transforms.ToTensor(),
+        to_tensor,
         torchvision.transforms.Normalize(mean=dataset_mean, std=dataset_std)
     ])
 
@@ -204,13 +250,6 @@ def get_dataloaders(
                                           download=True,
                                           transform=transform_val)
 
-        if config.dataset == 'stl10' and config.method != 'wronglabel':
-            # Training set has too few images (5000 images in total).
-            # Let's augment it into a bigger dataset.
-            train_dataset = ExtendedDataset(train_dataset,
-                                            desired_len=10 *
-                                            len(train_dataset))
-
     elif config.dataset in ['tinyimagenet', 'imagenet']:
         train_dataset = torchvision_dataset(config.dataset_dir,
                                             split='train',
@@ -219,6 +258,30 @@ def get_dataloaders(
                                           split='val',
                                           transform=transform_val)
 
+    if use_cache:
+        # Replace the datasets with their cached counterparts, with the same transforms.
+        # The original datasets are only iterated once, to build the caches.
+        train_dataset = ResizedImageCache(dataset=train_dataset,
+                                          cache_dir=config.dataset_cache_dir,
+                                          dataset_name=config.dataset,
+                                          split='train',
+                                          imsize=imsize,
+                                          transform=train_dataset.transform,
+                                          num_workers=config.num_workers)
+        val_dataset = ResizedImageCache(dataset=val_dataset,
+                                        cache_dir=config.dataset_cache_dir,
+                                        dataset_name=config.dataset,
+                                        split='val',
+                                        imsize=imsize,
+                                        transform=val_dataset.transform,
+                                        num_workers=config.num_workers)
+
+    if config.dataset == 'stl10' and config.method != 'wronglabel':
+        # Training set has too few images (5000 images in total).
+        # Let's augment it into a bigger dataset.
+        train_dataset = ExtendedDataset(train_dataset,
+                                        desired_len=10 * len(train_dataset))
+
     train_loader = torch.utils.data.DataLoader(train_dataset,
                                                batch_size=config.batch_size,
                                                num_workers=config.num_workers,
@@ -229,6 +292,14 @@ def get_dataloaders(
                                              num_workers=config.num_workers,
                                              shuffle=False,
                                              pin_memory=True)
+    if config.method == 'simclr' and config.batched_augmentation:
+        train_loader = BatchedAugmentationDataLoader(
+            train_loader,
+            augmentation=BatchedTwoViewAugmentation(imsize=imsize,
+                                                    mean=dataset_mean,
+                                                    std=dataset_std),
+            device=torch.device('cuda:%d' % config.gpu_id
+                                if torch.cuda.is_available() else 'cpu'))
     if config.method == 'wronglabel':
         train_loader = CorruptLabelDataLoader(train_loader,
                                               random_seed=config.random_seed)
@@ -240,26 +311,33 @@ def get_dataloaders(
             config.dataset_dir,
             split='val',
             transform=torchvision.transforms.Compose([
-                torchvision.transforms.Resize(
-                    imsize,
-                    interpolation=torchvision.transforms.InterpolationMode.
-                    BICUBIC),
+                *resize,
                 torchvision.transforms.RandomResizedCrop(
                     imsize,
                     scale=(0.6, 1.6),
                     interpolation=torchvision.transforms.InterpolationMode.
                     BICUBIC),
-                torchvision.transforms.ToTensor(),
+                to_tensor,
                 torchvision.transforms.Normalize(mean=dataset_mean,
                                                  std=dataset_std)
             ]))
+        if use_cache:
+            # Reuses the cache built above.
+            val_dataset = ResizedImageCache(dataset=val_dataset,
+                                            cache_dir=config.dataset_cache_dir,
+                                            dataset_name=config.dataset,
+                                            split='val',
+                                            imsize=imsize,
+                                            transform=val_dataset.transform)
         val_dataset = ExtendedDataset(val_dataset,
                                       desired_len=10 * len(val_dataset))
+        # Not shuffled, such that the `ReservoirCollector` in `validate_epoch` keeps
+        # the same rows every epoch, which `precomputed_clusters_X` relies on.
         val_loader = torch.utils.data.DataLoader(
             val_dataset,
             batch_size=config.batch_size,
             num_workers=config.num_workers,
-            shuffle=True,
+            shuffle=False,
             pin_memory=True)
 
     return (train_loader, val_loader), config
@@ -492,14 +570,16 @@ def train(config: AttributeHashmap) -> None:
         val_metric = 'val_acc'
 
     # Compute the results before training.
-    val_loss, val_acc, dse_Z, cse_Z, dsmi_Z_X, csmi_Z_X, dsmi_Z_Y, csmi_Z_Y, \
-        dsmi_blockZ_Xs, dsmi_blockZ_Ys, precomputed_clusters_X = validate_epoch(
+    # Always in the foreground, as the clusters of the input (X) are recycled afterwards.
+    val_loss, val_acc, metrics = validate_epoch(
         config=config,
         val_loader=val_loader,
         model=model,
         device=device,
         loss_fn_classification=loss_fn_classification,
         precomputed_clusters_X=None)
+    dse_Z, cse_Z, dsmi_Z_X, csmi_Z_X, dsmi_Z_Y, csmi_Z_Y, \
+        dsmi_blockZ_Xs, dsmi_blockZ_Ys, precomputed_clusters_X = metrics
 
     state_dict = {
         'train_loss': 'Not started',
@@ -548,6 +628,24 @@ def train(config: AttributeHashmap) -> None:
     for val_metric_pct in val_metric_pct_list:
         is_model_saved[str(val_metric_pct)] = False
 
+    # Optionally monitor the DSE of the most recent training embeddings.
+    dse_monitor = None
+    if config.dse_window is not None:
+        dse_monitor = WindowedDiffusionSpectralEntropy(
+            window_size=config.dse_window,
+            update_every=config.dse_window_every)
+    global_step = 0
+
+    # Optionally compute the DSE/DSMI metrics in background processes,
+    # while the training continues with the next epoch.
+    metrics_executor = None
+    if config.async_metrics:
+        # `spawn` rather than `fork`, as the main process holds a CUDA context.
+        metrics_executor = ProcessPoolExecutor(
+            max_workers=config.async_metrics_workers,
+            mp_context=multiprocessing.get_context('spawn'))
+    pending_metrics = []
+
     for epoch_idx in tqdm(range(1, config.max_epoch)):
         # For SimCLR, only perform validation / linear probing every 5 epochs.
         skip_epoch_simlr = epoch_idx % 5 != 0
@@ -582,11 +680,10 @@ def train(config: AttributeHashmap) -> None:
                     x = x.repeat(1, 3, 1, 1)
                 x, y_true = x.to(device), y_true.to(device)
 
-                y_pred = model(x)
+                y_pred, z = model.forward_with_features(x)
                 loss = loss_fn_classification(y_pred, y_true)
-                state_dict['train_loss'] += loss.item() * B
-                correct += torch.sum(
-                    torch.argmax(y_pred, dim=-1) == y_true).item()
+                state_dict['train_loss'] += loss.detach() * B
+                correct += torch.sum(torch.argmax(y_pred, dim=-1) == y_true)
                 total_count_loss += B
                 total_count_acc += B
 
@@ -607,12 +704,14 @@ def train(config: AttributeHashmap) -> None:
                 x_aug1, x_aug2, y_true = x_aug1.to(device), x_aug2.to(
                     device), y_true.to(device)
 
-                # Train encoder.
-                z1 = model.project(x_aug1)
-                z2 = model.project(x_aug2)
+                # Train encoder. One forward pass on both views.
+                with per_view_batchnorm(model, num_views=2):
+                    z_both = model.encode(torch.cat((x_aug1, x_aug2), dim=0))
+                    z1, z2 = model.projection_head(z_both).chunk(2, dim=0)
+                z = z_both[:B]
 
                 loss, pseudo_acc = loss_fn_simclr(z1, z2)
-                state_dict['train_loss'] += loss.item() * B
+                state_dict['train_loss'] += loss.detach() * B
                 state_dict['train_simclr_pseudoAcc'] += pseudo_acc * B
                 total_count_loss += B
 
@@ -620,11 +719,24 @@ def train(config: AttributeHashmap) -> None:
                 loss.backward()
                 opt.step()
 
+            global_step += 1
+            if dse_monitor is not None:
+                dse_window = dse_monitor.update(z.detach().cpu().numpy(),
+                                                step=global_step)
+                if dse_window is not None:
+                    log('Step: %d. DSE (last %d training embeddings): %.3f' %
+                        (global_step, config.dse_window, dse_window),
+                        filepath=log_path,
+                        to_console=False)
+
+        # Read the on-device running sums once per epoch.
         if config.method == 'simclr':
-            state_dict['train_simclr_pseudoAcc'] /= total_count_loss
+            state_dict['train_simclr_pseudoAcc'] = float(
+                state_dict['train_simclr_pseudoAcc']) / total_count_loss
         else:
-            state_dict['train_acc'] = correct / total_count_acc * 100
-        state_dict['train_loss'] /= total_count_loss
+            state_dict['train_acc'] = float(correct) / total_count_acc * 100
+        state_dict['train_loss'] = float(
+            state_dict['train_loss']) / total_count_loss
 
         #
         '''
@@ -633,15 +745,15 @@ def train(config: AttributeHashmap) -> None:
         if config.method == 'simclr':
             if not skip_epoch_simlr:
                 # This function call includes validation.
-                probing_acc, val_acc_final, dse_Z, cse_Z, dsmi_Z_X, csmi_Z_X, dsmi_Z_Y, csmi_Z_Y, \
-                    dsmi_blockZ_Xs, dsmi_blockZ_Ys, _ = linear_probing(
+                probing_acc, val_acc_final, metrics = linear_probing(
                     config=config,
                     train_loader=train_loader,
                     val_loader=val_loader,
                     model=model,
                     device=device,
                     loss_fn_classification=loss_fn_classification,
-                    precomputed_clusters_X=precomputed_clusters_X)
+                    precomputed_clusters_X=precomputed_clusters_X,
+                    metrics_executor=metrics_executor)
                 state_dict['train_acc'] = probing_acc
                 state_dict['val_loss'] = np.nan
                 state_dict['val_acc'] = val_acc_final
@@ -650,14 +762,14 @@ def train(config: AttributeHashmap) -> None:
                 state_dict['val_loss'] = 'Val skipped for efficiency'
                 state_dict['val_acc'] = 'Val skipped for efficiency'
         else:
-            val_loss, val_acc, dse_Z, cse_Z, dsmi_Z_X, csmi_Z_X, dsmi_Z_Y, csmi_Z_Y, \
-                dsmi_blockZ_Xs, dsmi_blockZ_Ys, _ = validate_epoch(
+            val_loss, val_acc, metrics = validate_epoch(
                 config=config,
                 val_loader=val_loader,
                 model=model,
                 device=device,
                 loss_fn_classification=loss_fn_classification,
-                precomputed_clusters_X=precomputed_clusters_X)
+                precomputed_clusters_X=precomputed_clusters_X,
+                metrics_executor=metrics_executor)
             state_dict['val_loss'] = val_loss
             state_dict['val_acc'] = val_acc
 
@@ -672,16 +784,10 @@ def train(config: AttributeHashmap) -> None:
             to_console=False)
 
         if not (config.method == 'simclr' and skip_epoch_simlr):
-            results_dict['epoch'].append(epoch_idx)
-            results_dict['dse_Z'].append(dse_Z)
-            results_dict['cse_Z'].append(cse_Z)
-            results_dict['dsmi_Z_X'].append(dsmi_Z_X)
-            results_dict['csmi_Z_X'].append(csmi_Z_X)
-            results_dict['dsmi_Z_Y'].append(dsmi_Z_Y)
-            results_dict['csmi_Z_Y'].append(csmi_Z_Y)
-            results_dict['val_acc'].append(state_dict['val_acc'])
-            results_dict['dsmi_blockZ_Xs'].append(np.array(dsmi_blockZ_Xs))
-            results_dict['dsmi_blockZ_Ys'].append(np.array(dsmi_blockZ_Ys))
+            pending_metrics.append(
+                (epoch_idx, state_dict['val_acc'], metrics))
+        merge_metrics(results_dict=results_dict,
+                      pending_metrics=pending_metrics)
 
         plot_figures(data_arrays=results_dict,
                      save_path_fig=save_path_fig,
@@ -716,6 +822,16 @@ def train(config: AttributeHashmap) -> None:
                             filepath=log_path,
                             to_console=False)
 
+    # Wait for the metrics computed in the background.
+    merge_metrics(results_dict=results_dict,
+                  pending_metrics=pending_metrics,
+                  wait=True)
+    if metrics_executor is not None:
+        metrics_executor.shutdown()
+        plot_figures(data_arrays=results_dict,
+                     save_path_fig=save_path_fig,
+                     block_by_block=config.block_by_block)
+
     # Save the results after training.
     save_path_numpy = '%s/%s-%s-%s-seed%s/%s' % (
         config.output_save_path, config.dataset, config.method, config.model,
@@ -749,6 +865,15 @@ def train(config: AttributeHashmap) -> None:
             dsmi_blockZ_Ys=results_dict['dsmi_blockZ_Ys'],
         )
 
+    # Save the DSE time series over training steps.
+    if dse_monitor is not None:
+        save_path_numpy = '%s/%s-%s-%s-seed%s/%s' % (
+            config.output_save_path, config.dataset, config.method,
+            config.model, config.random_seed, 'window-results.npz')
+        steps, dse_window_values = dse_monitor.time_series()
+        with open(save_path_numpy, 'wb+') as f:
+            np.savez(f, step=steps, dse_Z_window=dse_window_values)
+
     return
 
 
@@ -761,28 +886,69 @@ timm_model_blocks_map = {
     'xcit': ['blocks', 12],
 }
 
+# Layout of the block activations, for `ActivationReducer`.
+timm_model_layout_map = {
+    'resnet': 'NCHW',
+    'resnext': 'NCHW',
+    'convnext': 'NCHW',
+    'vit': 'NLC',
+    'swin': 'NHWC',
+    'xcit': 'NLC',
+}
+
 
 def validate_epoch(config: AttributeHashmap,
                    val_loader: torch.utils.data.DataLoader,
-                   model: torch.nn.Module, device: torch.device,
+                   model: torch.nn.Module,
+                   device: torch.device,
                    loss_fn_classification: torch.nn.Module,
-                   precomputed_clusters_X: np.array):
+                   precomputed_clusters_X: np.array,
+                   metrics_executor: ProcessPoolExecutor = None):
+    '''
+    Validation loss and accuracy, and the DSE/CSE/DSMI/CSMI metrics (see `compute_metrics`).
+
+    If `metrics_executor` is provided, the metrics are computed in the background:
+    the collected tensors are saved to memory-mapped files, and `metrics` is a `Future`.
+    '''
 
     correct, total_count_loss, total_count_acc = 0, 0, 0
     val_loss, val_acc = 0, 0
 
-    tensor_X = None  # input
-    tensor_Y = None  # label
-    tensor_Z = None  # latent
+    # Collects input (X), label (Y), latent (Z) and block activations.
+    if config.dataset == 'tinyimagenet':
+        # For DSE and DSMI, subsample for faster computation.
+        # Only a class-stratified sample of the (extended) validation set is kept in memory.
+        collector = ReservoirCollector(max_N=10000,
+                                       stratify_by='Y',
+                                       num_classes=config.num_classes,
+                                       random_seed=config.random_seed)
+    else:
+        collector = EmbeddingCollector(capacity=len(val_loader.dataset))
+
+    # DSE of the latent (Z), with the kernel computed batch by batch during inference.
+    # Only when the validation set fits in `max_N` of `diffusion_spectral_entropy` (i.e., no subsampling),
+    # and when the metrics are not computed in the background.
+    dse_accumulator = None
+    if metrics_executor is None and config.dataset != 'tinyimagenet' \
+            and len(val_loader.dataset) <= 10000:
+        dse_accumulator = IncrementalDiffusionSpectralEntropy(
+            capacity=len(val_loader.dataset))
 
     if config.block_by_block:
         '''Get block by block activations'''
         activation = {}
 
         def getActivation(name):
+            # Reduce the activations on device, before moving them to CPU.
+            reducer = ActivationReducer(
+                method=config.block_reducer,
+                layout=timm_model_layout_map[config.model],
+                grid_size=config.block_reducer_grid,
+                projection_dim=config.block_reducer_dim,
+                random_seed=config.random_seed)
 
             def hook(model, input, output):
-                activation[name] = output.detach()
+                activation[name] = reducer(output.detach())
 
             return hook
 
@@ -809,8 +975,6 @@ def validate_epoch(config: AttributeHashmap,
                         getActivation('blocks_' + str(i))))
 
     model.eval()
-    if config.block_by_block:
-        blocks_features = [[] for _ in block_index_list]
     with torch.no_grad():
         for x, y_true in tqdm(val_loader):
             B = x.shape[0]
@@ -820,7 +984,8 @@ def validate_epoch(config: AttributeHashmap,
                 x = x.repeat(1, 3, 1, 1)
             x, y_true = x.to(device), y_true.to(device)
 
-            y_pred = model(x)
+            # Logits and latent (Z) from one pass of the encoder.
+            y_pred, z = model.forward_with_features(x)
             loss = loss_fn_classification(y_pred, y_true)
             val_loss += loss.item() * B
             correct += torch.sum(torch.argmax(y_pred, dim=-1) == y_true).item()
@@ -834,122 +999,244 @@ def validate_epoch(config: AttributeHashmap,
             curr_X = torch.nn.functional.interpolate(
                 x, size=(64, 64)).cpu().numpy().reshape(x.shape[0], -1)
             curr_Y = y_true.cpu().numpy()
-            curr_Z = model.encode(x).cpu().numpy()
-            if tensor_X is None:
-                tensor_X, tensor_Y, tensor_Z = curr_X, curr_Y, curr_Z
-            else:
-                tensor_X = np.vstack((tensor_X, curr_X))
-                tensor_Y = np.hstack((tensor_Y, curr_Y))
-                tensor_Z = np.vstack((tensor_Z, curr_Z))
+            curr_Z = z.cpu().numpy()
 
+            curr_blocks = {}
             if config.block_by_block:
                 # Collect block activations from key layers
                 for i in block_index_list:
                     curr_block_features = activation['blocks_' +
                                                      str(i)].cpu().numpy()
-                    curr_block_features = curr_block_features.reshape(
-                        curr_block_features.shape[0], -1)
-                    blocks_features[i].append(curr_block_features)  # (B, D)
+                    curr_blocks['blocks_' + str(i)] = \
+                        curr_block_features.reshape(
+                        curr_block_features.shape[0], -1)  # (B, D)
+
+            collector.add(X=curr_X, Y=curr_Y, Z=curr_Z, **curr_blocks)
+            if dse_accumulator is not None:
+                dse_accumulator.partial_fit(curr_Z)
 
+    blocks_features = []
     if config.block_by_block:
+        blocks_features = [
+            collector['blocks_' + str(i)] for i in block_index_list
+        ]
         for i in block_index_list:
-            blocks_features[i] = np.vstack(blocks_features[i])
             handlers_list[i].remove()
 
-    if config.dataset == 'tinyimagenet':
-        # For DSE, subsample for faster computation.
-        dse_Z = diffusion_spectral_entropy(
-            embedding_vectors=tensor_Z[:10000, :])
-        cse_Z = diffusion_spectral_entropy(
-            embedding_vectors=tensor_Z[:10000, :],
-            classic_shannon_entropy=True)
+    if config.method == 'simclr':
+        val_loss = torch.nan
     else:
+        val_loss /= total_count_loss
+    val_acc = correct / total_count_acc * 100
+
+    if metrics_executor is not None:
+        # Hand the tensors over to a background process through memory-mapped files.
+        memmap_dir = tempfile.mkdtemp(prefix='dse-metrics-')
+        for name in collector.keys():
+            np.save('%s/%s.npy' % (memmap_dir, name), collector[name])
+        metrics = metrics_executor.submit(
+            compute_metrics_from_memmap,
+            memmap_dir=memmap_dir,
+            num_blocks=len(blocks_features),
+            num_classes=config.num_classes,
+            cluster_method=config.cluster_method,
+            precomputed_clusters_X=precomputed_clusters_X)
+    else:
+        metrics = compute_metrics(
+            tensor_X=collector['X'],
+            tensor_Y=collector['Y'],
+            tensor_Z=collector['Z'],
+            blocks_features=blocks_features,
+            num_classes=config.num_classes,
+            cluster_method=config.cluster_method,
+            precomputed_clusters_X=precomputed_clusters_X,
+            dse_Z=None
+            if dse_accumulator is None else dse_accumulator.finalize())
+
+    return val_loss, val_acc, metrics
+
+
+def compute_metrics(tensor_X: np.array,
+                    tensor_Y: np.array,
+                    tensor_Z: np.array,
+                    blocks_features: List[np.array],
+                    num_classes: int,
+                    cluster_method: str,
+                    precomputed_clusters_X: np.array,
+                    dse_Z: float = None) -> Tuple:
+    '''
+    DSE and CSE of the latent (Z), DSMI and CSMI between the latent and the input (X) / label (Y),
+    and the block-by-block DSMI if `blocks_features` is not empty.
+
+    returns:
+        (dse_Z, cse_Z, dsmi_Z_X, csmi_Z_X, dsmi_Z_Y, csmi_Z_Y,
+         dsmi_blockZ_Xs, dsmi_blockZ_Ys, precomputed_clusters_X)
+    '''
+    if dse_Z is None:
         dse_Z = diffusion_spectral_entropy(embedding_vectors=tensor_Z)
-        cse_Z = diffusion_spectral_entropy(embedding_vectors=tensor_Z,
-                                           classic_shannon_entropy=True)
+    cse_Z = diffusion_spectral_entropy(embedding_vectors=tensor_Z,
+                                       classic_shannon_entropy=True)
 
-    dsmi_Z_X, precomputed_clusters_X = diffusion_spectral_mutual_information(
+    dsmi_Z_X, csmi_Z_X, _, _, precomputed_clusters_X = diffusion_and_classic_mutual_information(
         embedding_vectors=tensor_Z,
         reference_vectors=tensor_X,
-        n_clusters=config.num_classes,
+        n_clusters=num_classes,
+        cluster_method=cluster_method,
         precomputed_clusters=precomputed_clusters_X)
-    csmi_Z_X, precomputed_clusters_X = diffusion_spectral_mutual_information(
-        embedding_vectors=tensor_Z,
-        reference_vectors=tensor_X,
-        n_clusters=config.num_classes,
-        precomputed_clusters=precomputed_clusters_X,
-        classic_shannon_entropy=True)
 
-    dsmi_Z_Y, _ = diffusion_spectral_mutual_information(
+    dsmi_Z_Y, csmi_Z_Y, _, _, _ = diffusion_and_classic_mutual_information(
         embedding_vectors=tensor_Z, reference_vectors=tensor_Y)
-    csmi_Z_Y, _ = diffusion_spectral_mutual_information(
-        embedding_vectors=tensor_Z,
-        reference_vectors=tensor_Y,
-        classic_shannon_entropy=True)
 
     dsmi_blockZ_Xs, dsmi_blockZ_Ys = [], []
-    if config.block_by_block:
-        for i in block_index_list:
-            tensor_blockZ = blocks_features[i]
-            dsmi_blockZ_X, _ = diffusion_spectral_mutual_information(
-                embedding_vectors=tensor_blockZ,
-                reference_vectors=tensor_X,
-                precomputed_clusters=precomputed_clusters_X,
-            )
-            dsmi_blockZ_Xs.append(dsmi_blockZ_X)
-            dsmi_blockZ_Y, _ = diffusion_spectral_mutual_information(
-                embedding_vectors=tensor_blockZ, reference_vectors=tensor_Y)
-            dsmi_blockZ_Ys.append(dsmi_blockZ_Y)
+    if len(blocks_features) > 0:
+        # Evaluate all blocks at once, sharing the clusters and index sets.
+        dsmi_blockZ_Xs, _ = diffusion_spectral_mutual_information_multi(
+            embeddings_list=blocks_features,
+            reference_vectors=tensor_X,
+            precomputed_clusters=precomputed_clusters_X,
+        )
+        dsmi_blockZ_Ys, _ = diffusion_spectral_mutual_information_multi(
+            embeddings_list=blocks_features, reference_vectors=tensor_Y)
+
+    return (dse_Z, cse_Z, dsmi_Z_X, csmi_Z_X, dsmi_Z_Y, csmi_Z_Y,
+            dsmi_blockZ_Xs, dsmi_blockZ_Ys, precomputed_clusters_X)
 
-    if config.method == 'simclr':
-        val_loss = torch.nan
-    else:
-        val_loss /= total_count_loss
-    val_acc = correct / total_count_acc * 100
 
-    return (val_loss, val_acc, dse_Z, cse_Z, dsmi_Z_X, csmi_Z_X, dsmi_Z_Y,
-            csmi_Z_Y, dsmi_blockZ_Xs, dsmi_blockZ_Ys, precomputed_clusters_X)
+def compute_metrics_from_memmap(memmap_dir: str, num_blocks: int,
+                                num_classes: int, cluster_method: str,
+                                precomputed_clusters_X: np.array) -> Tuple:
+    '''
+    `compute_metrics` on the tensors saved by `validate_epoch` in `memmap_dir`.
+    Runs in a background process. `memmap_dir` is removed afterwards.
+    '''
+
+    def load(name: str) -> np.array:
+        return np.load('%s/%s.npy' % (memmap_dir, name), mmap_mode='r')
+
+    try:
+        metrics = compute_metrics(
+            tensor_X=load('X'),
+            tensor_Y=load('Y'),
+            tensor_Z=load('Z'),
+            blocks_features=[
+                load('blocks_' + str(i)) for i in range(num_blocks)
+            ],
+            num_classes=num_classes,
+            cluster_method=cluster_method,
+            precomputed_clusters_X=precomputed_clusters_X)
+    finally:
+        shutil.rmtree(memmap_dir, ignore_errors=True)
+    return metrics
+
+
+def merge_metrics(results_dict: Dict[str, list],
+                  pending_metrics: list,
+                  wait: bool = False) -> None:
+    '''
+    Append the metrics of the validated epochs to `results_dict`, in epoch order.
+
+    `pending_metrics` is a list of (epoch_idx, val_acc, metrics), where `metrics` is
+    the output of `compute_metrics` or a `Future` of it. A `Future` that is not done
+    holds back the later epochs, unless `wait` is True.
+    '''
+    while len(pending_metrics) > 0:
+        epoch_idx, val_acc, metrics = pending_metrics[0]
+        if isinstance(metrics, Future):
+            if not (wait or metrics.done()):
+                break
+            metrics = metrics.result()
+        pending_metrics.pop(0)
+
+        dse_Z, cse_Z, dsmi_Z_X, csmi_Z_X, dsmi_Z_Y, csmi_Z_Y, \
+            dsmi_blockZ_Xs, dsmi_blockZ_Ys, _ = metrics
+        results_dict['epoch'].append(epoch_idx)
+        results_dict['dse_Z'].append(dse_Z)
+        results_dict['cse_Z'].append(cse_Z)
+        results_dict['dsmi_Z_X'].append(dsmi_Z_X)
+        results_dict['csmi_Z_X'].append(csmi_Z_X)
+        results_dict['dsmi_Z_Y'].append(dsmi_Z_Y)
+        results_dict['csmi_Z_Y'].append(csmi_Z_Y)
+        results_dict['val_acc'].append(val_acc)
+        results_dict['dsmi_blockZ_Xs'].append(np.array(dsmi_blockZ_Xs))
+        results_dict['dsmi_blockZ_Ys'].append(np.array(dsmi_blockZ_Ys))
 
 
 def linear_probing(config: AttributeHashmap,
                    train_loader: torch.utils.data.DataLoader,
                    val_loader: torch.utils.data.DataLoader,
-                   model: torch.nn.Module, device: torch.device,
+                   model: torch.nn.Module,
+                   device: torch.device,
                    loss_fn_classification: torch.nn.Module,
-                   precomputed_clusters_X: np.array):
+                   precomputed_clusters_X: np.array,
+                   metrics_executor: ProcessPoolExecutor = None):
 
     # Separately train linear classifier.
     model.init_linear()
-    # Note: Need to create another optimizer because the model will keep updating
-    # even after freezing with `requires_grad = False` when `opt` has `momentum`.
-    opt_probing = torch.optim.AdamW(list(model.linear.parameters()),
-                                    lr=float(config.learning_rate_probing))
-
-    lr_scheduler_probing = LinearWarmupCosineAnnealingLR(
-        optimizer=opt_probing,
-        warmup_epochs=min(10, config.probing_epoch // 5),
-        max_epochs=config.probing_epoch)
 
-    for _ in tqdm(range(config.probing_epoch)):
-        # Because of linear warmup, first step has zero LR. Hence step once before training.
-        lr_scheduler_probing.step()
-        probing_acc = linear_probing_epoch(
-            config=config,
+    # The L-BFGS / ridge solvers require the cached features.
+    if config.probing_cached_features or config.probing_solver != 'adamw':
+        # Encode the training set once, instead of once per probing epoch.
+        features, labels = encode_probing_features(
             train_loader=train_loader,
             model=model,
             device=device,
-            opt_probing=opt_probing,
-            loss_fn_classification=loss_fn_classification)
+            in_channels=config.in_channels,
+            num_views=config.probing_num_views)
+
+    if config.probing_solver in ['lbfgs', 'ridge']:
+        # Full-batch fit of the linear classifier, in place of the epochs of AdamW.
+        probing_acc = fit_linear_probe(linear=model.linear,
+                                       features=features,
+                                       labels=labels,
+                                       device=device,
+                                       solver=config.probing_solver,
+                                       l2_reg=config.probing_l2_reg,
+                                       max_iter=config.probing_max_iter)
+    elif config.probing_solver == 'adamw':
+        # Note: Need to create another optimizer because the model will keep updating
+        # even after freezing with `requires_grad = False` when `opt` has `momentum`.
+        opt_probing = torch.optim.AdamW(list(model.linear.parameters()),
+                                        lr=float(config.learning_rate_probing))
+
+        lr_scheduler_probing = LinearWarmupCosineAnnealingLR(
+            optimizer=opt_probing,
+            warmup_epochs=min(10, config.probing_epoch // 5),
+            max_epochs=config.probing_epoch)
+
+        for _ in tqdm(range(config.probing_epoch)):
+            # Because of linear warmup, first step has zero LR. Hence step once before training.
+            lr_scheduler_probing.step()
+            if config.probing_cached_features:
+                probing_acc = linear_probing_epoch_on_features(
+                    linear=model.linear,
+                    features=features,
+                    labels=labels,
+                    device=device,
+                    opt_probing=opt_probing,
+                    loss_fn_classification=loss_fn_classification,
+                    batch_size=config.probing_batch_size)
+            else:
+                probing_acc = linear_probing_epoch(
+                    config=config,
+                    train_loader=train_loader,
+                    model=model,
+                    device=device,
+                    opt_probing=opt_probing,
+                    loss_fn_classification=loss_fn_classification)
+    else:
+        raise ValueError('`linear_probing`: probing_solver (%s) not supported.' %
+                         config.probing_solver)
 
-    _, val_acc, dse_Z, cse_Z, dsmi_Z_X, csmi_Z_X, dsmi_Z_Y, csmi_Z_Y, dsmi_blockZ_Xs, dsmi_blockZ_Ys, _ = validate_epoch(
+    _, val_acc, metrics = validate_epoch(
         config=config,
         val_loader=val_loader,
         model=model,
         device=device,
         loss_fn_classification=loss_fn_classification,
-        precomputed_clusters_X=precomputed_clusters_X)
+        precomputed_clusters_X=precomputed_clusters_X,
+        metrics_executor=metrics_executor)
 
-    return probing_acc, val_acc, dse_Z, cse_Z, dsmi_Z_X, csmi_Z_X, dsmi_Z_Y, csmi_Z_Y, dsmi_blockZ_Xs, dsmi_blockZ_Ys, precomputed_clusters_X
+    return probing_acc, val_acc, metrics
 
 
 def linear_probing_epoch(config: AttributeHashmap,
@@ -970,23 +1257,21 @@ def linear_probing_epoch(config: AttributeHashmap,
         x_aug1, x_aug2, y_true = x_aug1.to(device), x_aug2.to(
             device), y_true.to(device)
 
-        with torch.no_grad():
-            h1, h2 = model.encode(x_aug1), model.encode(x_aug2)
-        y_pred_aug1, y_pred_aug2 = model.linear(h1), model.linear(h2)
-        loss_aug1 = loss_fn_classification(y_pred_aug1, y_true)
-        loss_aug2 = loss_fn_classification(y_pred_aug2, y_true)
-        loss = (loss_aug1 + loss_aug2) / 2
-        correct += torch.sum(
-            torch.argmax(y_pred_aug1, dim=-1) == y_true).item()
-        correct += torch.sum(
-            torch.argmax(y_pred_aug2, dim=-1) == y_true).item()
+        # One forward pass on both views.
+        with torch.no_grad(), per_view_batchnorm(model, num_views=2):
+            h = model.encode(torch.cat((x_aug1, x_aug2), dim=0))
+        y_pred = model.linear(h)
+        y_true = y_true.repeat(2)
+        # Same as the average of the losses of the two views.
+        loss = loss_fn_classification(y_pred, y_true)
+        correct += torch.sum(torch.argmax(y_pred, dim=-1) == y_true)
         total_count_acc += 2 * B
 
         opt_probing.zero_grad()
         loss.backward()
         opt_probing.step()
 
-    probing_acc = correct / total_count_acc * 100
+    probing_acc = float(correct) / total_count_acc * 100
 
     return probing_acc
 
@@ -1005,6 +1290,89 @@ if __name__ == '__main__':
         '--block-by-block',
         action='store_true',
         help='If turned on, we compute the block-by-block DSE/DSMI.')
+    parser.add_argument(
+        '--block-reducer',
+        help='How to reduce the block activations for `--block-by-block`: '
+        '[flatten, gap, grid, random_projection]',
+        type=str,
+        default='flatten')
+    parser.add_argument(
+        '--block-reducer-grid',
+        help='Grid size of `--block-reducer grid`.',
+        type=int,
+        default=2)
+    parser.add_argument(
+        '--block-reducer-dim',
+        help='Output dimension of `--block-reducer random_projection`.',
+        type=int,
+        default=1024)
+    parser.add_argument(
+        '--cluster-method',
+        help='How to cluster the input images for DSMI(Z; X): '
+        '[spectral, minibatch_kmeans, pca_kmeans, sparse_spectral]',
+        type=str,
+        default='spectral')
+    parser.add_argument(
+        '--async-metrics',
+        action='store_true',
+        help='If turned on, the DSE/DSMI metrics are computed in background processes.')
+    parser.add_argument(
+        '--async-metrics-workers',
+        help='Number of background processes for `--async-metrics`.',
+        type=int,
+        default=2)
+    parser.add_argument(
+        '--dse-window',
+        help='If provided, monitor the DSE of the most recent N training embeddings.',
+        type=int,
+        default=None)
+    parser.add_argument(
+        '--dse-window-every',
+        help='Number of training steps between two DSE updates of `--dse-window`.',
+        type=int,
+        default=50)
+    parser.add_argument(
+        '--dataset-cache-dir',
+        help='If provided, the images are resized once into a uint8 cache in this folder '
+        '(only for mnist, cifar10, stl10, tinyimagenet).',
+        type=str,
+        default=None)
+    parser.add_argument(
+        '--batched-augmentation',
+        action='store_true',
+        help='If turned on, the SimCLR views are augmented batch by batch on the device. '
+        'Requires `--dataset-cache-dir`.')
+    parser.add_argument(
+        '--probing-cached-features',
+        action='store_true',
+        help='If turned on, linear probing encodes the training set once '
+        'and trains the linear classifier on the cached features.')
+    parser.add_argument(
+        '--probing-num-views',
+        help='Number of augmented views per image cached for `--probing-cached-features`.',
+        type=int,
+        default=2)
+    parser.add_argument(
+        '--probing-batch-size',
+        help='Batch size of the linear classifier for `--probing-cached-features`.',
+        type=int,
+        default=4096)
+    parser.add_argument(
+        '--probing-solver',
+        help='How to fit the linear classifier in linear probing: [adamw, lbfgs, ridge]. '
+        '`lbfgs` and `ridge` fit it on the cached features in one go.',
+        type=str,
+        default='adamw')
+    parser.add_argument(
+        '--probing-l2-reg',
+        help='L2 regularization of `--probing-solver lbfgs/ridge`.',
+        type=float,
+        default=1e-4)
+    parser.add_argument(
+        '--probing-max-iter',
+        help='Maximum number of iterations of `--probing-solver lbfgs`.',
+        type=int,
+        default=100)
     parser.add_argument('--gpu-id',
                         help='Available GPU index.',
                         type=int,
@@ -1020,8 +1388,24 @@ if __name__ == '__main__':
     config = AttributeHashmap(yaml.safe_load(open(args.config)))
     config.config_file_name = args.config
     config.gpu_id = args.gpu_id
+    config.dataset_cache_dir = args.dataset_cache_dir
+    config.batched_augmentation = args.batched_augmentation
+    config.probing_cached_features = args.probing_cached_features
+    config.probing_num_views = args.probing_num_views
+    config.probing_batch_size = args.probing_batch_size
+    config.probing_solver = args.probing_solver
+    config.probing_l2_reg = args.probing_l2_reg
+    config.probing_max_iter = args.probing_max_iter
     config.model = args.model
     config.block_by_block = args.block_by_block
+    config.block_reducer = args.block_reducer
+    config.block_reducer_grid = args.block_reducer_grid
+    config.block_reducer_dim = args.block_reducer_dim
+    config.cluster_method = args.cluster_method
+    config.async_metrics = args.async_metrics
+    config.async_metrics_workers = args.async_metrics_workers
+    config.dse_window = args.dse_window
+    config.dse_window_every = args.dse_window_every
     if args.random_seed is not None:
         config.random_seed = args.random_seed
     config = update_config_dirs(AttributeHashmap(config))
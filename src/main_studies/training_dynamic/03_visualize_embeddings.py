@@ -23,6 +23,7 @@ import_dir = '/'.join(os.path.realpath(__file__).split('/')[:-4])
 sys.path.insert(0, import_dir + '/src/nn/')
 sys.path.insert(0, import_dir + '/src/utils/')
 from attribute_hashmap import AttributeHashmap
+from collector import EmbeddingCollector
 from laplacian_extrema import get_laplacian_extrema
 from path_utils import update_config_dirs
 from timm_models import build_timm_model
@@ -117,7 +118,7 @@ if __name__ == '__main__':
         model.load_state_dict(torch.load(checkpoint_name, map_location=device))
         model.eval()
 
-        labels, embeddings = None, None
+        collector = EmbeddingCollector(capacity=len(val_loader.dataset))
         with torch.no_grad():
             for x, y_true in tqdm(val_loader):
                 B = x.shape[0]
@@ -133,12 +134,9 @@ if __name__ == '__main__':
                 curr_Y = y_true.cpu().numpy()
                 curr_Z = model.encode(x).cpu().numpy()
 
-                if labels is None:
-                    labels = curr_Y.reshape(B, 1)
-                    embeddings = curr_Z
-                else:
-                    labels = np.vstack((labels, curr_Y.reshape(B, 1)))
-                    embeddings = np.vstack((embeddings, curr_Z))
+                collector.add(labels=curr_Y.reshape(B, 1), embeddings=curr_Z)
+
+        labels, embeddings = collector['labels'], collector['embeddings']
 
         N, D = embeddings.shape
 
@@ -14,11 +14,11 @@ import timm
 
 import_dir = '/'.join(os.path.realpath(__file__).split('/')[:-4])
 sys.path.insert(0, import_dir + '/api/')
-from dse import diffusion_spectral_entropy
-from dsmi import diffusion_spectral_mutual_information
+from dsmi import diffusion_and_classic_mutual_information
 
 sys.path.insert(0, import_dir + '/src/utils/')
 from attribute_hashmap import AttributeHashmap
+from collector import EmbeddingCollector
 from seed import seed_everything
 from extend import ExtendedDataset
 
@@ -459,9 +459,8 @@ def evaluate_dse_dsmi(args: AttributeHashmap,
                       val_loader: torch.utils.data.DataLoader,
                       model: torch.nn.Module, device: torch.device):
 
-    tensor_X = None  # input
-    tensor_Y = None  # label
-    tensor_Z = None  # latent
+    # Collects input (X), label (Y) and latent (Z).
+    collector = EmbeddingCollector(capacity=len(val_loader.dataset))
 
     model.eval()
     for x, y_true in tqdm(val_loader):
@@ -478,32 +477,19 @@ def evaluate_dse_dsmi(args: AttributeHashmap,
             x, size=(64, 64)).cpu().numpy().reshape(x.shape[0], -1)
         curr_Y = y_true.cpu().numpy()
         curr_Z = model.encode(x).cpu().numpy()
-        if tensor_X is None:
-            tensor_X, tensor_Y, tensor_Z = curr_X, curr_Y, curr_Z
-        else:
-            tensor_X = np.vstack((tensor_X, curr_X))
-            tensor_Y = np.hstack((tensor_Y, curr_Y))
-            tensor_Z = np.vstack((tensor_Z, curr_Z))
+        collector.add(X=curr_X, Y=curr_Y, Z=curr_Z)
+
+    tensor_X, tensor_Y, tensor_Z = collector['X'], collector['Y'], collector['Z']
 
     # For DSE, subsample for faster computation.
-    dse_Z = diffusion_spectral_entropy(embedding_vectors=tensor_Z)
-    cse_Z = diffusion_spectral_entropy(embedding_vectors=tensor_Z,
-                                       classic_shannon_entropy=True)
-    dsmi_Z_X, _ = diffusion_spectral_mutual_information(
-        embedding_vectors=tensor_Z, reference_vectors=tensor_X,
-        n_clusters=10)  # Imagenette
-    csmi_Z_X, _ = diffusion_spectral_mutual_information(
+    dsmi_Z_X, csmi_Z_X, dse_Z, cse_Z, _ = diffusion_and_classic_mutual_information(
         embedding_vectors=tensor_Z,
         reference_vectors=tensor_X,
         n_clusters=10,  # Imagenette
-        classic_shannon_entropy=True)
+        compute_entropy=True)
 
-    dsmi_Z_Y, _ = diffusion_spectral_mutual_information(
+    dsmi_Z_Y, csmi_Z_Y, _, _, _ = diffusion_and_classic_mutual_information(
         embedding_vectors=tensor_Z, reference_vectors=tensor_Y)
-    csmi_Z_Y, _ = diffusion_spectral_mutual_information(
-        embedding_vectors=tensor_Z,
-        reference_vectors=tensor_Y,
-        classic_shannon_entropy=True)
 
     return dse_Z, cse_Z, dsmi_Z_X, csmi_Z_X, dsmi_Z_Y, csmi_Z_Y
 
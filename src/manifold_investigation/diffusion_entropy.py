@@ -7,7 +7,6 @@ import numpy as np
 import yaml
 from matplotlib import pyplot as plt
 from scipy.stats import pearsonr, spearmanr
-from tqdm import tqdm
 from typing import Dict, Iterable
 import random
 
@@ -27,6 +26,7 @@ from information import approx_eigvals, exact_eigvals, \
 from diffusion import compute_diffusion_matrix
 from log_utils import log
 from path_utils import update_config_dirs
+from save_utils import load_numpy
 from seed import seed_everything
 
 cifar10_int2name = {
@@ -314,26 +314,13 @@ if __name__ == '__main__':
                     embedding_folder.split('-valAcc')[1].split('-divergence')
                     [0]))
 
-            files = sorted(glob(embedding_folder + '/*'))
             checkpoint_name = os.path.basename(embedding_folder)
             log(checkpoint_name, log_path)
 
-            labels, embeddings, orig_input = None, None, None
-
-            for file in tqdm(files):
-                np_file = np.load(file)
-                curr_input = np_file['image']
-                curr_label = np_file['label_true']
-                curr_embedding = np_file['embedding']
-
-                if labels is None:
-                    orig_input = curr_input
-                    labels = curr_label[:, None]  # expand dim to [B, 1]
-                    embeddings = curr_embedding
-                else:
-                    orig_input = np.vstack((orig_input, curr_input))
-                    labels = np.vstack((labels, curr_label[:, None]))
-                    embeddings = np.vstack((embeddings, curr_embedding))
+            np_arrays = load_numpy(embedding_folder)
+            orig_input = np_arrays['image']
+            labels = np_arrays['label_true'][:, None]  # expand dim to [B, 1]
+            embeddings = np_arrays['embedding']
 
             # This is the matrix of N embedding vectors each at dim [1, D].
             N, D = embeddings.shape
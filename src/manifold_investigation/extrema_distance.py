@@ -8,7 +8,6 @@ import seaborn as sns
 import yaml
 from matplotlib import pyplot as plt
 from sklearn.metrics import pairwise_distances
-from tqdm import tqdm
 
 os.environ["OMP_NUM_THREADS"] = "1"  # export OMP_NUM_THREADS=1
 os.environ["OPENBLAS_NUM_THREADS"] = "1"  # export OPENBLAS_NUM_THREADS=1
@@ -20,6 +19,7 @@ import_dir = '/'.join(os.path.realpath(__file__).split('/')[:-2])
 sys.path.insert(0, import_dir + '/utils/')
 from attribute_hashmap import AttributeHashmap
 from path_utils import update_config_dirs
+from save_utils import load_numpy
 from seed import seed_everything
 from laplacian_extrema import get_laplacian_extrema
 
@@ -99,22 +99,12 @@ if __name__ == '__main__':
         checkpoint_name = os.path.basename(embedding_folder)
         checkpoint_acc = checkpoint_name.split('acc_')[1]
 
-        files = sorted(glob(embedding_folder + '/*'))
         checkpoint_name = os.path.basename(embedding_folder)
 
-        labels, embeddings = None, None
-
-        for file in tqdm(files):
-            np_file = np.load(file)
-            curr_label = np_file['label_true']
-            curr_embedding = np_file['embedding']
-
-            if labels is None:
-                labels = curr_label[:, None]  # expand dim to [B, 1]
-                embeddings = curr_embedding
-            else:
-                labels = np.vstack((labels, curr_label[:, None]))
-                embeddings = np.vstack((embeddings, curr_embedding))
+        np_arrays = load_numpy(embedding_folder,
+                               fields=['label_true', 'embedding'])
+        labels = np_arrays['label_true'][:, None]  # expand dim to [B, 1]
+        embeddings = np_arrays['embedding']
 
         # This is the matrix of N embedding vectors each at dim [1, D].
         N, D = embeddings.shape
@@ -8,7 +8,6 @@ from typing import List
 import numpy as np
 import yaml
 from matplotlib import pyplot as plt
-from tqdm import tqdm
 
 os.environ["OMP_NUM_THREADS"] = "1"  # export OMP_NUM_THREADS=1
 os.environ["OPENBLAS_NUM_THREADS"] = "1"  # export OPENBLAS_NUM_THREADS=1
@@ -21,6 +20,7 @@ sys.path.insert(0, import_dir + '/utils/')
 from attribute_hashmap import AttributeHashmap
 from log_utils import log
 from path_utils import update_config_dirs
+from save_utils import load_numpy
 from seed import seed_everything
 
 cifar10_int2name = {
@@ -201,23 +201,13 @@ if __name__ == '__main__':
                 1)
             acc_list.append(float(embedding_folder.split('-valAcc')[1]))
 
-            files = sorted(glob(embedding_folder + '/*'))
             checkpoint_name = os.path.basename(embedding_folder)
             log(checkpoint_name, log_path)
 
-            labels, embeddings = None, None
-
-            for file in tqdm(files):
-                np_file = np.load(file)
-                curr_label = np_file['label_true']
-                curr_embedding = np_file['embedding']
-
-                if labels is None:
-                    labels = curr_label[:, None]  # expand dim to [B, 1]
-                    embeddings = curr_embedding
-                else:
-                    labels = np.vstack((labels, curr_label[:, None]))
-                    embeddings = np.vstack((embeddings, curr_embedding))
+            np_arrays = load_numpy(embedding_folder,
+                                   fields=['label_true', 'embedding'])
+            labels = np_arrays['label_true'][:, None]  # expand dim to [B, 1]
+            embeddings = np_arrays['embedding']
 
             # This is the matrix of N embedding vectors each at dim [1, D].
             N, D = embeddings.shape
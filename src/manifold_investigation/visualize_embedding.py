@@ -14,13 +14,13 @@ import phate
 import scprep
 import yaml
 from matplotlib import pyplot as plt
-from tqdm import tqdm
 
 import_dir = '/'.join(os.path.realpath(__file__).split('/')[:-2])
 sys.path.insert(0, import_dir + '/utils/')
 from attribute_hashmap import AttributeHashmap
 from laplacian_extrema import get_laplacian_extrema
 from path_utils import update_config_dirs
+from save_utils import load_numpy
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -76,23 +76,13 @@ if __name__ == '__main__':
                          config.dataset)
 
     for i, embedding_folder in enumerate(embedding_folders):
-        files = sorted(glob(embedding_folder + '/*'))
         checkpoint_name = os.path.basename(embedding_folder)
         checkpoint_acc = checkpoint_name.split('acc_')[1]
 
-        labels, embeddings = None, None
-
-        for file in tqdm(files):
-            np_file = np.load(file)
-            curr_label = np_file['label_true']
-            curr_embedding = np_file['embedding']
-
-            if labels is None:
-                labels = curr_label[:, None]  # expand dim to [B, 1]
-                embeddings = curr_embedding
-            else:
-                labels = np.vstack((labels, curr_label[:, None]))
-                embeddings = np.vstack((embeddings, curr_embedding))
+        np_arrays = load_numpy(embedding_folder,
+                               fields=['label_true', 'embedding'])
+        labels = np_arrays['label_true'][:, None]  # expand dim to [B, 1]
+        embeddings = np_arrays['embedding']
 
         N, D = embeddings.shape
 
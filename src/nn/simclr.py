@@ -1,10 +1,10 @@
 import random
+from contextlib import contextmanager
 from typing import Tuple
 
 import torch
 import torchvision.transforms as transforms
 from PIL import ImageFilter
-from sklearn.metrics import accuracy_score
 
 
 class NTXentLoss(torch.nn.Module):
@@ -13,6 +13,8 @@ class NTXentLoss(torch.nn.Module):
         super(NTXentLoss, self).__init__()
         self.temperature = temperature
         self.epsilon = 1e-7
+        # Positive pair masks, cached per (batch size, device).
+        self.pos_pair_masks = {}
 
     def forward(self, z1: torch.Tensor, z2: torch.Tensor):
         assert z1.shape == z2.shape
@@ -24,39 +26,105 @@ class NTXentLoss(torch.nn.Module):
 
         # Create a matrix that represent the [i,j] entries of positive pairs.
         # Diagonal (self) are positive pairs.
-        pos_pair_ij = torch.diag(torch.ones(B))
-        pos_pair_ij = pos_pair_ij.bool()
+        pos_pair_ij = self._pos_pair_mask(B, z1.device)
 
         # Similarity matrix.
         sim_matrix = torch.matmul(z1, z2.T)
 
-        # Entries noted by 1's in `pos_pair_ij` are similarities of positive pairs.
-        numerator = torch.sum(
-            torch.exp(sim_matrix[pos_pair_ij] / self.temperature))
-
+        # Diagonal entries are similarities of positive pairs.
         # Entries elsewhere are similarities of negative pairs.
-        denominator = torch.sum(
-            torch.exp(sim_matrix[~pos_pair_ij] / self.temperature))
+        # NOTE: Sums over the diagonal and over the whole matrix, rather than indexing
+        # with the boolean mask, which would synchronize with the host.
+        exp_sim_matrix = torch.exp(sim_matrix / self.temperature)
+        numerator = torch.sum(torch.diagonal(exp_sim_matrix))
+        denominator = torch.sum(exp_sim_matrix) - numerator
 
         loss += -torch.log(numerator /
                            (denominator + self.epsilon) + self.epsilon)
 
-        pseudo_acc = accuracy_score(
-            y_true=pos_pair_ij.cpu().detach().numpy().reshape(-1),
-            y_pred=sim_matrix.cpu().detach().numpy().reshape(-1) > 0.5)
+        # Same as `accuracy_score` of the mask against `sim_matrix > 0.5`, kept on device.
+        pseudo_acc = torch.mean(
+            ((sim_matrix.detach() > 0.5) == pos_pair_ij).float())
 
         return loss / B, pseudo_acc
 
+    def _pos_pair_mask(self, B: int, device: torch.device) -> torch.Tensor:
+        key = (B, device)
+        if key not in self.pos_pair_masks:
+            self.pos_pair_masks[key] = torch.eye(B,
+                                                 dtype=torch.bool,
+                                                 device=device)
+        return self.pos_pair_masks[key]
+
+
+@contextmanager
+def per_view_batchnorm(model: torch.nn.Module, num_views: int = 2):
+    '''
+    Within this context, each BatchNorm layer of `model` splits its input
+    into `num_views` equal chunks along the batch dimension,
+    and normalizes each chunk with its own batch statistics.
+
+    Meant for a single forward pass on the concatenation of the views,
+    to keep the same BatchNorm statistics (and running statistics updates)
+    as one forward pass per view, while the other layers run on the larger batch.
+
+    Usage:
+        with per_view_batchnorm(model, num_views=2):
+            z1, z2 = model.project(torch.cat((x_aug1, x_aug2), dim=0)).chunk(2, dim=0)
+
+    Has no effect when `model` is in eval mode, where BatchNorm uses the running statistics.
+    '''
+    patched = []
+    if model.training:
+        for module in model.modules():
+            if isinstance(module, torch.nn.modules.batchnorm._BatchNorm):
+                module.forward = _per_view_forward(module.forward, num_views)
+                patched.append(module)
+    try:
+        yield
+    finally:
+        for module in patched:
+            # Restore the class method.
+            del module.forward
+
+
+def _per_view_forward(forward, num_views: int):
+
+    def split_forward(x):
+        return torch.cat(
+            [forward(chunk) for chunk in x.chunk(num_views, dim=0)], dim=0)
+
+    return split_forward
+
 
 class SingleInstanceTwoView:
     '''
     This class is adapted from BarlowTwins and SimSiam in our external_src folder.
+
+    If `pre_resized`, the inputs are uint8 tensors already resized to `imsize`
+    (e.g., from `ResizedImageCache`), hence the resize is skipped and
+    all augmentations are applied on tensors.
     '''
 
-    def __init__(self, imsize: int, mean: Tuple[float], std: Tuple[float]):
+    def __init__(self,
+                 imsize: int,
+                 mean: Tuple[float],
+                 std: Tuple[float],
+                 pre_resized: bool = False):
+        if pre_resized:
+            resize = []
+            blur = transforms.GaussianBlur(kernel_size=13, sigma=(0.1, 2.0))
+            to_tensor = transforms.ConvertImageDtype(torch.float32)
+        else:
+            resize = [
+                transforms.Resize(
+                    imsize, interpolation=transforms.InterpolationMode.BICUBIC)
+            ]
+            blur = GaussianBlur([0.1, 2.0])
+            to_tensor = transforms.ToTensor()
+
         self.augmentation = transforms.Compose([
-            transforms.Resize(
-                imsize, interpolation=transforms.InterpolationMode.BICUBIC),
+            *resize,
             transforms.RandomResizedCrop(
                 imsize,
                 scale=(0.6, 1.6),
@@ -68,8 +136,8 @@ class SingleInstanceTwoView:
             ],
                                    p=0.4),
             transforms.RandomGrayscale(p=0.2),
-            transforms.RandomApply([GaussianBlur([0.1, 2.0])], p=0.5),
-            transforms.ToTensor(),
+            transforms.RandomApply([blur], p=0.5),
+            to_tensor,
             transforms.Normalize(mean=mean, std=std)
         ])
 
@@ -88,3 +156,223 @@ class GaussianBlur(object):
         sigma = random.uniform(self.sigma[0], self.sigma[1])
         x = x.filter(ImageFilter.GaussianBlur(radius=sigma))
         return x
+
+
+class BatchedTwoViewAugmentation:
+    '''
+    Batched counterpart of `SingleInstanceTwoView(pre_resized=True)`.
+
+    Takes a batch of uint8 images of shape [B, C, imsize, imsize]
+    (e.g., from `ResizedImageCache` without transform), and returns two
+    augmented and normalized views of shape [B, C, imsize, imsize] each.
+
+    The same augmentations (random resized crop, horizontal flip, color jitter,
+    grayscale, Gaussian blur) are applied as vectorized tensor ops over the batch,
+    on the device of the batch, instead of one PIL pipeline per image and per view.
+    The random parameters are still drawn independently for each image and each view.
+    '''
+
+    def __init__(self,
+                 imsize: int,
+                 mean: Tuple[float],
+                 std: Tuple[float],
+                 scale: Tuple[float] = (0.6, 1.6),
+                 ratio: Tuple[float] = (3 / 4, 4 / 3),
+                 jitter_strength: Tuple[float] = (0.8, 0.8, 0.8, 0.2),
+                 p_flip: float = 0.5,
+                 p_jitter: float = 0.4,
+                 p_grayscale: float = 0.2,
+                 p_blur: float = 0.5,
+                 blur_sigma: Tuple[float] = (0.1, 2.0),
+                 blur_kernel_size: int = 13):
+        self.imsize = imsize
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+        self.scale = scale
+        self.ratio = ratio
+        self.jitter_strength = jitter_strength
+        self.p_flip = p_flip
+        self.p_jitter = p_jitter
+        self.p_grayscale = p_grayscale
+        self.p_blur = p_blur
+        self.blur_sigma = blur_sigma
+        self.blur_kernel_size = blur_kernel_size
+
+    def __call__(
+            self,
+            x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        assert x.dtype == torch.uint8 and x.ndim == 4, \
+            '`BatchedTwoViewAugmentation`: expecting a uint8 batch of shape [B, C, H, W].'
+        B = x.shape[0]
+
+        # Both views in one batch.
+        x = torch.cat((x, x), dim=0).float() / 255
+
+        x = self._resized_crop_flip(x)
+        apply = torch.rand(2 * B, device=x.device) < self.p_jitter
+        x[apply] = self._color_jitter(x[apply])
+        if x.shape[1] == 3:
+            apply = torch.rand(2 * B, device=x.device) < self.p_grayscale
+            x[apply] = _rgb_to_grayscale(x[apply]).expand(-1, 3, -1, -1)
+        apply = torch.rand(2 * B, device=x.device) < self.p_blur
+        x[apply] = self._gaussian_blur(x[apply])
+
+        x = (x - self.mean.to(x.device)) / self.std.to(x.device)
+        aug1, aug2 = x[:B], x[B:]
+        return aug1, aug2
+
+    def _resized_crop_flip(self, x: torch.Tensor) -> torch.Tensor:
+        '''
+        Same sampling of the crop boxes as `transforms.RandomResizedCrop`
+        (up to 10 trials per image, then the whole image), done for all images at once.
+        The crops are resized (and flipped) with a single `grid_sample`.
+        '''
+        N, _, H, W = x.shape
+        device = x.device
+        num_trials = 10
+
+        area = H * W * torch.empty(N, num_trials, device=device).uniform_(
+            *self.scale)
+        log_ratio = torch.log(torch.tensor(self.ratio))
+        aspect_ratio = torch.exp(
+            torch.empty(N, num_trials,
+                        device=device).uniform_(log_ratio[0], log_ratio[1]))
+        w = torch.round(torch.sqrt(area * aspect_ratio))
+        h = torch.round(torch.sqrt(area / aspect_ratio))
+        valid = (w > 0) & (w <= W) & (h > 0) & (h <= H)
+
+        # First valid trial of each image, or the whole image if none.
+        first_valid = torch.argmax(valid.int(), dim=1, keepdim=True)
+        has_valid = valid.any(dim=1)
+        w = torch.where(has_valid,
+                        w.gather(1, first_valid).squeeze(1),
+                        torch.full((N, ), float(W), device=device))
+        h = torch.where(has_valid,
+                        h.gather(1, first_valid).squeeze(1),
+                        torch.full((N, ), float(H), device=device))
+        top = torch.floor(torch.rand(N, device=device) * (H - h + 1))
+        left = torch.floor(torch.rand(N, device=device) * (W - w + 1))
+
+        flip = torch.where(
+            torch.rand(N, device=device) < self.p_flip, -1.0, 1.0)
+
+        # Affine map from the output grid to the crop box, in normalized coordinates [-1, 1].
+        theta = torch.zeros(N, 2, 3, device=device)
+        theta[:, 0, 0] = flip * w / W
+        theta[:, 0, 2] = (2 * left + w) / W - 1
+        theta[:, 1, 1] = h / H
+        theta[:, 1, 2] = (2 * top + h) / H - 1
+        grid = torch.nn.functional.affine_grid(
+            theta, size=(N, x.shape[1], self.imsize, self.imsize),
+            align_corners=False)
+        x = torch.nn.functional.grid_sample(x,
+                                            grid,
+                                            mode='bicubic',
+                                            padding_mode='border',
+                                            align_corners=False)
+        return x.clamp(0, 1)
+
+    def _color_jitter(self, x: torch.Tensor) -> torch.Tensor:
+        '''
+        Brightness, contrast, saturation and hue jitter with per-image factors,
+        applied in a random order per image, same as `transforms.ColorJitter`.
+        Saturation and hue are left unchanged for 1-channel images.
+        '''
+        N = x.shape[0]
+        if N == 0:
+            return x
+        device = x.device
+        brightness, contrast, saturation, hue = self.jitter_strength
+
+        def uniform(low, high):
+            return torch.empty(N, 1, 1, 1, device=device).uniform_(low, high)
+
+        factors = [
+            uniform(max(0, 1 - brightness), 1 + brightness),
+            uniform(max(0, 1 - contrast), 1 + contrast),
+            uniform(max(0, 1 - saturation), 1 + saturation),
+            uniform(-hue, hue),
+        ]
+        order = torch.argsort(torch.rand(N, 4, device=device), dim=1)
+
+        for position in range(4):
+            for fn_idx in range(4):
+                mask = order[:, position] == fn_idx
+                if x.shape[1] == 1 and fn_idx in [2, 3]:
+                    continue
+                x_sub, factor = x[mask], factors[fn_idx][mask]
+                if fn_idx == 0:
+                    x_sub = x_sub * factor
+                elif fn_idx == 1:
+                    mean = _rgb_to_grayscale(x_sub).mean(dim=(1, 2, 3),
+                                                         keepdim=True)
+                    x_sub = factor * x_sub + (1 - factor) * mean
+                elif fn_idx == 2:
+                    x_sub = factor * x_sub + (1 -
+                                              factor) * _rgb_to_grayscale(x_sub)
+                else:
+                    hsv = _rgb_to_hsv(x_sub)
+                    hsv[:, 0] = torch.remainder(hsv[:, 0] + factor[:, 0], 1.0)
+                    x_sub = _hsv_to_rgb(hsv)
+                x[mask] = x_sub.clamp(0, 1)
+        return x
+
+    def _gaussian_blur(self, x: torch.Tensor) -> torch.Tensor:
+        '''
+        Separable Gaussian blur with a per-image sigma, as one grouped convolution per axis.
+        '''
+        N, C, H, W = x.shape
+        if N == 0:
+            return x
+        sigma = torch.empty(N, 1, device=x.device).uniform_(*self.blur_sigma)
+        half = (self.blur_kernel_size - 1) / 2
+        coords = torch.linspace(-half,
+                                half,
+                                self.blur_kernel_size,
+                                device=x.device)
+        kernel = torch.exp(-coords[None, :]**2 / (2 * sigma**2))
+        kernel = kernel / kernel.sum(dim=1, keepdim=True)
+        # One kernel per (image, channel).
+        kernel = kernel.repeat_interleave(C, dim=0)
+
+        pad = self.blur_kernel_size // 2
+        x = x.reshape(1, N * C, H, W)
+        x = torch.nn.functional.pad(x, (pad, pad, pad, pad), mode='reflect')
+        x = torch.nn.functional.conv2d(x,
+                                       kernel[:, None, None, :],
+                                       groups=N * C)
+        x = torch.nn.functional.conv2d(x,
+                                       kernel[:, None, :, None],
+                                       groups=N * C)
+        return x.reshape(N, C, H, W)
+
+
+def _rgb_to_grayscale(x: torch.Tensor) -> torch.Tensor:
+    if x.shape[1] == 1:
+        return x
+    r, g, b = x.unbind(dim=1)
+    return (0.2989 * r + 0.587 * g + 0.114 * b).unsqueeze(1)
+
+
+def _rgb_to_hsv(x: torch.Tensor) -> torch.Tensor:
+    r, g, b = x.unbind(dim=1)
+    maxc = x.max(dim=1).values
+    minc = x.min(dim=1).values
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    s = cr / torch.where(maxc == minc, ones, maxc)
+    cr = torch.where(maxc == minc, ones, cr)
+    h = torch.where(
+        maxc == r, (g - b) / cr,
+        torch.where(maxc == g, 2.0 + (b - r) / cr, 4.0 + (r - g) / cr))
+    h = torch.remainder(h / 6.0, 1.0)
+    return torch.stack((h, s, maxc), dim=1)
+
+
+def _hsv_to_rgb(x: torch.Tensor) -> torch.Tensor:
+    h, s, v = x.unbind(dim=1)
+    rgb = []
+    for n in [5, 3, 1]:
+        k = torch.remainder(n + h * 6.0, 6.0)
+        rgb.append(v - v * s * torch.clamp(torch.minimum(k, 4.0 - k), 0, 1))
+    return torch.stack(rgb, dim=1)
@@ -99,6 +99,13 @@ class SimCLRModel(torch.nn.Module):
     def forward(self, x):
         return self.linear(self.encoder(x))
 
+    def forward_with_features(self, x):
+        '''
+        Returns both the logits and the embeddings, with one pass of the encoder.
+        '''
+        h = self.encoder(x)
+        return self.linear(h), h
+
     def init_linear(self):
         torch.nn.init.constant_(self.linear.weight, 0.01)
         torch.nn.init.constant_(self.linear.bias, 0)
@@ -0,0 +1,116 @@
+import numpy as np
+import torch
+
+
+class ActivationReducer(object):
+    '''
+    Reduce the activations of a block, of shape [B, ...], to vectors of shape [B, d].
+
+    Meant to be applied inside a forward hook, before moving the activations to CPU,
+    such that the captured block-by-block activations fit in a fixed memory budget.
+
+    Usage:
+        reducer = ActivationReducer(method='gap', layout='NCHW')
+
+        def hook(model, input, output):
+            activation[name] = reducer(output.detach())
+
+    args:
+        method: str
+            'flatten': no reduction, only flatten. D = C * H * W.
+            'gap': global average pooling over the spatial dims (or tokens). d = C.
+            'grid': average pooling to a `grid_size` x `grid_size` spatial grid
+                    (or `grid_size`^2 groups of tokens). d = C * grid_size^2.
+            'random_projection': seeded sparse random projection of the flattened activation.
+                    d = `projection_dim`.
+
+        layout: str
+            Layout of the activations.
+            'NCHW': conv feature maps (e.g., ResNet, ConvNeXt).
+            'NHWC': channel-last feature maps (e.g., Swin).
+            'NLC': sequences of tokens (e.g., ViT, XCiT).
+
+        grid_size: int
+            Only relevant to 'grid'.
+
+        projection_dim: int
+            Only relevant to 'random_projection'.
+
+        random_seed: int
+            Only relevant to 'random_projection'.
+    '''
+
+    def __init__(self,
+                 method: str = 'flatten',
+                 layout: str = 'NCHW',
+                 grid_size: int = 2,
+                 projection_dim: int = 1024,
+                 random_seed: int = 0):
+        if method not in ['flatten', 'gap', 'grid', 'random_projection']:
+            raise ValueError(
+                '`ActivationReducer`: method (%s) not supported.' % method)
+        if layout not in ['NCHW', 'NHWC', 'NLC']:
+            raise ValueError(
+                '`ActivationReducer`: layout (%s) not supported.' % layout)
+        self.method = method
+        self.layout = layout
+        self.grid_size = grid_size
+        self.projection_dim = projection_dim
+        self.random_seed = random_seed
+
+        # The projection matrix depends on the input dimension, hence built on the first call.
+        self.projection = None
+
+    def __call__(self, activation: torch.Tensor) -> torch.Tensor:
+        B = activation.shape[0]
+
+        if self.method == 'flatten':
+            return activation.reshape(B, -1)
+
+        if self.method == 'random_projection':
+            activation = activation.reshape(B, -1)
+            if self.projection is None:
+                self.projection = self._sparse_random_projection(
+                    input_dim=activation.shape[1], device=activation.device)
+            # [d, D] @ [D, B] -> [d, B]
+            return torch.sparse.mm(self.projection,
+                                   activation.float().T).T
+
+        # Channel-first layouts: [B, C, H, W] or [B, C, L].
+        if self.layout == 'NHWC':
+            activation = activation.permute(0, 3, 1, 2)
+        elif self.layout == 'NLC':
+            activation = activation.permute(0, 2, 1)
+
+        if self.method == 'gap':
+            return activation.reshape(B, activation.shape[1], -1).mean(dim=-1)
+
+        # self.method == 'grid'
+        if self.layout == 'NLC':
+            activation = torch.nn.functional.adaptive_avg_pool1d(
+                activation, self.grid_size**2)
+        else:
+            activation = torch.nn.functional.adaptive_avg_pool2d(
+                activation, self.grid_size)
+        return activation.reshape(B, -1)
+
+    def _sparse_random_projection(self, input_dim: int,
+                                  device: torch.device) -> torch.Tensor:
+        '''
+        Very sparse random projection (Li et al., 2006), as a sparse [d, D] matrix.
+        Each entry is +/- sqrt(s / d) with probability 1 / (2s) each, and 0 otherwise,
+        with s = sqrt(D). Each row has about D / s = sqrt(D) non-zeros.
+        '''
+        rng = np.random.default_rng(self.random_seed)
+        s = np.sqrt(input_dim)
+        nnz_per_row = int(np.ceil(input_dim / s))
+
+        rows = np.repeat(np.arange(self.projection_dim), nnz_per_row)
+        cols = rng.integers(0, input_dim, size=len(rows))
+        values = rng.choice([-1.0, 1.0], size=len(rows)) * np.sqrt(
+            s / self.projection_dim)
+
+        return torch.sparse_coo_tensor(
+            indices=torch.from_numpy(np.stack((rows, cols))),
+            values=torch.from_numpy(values).float(),
+            size=(self.projection_dim, input_dim)).coalesce().to(device)
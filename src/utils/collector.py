@@ -0,0 +1,241 @@
+from typing import Dict, Tuple
+
+import numpy as np
+
+
+class EmbeddingCollector(object):
+    '''
+    Collect aligned batches of arrays (e.g., inputs, labels, embeddings) into preallocated buffers.
+
+    Replaces the pattern of growing arrays with `np.vstack` per batch, which copies
+    all previously collected rows for every new batch.
+
+    Each field gets one buffer of shape [capacity, ...]. Batches are written in place.
+    If `capacity` is exceeded (or not provided), the buffers grow geometrically.
+
+    Usage:
+        collector = EmbeddingCollector(capacity=len(val_loader.dataset))
+        for x, y_true in val_loader:
+            ...
+            collector.add(X=curr_X, Y=curr_Y, Z=curr_Z)
+        tensor_Z = collector['Z']  # zero-copy view of the collected rows.
+
+    args:
+        capacity: int
+            Expected total number of rows, e.g., `len(loader.dataset)`.
+
+        float_dtype: np.dtype
+            If provided, floating point fields are stored in this dtype (e.g., `np.float16`)
+            to reduce memory usage. Non-floating fields (e.g., labels) keep their dtype.
+            NOTE: bfloat16 is not a NumPy dtype, hence not supported here.
+    '''
+
+    def __init__(self, capacity: int = None, float_dtype: np.dtype = None):
+        self.capacity = capacity
+        self.float_dtype = float_dtype
+        self.buffers = {}
+        self.num_rows = 0
+
+    def add(self, **batches: np.array) -> None:
+        '''
+        Append one batch per field. All batches must have the same number of rows.
+        '''
+        batch_sizes = set([len(batch) for batch in batches.values()])
+        assert len(batch_sizes) == 1, \
+            '`EmbeddingCollector.add`: all fields must have the same batch size.'
+        B = batch_sizes.pop()
+
+        if not self.buffers:
+            self._allocate(batches, capacity=max(self.capacity or 0, B))
+        assert set(batches.keys()) == set(self.buffers.keys()), \
+            '`EmbeddingCollector.add`: all batches must provide the same fields.'
+
+        if self.num_rows + B > len(self):
+            self._grow(min_capacity=self.num_rows + B)
+
+        for name, batch in batches.items():
+            self.buffers[name][self.num_rows:self.num_rows + B] = batch
+        self.num_rows += B
+
+    def __getitem__(self, name: str) -> np.array:
+        '''
+        Zero-copy view of the rows collected so far for the field `name`.
+        '''
+        return self.buffers[name][:self.num_rows]
+
+    def __len__(self) -> int:
+        '''
+        Number of rows currently allocated.
+        '''
+        if not self.buffers:
+            return 0
+        return len(next(iter(self.buffers.values())))
+
+    def keys(self):
+        return self.buffers.keys()
+
+    def _allocate(self, batches: Dict[str, np.array], capacity: int) -> None:
+        for name, batch in batches.items():
+            batch = np.asarray(batch)
+            dtype = batch.dtype
+            if self.float_dtype is not None and np.issubdtype(
+                    dtype, np.floating):
+                dtype = self.float_dtype
+            self.buffers[name] = np.empty((capacity, *batch.shape[1:]),
+                                          dtype=dtype)
+
+    def _grow(self, min_capacity: int) -> None:
+        capacity = max(min_capacity, 2 * len(self))
+        for name, buffer in self.buffers.items():
+            new_buffer = np.empty((capacity, *buffer.shape[1:]),
+                                  dtype=buffer.dtype)
+            new_buffer[:self.num_rows] = buffer[:self.num_rows]
+            self.buffers[name] = new_buffer
+
+
+class ReservoirCollector(EmbeddingCollector):
+    '''
+    Collect a fixed-size random sample of aligned batches, without holding all rows in memory.
+
+    Memory usage is capped at `max_N` rows regardless of the dataset size.
+    All fields (e.g., X, Y, Z and block activations) are sampled with the same row indices,
+    so they remain aligned.
+
+    If `stratify_by` is None, a uniform reservoir sample (Algorithm R) is kept over the stream.
+    Otherwise, each class of the field `stratify_by` gets its own reservoir of
+    `max_N // num_classes` rows.
+
+    The sampling only depends on the random seed and the order of the stream,
+    so the same rows are kept across epochs when iterating over a non-shuffled DataLoader.
+
+    Usage:
+        collector = ReservoirCollector(max_N=10000, stratify_by='Y', num_classes=200)
+        for x, y_true in val_loader:
+            ...
+            collector.add(X=curr_X, Y=curr_Y, Z=curr_Z)
+        tensor_Z = collector['Z']
+
+    args:
+        max_N: int
+            Maximum number of rows kept.
+
+        stratify_by: str
+            Name of the (discrete) field used to stratify, e.g., 'Y'.
+
+        num_classes: int
+            Number of classes of `stratify_by`. Needed if `stratify_by` is provided.
+
+        random_seed: int
+            Random seed of the sampling.
+
+        float_dtype: np.dtype
+            Same as in `EmbeddingCollector`.
+    '''
+
+    def __init__(self,
+                 max_N: int,
+                 stratify_by: str = None,
+                 num_classes: int = None,
+                 random_seed: int = 0,
+                 float_dtype: np.dtype = None):
+        super().__init__(capacity=max_N, float_dtype=float_dtype)
+        if stratify_by is not None:
+            assert num_classes is not None, \
+                '`ReservoirCollector`: `num_classes` needed for stratified sampling.'
+            assert max_N >= num_classes, \
+                '`ReservoirCollector`: `max_N` must be at least `num_classes`.'
+        self.max_N = max_N
+        self.stratify_by = stratify_by
+        self.num_classes = num_classes
+        self.rng = np.random.default_rng(random_seed)
+
+        # Number of rows seen so far, and slot offsets, per reservoir.
+        self.num_seen = {}
+        self.slot_offsets = {}
+
+    def add(self, **batches: np.array) -> None:
+        '''
+        Offer one batch per field to the reservoir. All batches must have the same number of rows.
+        '''
+        batch_sizes = set([len(batch) for batch in batches.values()])
+        assert len(batch_sizes) == 1, \
+            '`ReservoirCollector.add`: all fields must have the same batch size.'
+        B = batch_sizes.pop()
+
+        if not self.buffers:
+            self._allocate(batches, capacity=self.max_N)
+        assert set(batches.keys()) == set(self.buffers.keys()), \
+            '`ReservoirCollector.add`: all batches must provide the same fields.'
+
+        if self.stratify_by is None:
+            rows, slots = self._sample_slots(reservoir=None,
+                                             rows=np.arange(B),
+                                             reservoir_size=self.max_N)
+        else:
+            rows, slots = [], []
+            categories = np.asarray(batches[self.stratify_by]).reshape(B, -1)
+            assert categories.shape[1] == 1, \
+                '`ReservoirCollector.add`: `stratify_by` must be one label per row.'
+            categories = categories.reshape(-1)
+            for category in np.unique(categories):
+                curr_rows, curr_slots = self._sample_slots(
+                    reservoir=category.item(),
+                    rows=np.argwhere(categories == category).reshape(-1),
+                    reservoir_size=self.max_N // self.num_classes)
+                rows.append(curr_rows)
+                slots.append(curr_slots)
+            rows, slots = np.concatenate(rows), np.concatenate(slots)
+
+        for name, batch in batches.items():
+            self.buffers[name][slots] = np.asarray(batch)[rows]
+        self.num_rows = len(self._filled_slots())
+
+    def __getitem__(self, name: str) -> np.array:
+        '''
+        The sampled rows for the field `name`.
+        A zero-copy view in the uniform case, a copy in the stratified case.
+        '''
+        if self.stratify_by is None:
+            return super().__getitem__(name)
+        return self.buffers[name][self._filled_slots()]
+
+    def _sample_slots(self, reservoir, rows: np.array,
+                      reservoir_size: int) -> Tuple[np.array, np.array]:
+        '''
+        Algorithm R, vectorized over the incoming rows of one reservoir.
+        Returns the incoming rows to keep and the slots they overwrite.
+        '''
+        if reservoir not in self.num_seen:
+            assert len(self.slot_offsets) * reservoir_size < self.max_N, \
+                '`ReservoirCollector.add`: more classes than `num_classes`.'
+            self.slot_offsets[reservoir] = len(
+                self.slot_offsets) * reservoir_size
+            self.num_seen[reservoir] = 0
+
+        # Global (per reservoir) index of each incoming row in the stream.
+        stream_index = self.num_seen[reservoir] + np.arange(len(rows))
+        self.num_seen[reservoir] += len(rows)
+
+        # The first `reservoir_size` rows fill the reservoir.
+        # Afterwards, the row at `stream_index` replaces a random slot
+        # with probability `reservoir_size / (stream_index + 1)`.
+        slots = np.where(stream_index < reservoir_size, stream_index,
+                         self.rng.integers(0, stream_index + 1))
+        keep = slots < reservoir_size
+        rows, slots = rows[keep], slots[keep]
+
+        # If a slot is hit more than once within the batch, the last row wins.
+        _, last = np.unique(slots[::-1], return_index=True)
+        last = len(slots) - 1 - last
+        return rows[last], slots[last] + self.slot_offsets[reservoir]
+
+    def _filled_slots(self) -> np.array:
+        if self.stratify_by is None:
+            return np.arange(min(self.num_seen.get(None, 0), self.max_N))
+        if not self.slot_offsets:
+            return np.array([], dtype=np.int64)
+        reservoir_size = self.max_N // self.num_classes
+        return np.concatenate([
+            offset + np.arange(min(self.num_seen[reservoir], reservoir_size))
+            for reservoir, offset in self.slot_offsets.items()
+        ])
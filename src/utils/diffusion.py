@@ -81,6 +81,30 @@ def compute_diffusion_matrix(X: np.array, sigma: float = 10.0):
     return K
 
 
+def compute_gaussian_kernel(X: np.array, sigma: float = 10.0):
+    '''
+    The (unnormalized) Gaussian kernel used in `compute_diffusion_matrix`.
+    '''
+
+    # Construct the distance matrix.
+    D = pairwise_distances(X)
+
+    # Gaussian kernel
+    G = (1 / (sigma * np.sqrt(2 * np.pi))) * np.exp((-D**2) / (2 * sigma**2))
+
+    return G
+
+
+def normalize_gaussian_kernel(G: np.array):
+    '''
+    Anisotropic density normalization of a Gaussian kernel `G`.
+    Equivalent to `Deg @ G @ Deg` in `compute_diffusion_matrix`.
+    '''
+    deg_inv_sqrt = 1 / np.sum(G, axis=1)**0.5
+    K = deg_inv_sqrt[:, None] * G * deg_inv_sqrt[None, :]
+    return K
+
+
 def estimate_gaussian_kernel_sigma(X: np.array):
     # Construct the distance matrix.
     D = pairwise_distances(X)
@@ -0,0 +1,113 @@
+import os
+import shutil
+from typing import Callable, Tuple
+
+import numpy as np
+import torch
+import torchvision
+from save_utils import EmbeddingStore, load_numpy
+from torch.utils.data import Dataset
+from tqdm import tqdm
+
+
+class ResizedImageCache(Dataset):
+    '''
+    Dataset that reads images already resized to `imsize` x `imsize`
+    from a uint8 memory-mapped cache, instead of decoding and resizing them
+    with PIL for every sample of every epoch.
+
+    The cache is built once per (dataset, split, imsize), with the same
+    bicubic resize + center crop as the validation transform,
+    and is stored as an `EmbeddingStore`:
+        `cache_dir`/`dataset_name`-`split`-`imsize`/image.npy  (N, imsize, imsize, C), uint8
+        `cache_dir`/`dataset_name`-`split`-`imsize`/label.npy  (N,)
+
+    Each item is a uint8 tensor of shape [C, imsize, imsize]. `transform`,
+    if provided, is applied to that tensor. Hence it should only contain
+    the random augmentations and the tensor-compatible steps
+    (e.g., `ConvertImageDtype` and `Normalize` in place of `ToTensor` and `Normalize`).
+
+    NOTE: The images are resized along the shorter side and center-cropped,
+    hence only meant for datasets of square images (MNIST, CIFAR, STL-10, TinyImageNet).
+
+    args:
+        dataset: torch.utils.data.Dataset
+            A torchvision-style dataset that returns (PIL image, label).
+            Only used, and only iterated once, if the cache does not exist yet.
+
+        cache_dir: str
+            Parent folder of the caches.
+
+        dataset_name: str
+        split: str
+            Together with `imsize`, the key of the cache.
+
+        transform: Callable
+            Applied to the uint8 [C, imsize, imsize] tensors.
+
+        num_workers: int
+            Number of workers to decode and resize the images when building the cache.
+    '''
+
+    def __init__(self,
+                 dataset: Dataset,
+                 cache_dir: str,
+                 dataset_name: str,
+                 split: str,
+                 imsize: int = 224,
+                 transform: Callable = None,
+                 num_workers: int = 0):
+        self.cache_path = '%s/%s-%s-%d' % (cache_dir, dataset_name, split,
+                                           imsize)
+        self.transform = transform
+
+        if not os.path.exists(
+                '%s/%s' % (self.cache_path, EmbeddingStore.index_filename)):
+            self._build(dataset=dataset,
+                        imsize=imsize,
+                        num_workers=num_workers)
+
+        # The labels are small, hence loaded entirely.
+        self.labels = np.array(
+            load_numpy(self.cache_path, fields=['label'])['label'])
+        # The images are memory-mapped on first access, i.e., in each DataLoader worker.
+        # Opening them here would copy the whole array when the dataset is pickled.
+        self.images = None
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def __getitem__(self, idx) -> Tuple[torch.Tensor, int]:
+        if self.images is None:
+            self.images = load_numpy(self.cache_path, fields=['image'])['image']
+
+        # channel-last to channel-first
+        image = torch.from_numpy(np.array(self.images[idx])).permute(2, 0, 1)
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, int(self.labels[idx])
+
+    def _build(self, dataset: Dataset, imsize: int, num_workers: int) -> None:
+        dataset.transform = torchvision.transforms.Compose([
+            torchvision.transforms.Resize(
+                imsize,
+                interpolation=torchvision.transforms.InterpolationMode.BICUBIC),
+            torchvision.transforms.CenterCrop(imsize),
+            torchvision.transforms.PILToTensor(),
+        ])
+        loader = torch.utils.data.DataLoader(dataset,
+                                             batch_size=256,
+                                             num_workers=num_workers,
+                                             shuffle=False)
+
+        # Write to a temporary folder first, such that an interrupted build is not mistaken for a cache.
+        tmp_path = self.cache_path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        store = EmbeddingStore(tmp_path, capacity=len(dataset))
+        for x, y in tqdm(loader, desc='Caching %s' % self.cache_path):
+            # channel-first to channel-last
+            store.append(image=x.permute(0, 2, 3, 1).numpy(),
+                         label=y.numpy().astype(np.int64))
+        store.close()
+        os.rename(tmp_path, self.cache_path)
+        return
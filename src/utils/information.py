@@ -1,17 +1,22 @@
 from typing import Dict
 
 import numpy as np
+import scipy.linalg
 from tqdm import tqdm
 import random
-from diffusion import compute_diffusion_matrix
+from diffusion import compute_diffusion_matrix, compute_gaussian_kernel, normalize_gaussian_kernel
 from DiffusionEMD.diffusion_emd import estimate_dos
 from log_utils import log
 
 
-def simple_bin(cond_x: np.array, num_digit: int):
+def simple_bin(cond_x: np.array, num_digit: int, chunk_size: int = 4096):
     '''
         put N of D-dim vectors into discrete bins
         the final number of unique D-dim vectors is M
+
+        The bins of each vector are packed into a fixed-width byte key
+        (ceil(log2(num_digit)) bits per element), processed in chunks of `chunk_size` rows,
+        and the keys are counted with a single `np.unique`.
     Args:
         cond_x: [N, D]
 
@@ -20,37 +25,49 @@ def simple_bin(cond_x: np.array, num_digit: int):
         cnts: List of length M, each indicating the number of rows in that specific unique row
 
     '''
-    # minmax normalize to [0,1]
-    cond_x = (cond_x - np.min(cond_x)) / (np.max(cond_x) - np.min(cond_x))
+    N, D = cond_x.shape
+    cond_min, cond_max = np.min(cond_x), np.max(cond_x)
     bins = np.linspace(0, 1, num_digit, dtype='float32')
-    # bin each element, [N x d_2]
-    digitized_cond_x = np.digitize(cond_x, bins=bins, right=False)
-
-    # turn d_2 feature vector to 1-dim [N x d_2] -> [N x 1], for the purpose of using np.unique
-    cond_rows = np.ascontiguousarray(digitized_cond_x).view(
-        np.dtype(
-            (np.void,
-             digitized_cond_x.dtype.itemsize * digitized_cond_x.shape[1])))
-    _, assignments, cnts = np.unique(cond_rows,
-                                     return_index=False,
-                                     return_inverse=True,
-                                     return_counts=True)
+    # After min-max normalization, `np.digitize` gives 1, ..., num_digit.
+    num_bits = max(1, int(np.ceil(np.log2(num_digit))))
+
+    keys = np.empty((N, int(np.ceil(D * num_bits / 8))), dtype=np.uint8)
+    for start in range(0, N, chunk_size):
+        # minmax normalize to [0,1]
+        chunk = (cond_x[start:start + chunk_size] - cond_min) / (cond_max -
+                                                                cond_min)
+        # bin each element, [chunk x d_2]
+        digitized_chunk = np.digitize(chunk, bins=bins, right=False)
+        # turn d_2 feature vector to a fixed-width key, for the purpose of using np.unique
+        keys[start:start + chunk_size] = pack_codes(digitized_chunk - 1,
+                                                    num_bits=num_bits)
+
+    cnts, assignments = count_keys(keys, return_inverse=True)
 
     return assignments, cnts
 
 
-def comp_diffusion_embedding(X: np.array, sigma: float = 10.0):
+def comp_diffusion_embedding(X: np.array,
+                             sigma: float = 10.0,
+                             num_components: int = None):
     '''
         Compute diffusion embedding of X
     Args:
         X: [N, D]
+        num_components: if provided, only compute the top `num_components`
+            eigenpairs with a symmetric subset eigensolver.
 
     Returns:
-        diff_embed: [N, N]
+        diff_embed: [N, N] or [N, num_components]
     '''
     # Diffusion matrix
     diffusion_matrix = compute_diffusion_matrix(X, sigma=sigma)
-    eigenvalues_P, eigenvectors_P = np.linalg.eig(diffusion_matrix)
+    if num_components is None:
+        eigenvalues_P, eigenvectors_P = np.linalg.eig(diffusion_matrix)
+    else:
+        N = diffusion_matrix.shape[0]
+        eigenvalues_P, eigenvectors_P = scipy.linalg.eigh(
+            diffusion_matrix, subset_by_index=[N - num_components, N - 1])
 
     # Sort eigenvalues
     sorted_idx = np.argsort(eigenvalues_P)[::-1]
@@ -162,7 +179,8 @@ def mutual_information(orig_x: np.array,
         if num_spectral is None:
             num_spectral = min(cond_x.shape[1], cond_x.shape[0])
         if diff_embed is None:
-            diff_embed = comp_diffusion_embedding(X=cond_x)
+            diff_embed = comp_diffusion_embedding(X=cond_x,
+                                                  num_components=num_spectral)
 
         # Top components
         diff_embed = diff_embed[:, :num_spectral]
@@ -496,23 +514,64 @@ def mutual_information_per_class_append(embeddings: np.array,
                                         joint_entropy: float = None,
                                         vne_t: int = 2,
                                         z_entropy: float = None,
-                                        y_entropy: float = None):
+                                        y_entropy: float = None,
+                                        closed_form: bool = True):
     '''
         I(Z;Y) = H(Z) + H(Y) - H(Z,Y)
 
+        If `closed_form` is True (default), we exploit that the Gaussian kernel
+        over one-hot label embeddings only takes two values:
+            H(Y) is computed in closed form from the class counts.
+            The kernel of (Z, Y) is the kernel of Z reweighted elementwise,
+            hence the distances of Z are computed only once.
+        Otherwise, the one-hot embeddings are appended to Z explicitly.
+
     Args:
         embeddings (Z): [N,D]
         labels (Y): [N,1]
     Returns:
         mi: scaler
     '''
-    if joint_entropy is None:
-        N, D = embeddings.shape
-        num_classes = int(np.max(labels) + 1)
-        # One hot embedding for labels
-        labels_embeds = np.zeros((N, num_classes))
-        labels_embeds[np.arange(N), labels[:, 0]] = 1
+    if closed_form:
+        if joint_entropy is None or z_entropy is None:
+            # Gaussian kernel of Z.
+            kernel_Z = compute_gaussian_kernel(embeddings, sigma=sigma)
+
+        if joint_entropy is None:
+            # H(Z, Y). The squared distance between two one-hot vectors is 0 or 2,
+            # so appending them to Z multiplies the kernel of Z by 1 or exp(-1 / sigma^2).
+            same_class = labels.reshape(-1, 1) == labels.reshape(1, -1)
+            kernel_joint = kernel_Z * np.where(same_class, 1.0,
+                                               np.exp(-1 / sigma**2))
+            # Eigenvalues
+            eigenvalues_P = exact_eigvals(
+                normalize_gaussian_kernel(kernel_joint))
+            # Von Neumann Entropy
+            joint_entropy = von_neumann_entropy(eigenvalues_P, t=vne_t)
+
+        if y_entropy is None:
+            # Eigenvalues
+            eigenvalues_P = one_hot_label_eigvals(labels, sigma=sigma)
+            # Von Neumann Entropy
+            y_entropy = von_neumann_entropy(eigenvalues_P, t=vne_t)
+
+        if z_entropy is None:
+            # Eigenvalues
+            eigenvalues_P = exact_eigvals(normalize_gaussian_kernel(kernel_Z))
+            # Von Neumann Entropy
+            z_entropy = von_neumann_entropy(eigenvalues_P, t=vne_t)
+
+        mi = z_entropy + y_entropy - joint_entropy
 
+        return mi
+
+    N, D = embeddings.shape
+    num_classes = int(np.max(labels) + 1)
+    # One hot embedding for labels
+    labels_embeds = np.zeros((N, num_classes))
+    labels_embeds[np.arange(N), labels[:, 0]] = 1
+
+    if joint_entropy is None:
         # H(Z, Y) by appending one-hot label embeds to the Z
         joint_embeds = np.hstack((embeddings, labels_embeds))
         # Diffusion Matrix
@@ -543,6 +602,41 @@ def mutual_information_per_class_append(embeddings: np.array,
     return mi
 
 
+def one_hot_label_eigvals(labels: np.array, sigma: float = 10.0):
+    '''
+    Eigenvalues of the diffusion matrix over the one-hot embeddings of `labels`,
+    computed in closed form from the class counts.
+
+    Between two one-hot vectors, the Gaussian kernel is `c` for the same class
+    and `c * b` otherwise, with c = 1 / (sigma sqrt(2 pi)) and b = exp(-1 / sigma^2).
+        (1) Any vector that sums to zero within one class and is zero elsewhere
+            is in the null space. This gives N - C zero eigenvalues.
+        (2) The other C eigenvalues are those of the [C, C] matrix
+            S_kl = c sqrt(n_k n_l) (b + (1 - b) delta_kl) / sqrt(d_k d_l),
+            where n_k is the count of class k and d_k = c (b N + (1 - b) n_k)
+            is the degree of its data points.
+
+    Args:
+        labels: [N,1] or [N,]
+    Returns:
+        eigenvalues: [N,]
+    '''
+    _, class_cnts = np.unique(labels, return_counts=True)
+    class_cnts = class_cnts.astype(np.float64)
+    N, C = np.sum(class_cnts), len(class_cnts)
+
+    c = 1 / (sigma * np.sqrt(2 * np.pi))
+    b = np.exp(-1 / sigma**2)
+    degrees = c * (b * N + (1 - b) * class_cnts)
+
+    S = c * np.sqrt(np.outer(class_cnts, class_cnts)) * (
+        b + (1 - b) * np.eye(C)) / np.sqrt(np.outer(degrees, degrees))
+
+    eigenvalues = np.concatenate((np.linalg.eigvalsh(S), np.zeros(int(N) - C)))
+
+    return eigenvalues
+
+
 def approx_eigvals(A: np.array, filter_thr: float = 1e-3):
     '''
     Estimate the eigenvalues of a matrix `A` using
@@ -648,19 +742,95 @@ def shannon_entropy(X: np.array, num_bins_per_dim: int = 2):
 
     where each p(x) is the probability density of a histogram bin, after some sort of binning.
     '''
-    vecs = X.copy()
-
-    # Min-Max scale each dimension.
-    vecs = (vecs - np.min(vecs, axis=0)) / (np.max(vecs, axis=0) -
-                                            np.min(vecs, axis=0))
-
-    # Bin along each dimension.
-    bins = np.linspace(0, 1, num_bins_per_dim + 1)[:-1]
-    vecs = np.digitize(vecs, bins=bins)
+    # Min-Max scale and bin each dimension,
+    # and pack the bins of each vector into a compact key.
+    keys = pack_bin_codes(X, num_bins_per_dim=num_bins_per_dim)
 
     # Count probability.
-    counts = np.unique(vecs, axis=0, return_counts=True)[1]
+    counts = count_keys(keys)
     prob = counts / np.sum(counts)
     prob = prob + np.finfo(float).eps
 
     return -np.sum(prob * np.log2(prob))
+
+
+def pack_bin_codes(vecs: np.array,
+                   num_bins_per_dim: int = 2,
+                   vec_min: np.array = None,
+                   vec_max: np.array = None,
+                   chunk_size: int = 4096):
+    '''
+    Bin a set of N vectors, each of D dimensions, and pack the bins of each vector
+    into a compact fixed-width byte key.
+
+    Each dimension is Min-Max scaled and binned into `num_bins_per_dim` bins,
+    exactly as in the Classic Shannon Entropy. Each bin index takes ceil(log2(num_bins_per_dim))
+    bits (1 bit for 2 bins), so two vectors share a key if and only if they fall into the same bin.
+    Rows are processed in chunks of `chunk_size` to avoid materializing a full [N, D] integer matrix.
+
+    args:
+        vec_min, vec_max: np.array of shape [D, ]
+            Bounds used for Min-Max scaling. Computed from `vecs` if not provided.
+
+    returns:
+        keys: np.array of shape [N, W], dtype np.uint8, where W = ceil(D * bits / 8).
+    '''
+    N, D = vecs.shape
+    if vec_min is None:
+        vec_min = np.min(vecs, axis=0)
+    if vec_max is None:
+        vec_max = np.max(vecs, axis=0)
+
+    bins = np.linspace(0, 1, num_bins_per_dim + 1)[:-1]
+    num_bits = max(1, int(np.ceil(np.log2(num_bins_per_dim))))
+
+    keys = np.empty((N, int(np.ceil(D * num_bits / 8))), dtype=np.uint8)
+    for start in range(0, N, chunk_size):
+        chunk = vecs[start:start + chunk_size]
+        # Min-Max scale each dimension.
+        chunk = (chunk - vec_min) / (vec_max - vec_min)
+        # Bin along each dimension. Bin indices range from 0 to `num_bins_per_dim` - 1.
+        # Values outside of fixed bounds go to the first or the last bin.
+        codes = np.clip(np.digitize(chunk, bins=bins) - 1, 0,
+                        num_bins_per_dim - 1)
+        keys[start:start + chunk_size] = pack_codes(codes, num_bits=num_bits)
+
+    return keys
+
+
+def pack_codes(codes: np.array, num_bits: int):
+    '''
+    Pack a [N, D] matrix of small non-negative integers, each using `num_bits` bits,
+    into a [N, ceil(D * num_bits / 8)] matrix of bytes.
+
+    The bits of each integer are written most significant first, such that
+    comparing two packed rows byte by byte gives the lexicographic order of the original rows.
+    '''
+    N, D = codes.shape
+    codes = codes.astype(np.uint8 if num_bits <= 8 else np.uint16)
+    if num_bits > 1:
+        # Split each integer into its bits.
+        codes = np.stack(
+            [(codes >> bit) & 1 for bit in reversed(range(num_bits))],
+            axis=-1).reshape(N, D * num_bits)
+    return np.packbits(codes, axis=1)
+
+
+def count_keys(keys: np.array, return_inverse: bool = False):
+    '''
+    Count the occurrences of each unique row of `keys` produced by `pack_bin_codes`.
+    Each row is viewed as one fixed-width opaque value, so the rows are sorted
+    by memory comparison rather than lexicographically element by element.
+
+    returns:
+        counts: np.array of shape [M, ], M being the number of unique keys.
+        inverse (if `return_inverse`): np.array of shape [N, ], the index of the unique key of each row.
+    '''
+    keys = np.ascontiguousarray(keys)
+    keys_void = keys.view(np.dtype((np.void, keys.shape[1]))).reshape(-1)
+    _, inverse, counts = np.unique(keys_void,
+                                   return_inverse=True,
+                                   return_counts=True)
+    if return_inverse:
+        return counts, inverse.reshape(-1)
+    return counts
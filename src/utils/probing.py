@@ -0,0 +1,238 @@
+from typing import Tuple
+
+import numpy as np
+import torch
+from collector import EmbeddingCollector
+
+
+def encode_probing_features(
+        train_loader: torch.utils.data.DataLoader,
+        model: torch.nn.Module,
+        device: torch.device,
+        in_channels: int,
+        num_views: int = 2,
+        float_dtype: np.dtype = None
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    '''
+    Encode the training set once with the frozen encoder, for linear probing
+    on the cached features instead of re-running the encoder every probing epoch.
+
+    The training set yields two augmented views per image (`SingleInstanceTwoView`).
+    `num_views` augmentation draws are kept per image: the training set is iterated
+    ceil(`num_views` / 2) times, and only the first view is kept on the last pass if odd.
+
+    The encoder is run in eval mode, same as in validation.
+
+    args:
+        in_channels: int
+            1-channel images are repeated to 3 channels, same as in training.
+
+        num_views: int
+            Number of augmentation draws kept per image.
+
+        float_dtype: np.dtype
+            If provided, dtype of the cached features, e.g., np.float16 to halve the memory.
+
+    returns:
+        features: torch.Tensor, [num_views * N, D], on CPU
+        labels: torch.Tensor, [num_views * N], on CPU
+    '''
+    assert num_views >= 1, \
+        '`encode_probing_features`: `num_views` must be at least 1.'
+    assert in_channels in [1, 3]
+
+    collector = EmbeddingCollector(capacity=num_views *
+                                   len(train_loader.dataset),
+                                   float_dtype=float_dtype)
+
+    model.eval()
+    with torch.no_grad():
+        for pass_idx in range((num_views + 1) // 2):
+            keep_both_views = 2 * (pass_idx + 1) <= num_views
+            for _, (x, y_true) in enumerate(train_loader):
+                x_aug1, x_aug2 = x
+                if not keep_both_views:
+                    x_aug, y_true = x_aug1, y_true
+                else:
+                    # One forward pass on both views.
+                    x_aug = torch.cat((x_aug1, x_aug2), dim=0)
+                    y_true = y_true.repeat(2)
+                if in_channels == 1:
+                    # Repeat the channel dimension: 1 channel -> 3 channels.
+                    x_aug = x_aug.repeat(1, 3, 1, 1)
+                h = model.encode(x_aug.to(device))
+                collector.add(h=h.cpu().numpy(), y=y_true.numpy())
+
+    return torch.from_numpy(collector['h']), torch.from_numpy(collector['y'])
+
+
+def linear_probing_epoch_on_features(linear: torch.nn.Module,
+                                     features: torch.Tensor,
+                                     labels: torch.Tensor,
+                                     device: torch.device,
+                                     opt_probing: torch.optim.Optimizer,
+                                     loss_fn_classification: torch.nn.Module,
+                                     batch_size: int = 4096) -> float:
+    '''
+    One epoch of training the linear head on the features from `encode_probing_features`.
+
+    returns:
+        probing_acc: float
+            Training accuracy (%) over this epoch.
+    '''
+    linear.train()
+    correct = torch.zeros((), dtype=torch.int64, device=device)
+    permutation = torch.randperm(len(features))
+    for batch_start in range(0, len(features), batch_size):
+        batch_inds = permutation[batch_start:batch_start + batch_size]
+        h = features[batch_inds].to(device).float()
+        y_true = labels[batch_inds].to(device).long()
+
+        y_pred = linear(h)
+        loss = loss_fn_classification(y_pred, y_true)
+        correct += torch.sum(torch.argmax(y_pred.detach(), dim=-1) == y_true)
+
+        opt_probing.zero_grad()
+        loss.backward()
+        opt_probing.step()
+
+    probing_acc = correct.item() / len(features) * 100
+
+    return probing_acc
+
+
+def fit_linear_probe(linear: torch.nn.Linear,
+                     features: torch.Tensor,
+                     labels: torch.Tensor,
+                     device: torch.device,
+                     solver: str = 'lbfgs',
+                     l2_reg: float = 1e-4,
+                     max_iter: int = 100,
+                     batch_size: int = 65536) -> float:
+    '''
+    Fit the linear head in place on the features from `encode_probing_features`,
+    by solving the (convex) problem directly with full-batch solvers,
+    instead of many epochs of mini-batch gradient descent.
+
+    The features are moved to `device` in chunks of `batch_size` rows,
+    hence they do not need to fit on `device` at once.
+
+    args:
+        solver: str
+            'lbfgs': multinomial logistic regression, solved with L-BFGS.
+                     Minimizes mean cross-entropy + `l2_reg` / 2 * ||W||^2.
+            'ridge': least squares regression to the one-hot labels, in closed form.
+                     Minimizes mean squared error + `l2_reg` * ||W||^2.
+            The bias is not regularized.
+
+        l2_reg: float
+            Strength of the L2 regularization on the weights.
+
+        max_iter: int
+            Only relevant to 'lbfgs'. Maximum number of L-BFGS iterations.
+
+    returns:
+        probing_acc: float
+            Training accuracy (%) of the fitted linear head.
+    '''
+    if solver == 'lbfgs':
+        _fit_lbfgs(linear=linear,
+                   features=features,
+                   labels=labels,
+                   device=device,
+                   l2_reg=l2_reg,
+                   max_iter=max_iter,
+                   batch_size=batch_size)
+    elif solver == 'ridge':
+        _fit_ridge(linear=linear,
+                   features=features,
+                   labels=labels,
+                   device=device,
+                   l2_reg=l2_reg,
+                   batch_size=batch_size)
+    else:
+        raise ValueError('`fit_linear_probe`: solver (%s) not supported.' %
+                         solver)
+
+    correct = torch.zeros((), dtype=torch.int64, device=device)
+    with torch.no_grad():
+        for batch_start in range(0, len(features), batch_size):
+            h = features[batch_start:batch_start + batch_size].to(
+                device).float()
+            y_true = labels[batch_start:batch_start + batch_size].to(
+                device).long()
+            correct += torch.sum(torch.argmax(linear(h), dim=-1) == y_true)
+
+    probing_acc = correct.item() / len(features) * 100
+
+    return probing_acc
+
+
+def _fit_lbfgs(linear: torch.nn.Linear, features: torch.Tensor,
+               labels: torch.Tensor, device: torch.device, l2_reg: float,
+               max_iter: int, batch_size: int) -> None:
+    linear.train()
+    opt = torch.optim.LBFGS(linear.parameters(),
+                            lr=1,
+                            max_iter=max_iter,
+                            history_size=10,
+                            line_search_fn='strong_wolfe')
+
+    def closure():
+        opt.zero_grad()
+        total_loss = 0
+        # Accumulate the full-batch gradient chunk by chunk.
+        for batch_start in range(0, len(features), batch_size):
+            h = features[batch_start:batch_start + batch_size].to(
+                device).float()
+            y_true = labels[batch_start:batch_start + batch_size].to(
+                device).long()
+            loss = torch.nn.functional.cross_entropy(
+                linear(h), y_true, reduction='sum') / len(features)
+            loss.backward()
+            total_loss += loss.detach()
+        loss = l2_reg / 2 * torch.sum(linear.weight**2)
+        loss.backward()
+        total_loss += loss.detach()
+        return total_loss
+
+    opt.step(closure)
+
+
+def _fit_ridge(linear: torch.nn.Linear, features: torch.Tensor,
+               labels: torch.Tensor, device: torch.device, l2_reg: float,
+               batch_size: int) -> None:
+    N, D = features.shape
+    num_classes = linear.out_features
+
+    # Accumulate the sufficient statistics in float64, chunk by chunk.
+    sum_h = torch.zeros(D, dtype=torch.float64, device=device)
+    sum_y = torch.zeros(num_classes, dtype=torch.float64, device=device)
+    hTh = torch.zeros((D, D), dtype=torch.float64, device=device)
+    hTy = torch.zeros((D, num_classes), dtype=torch.float64, device=device)
+    for batch_start in range(0, N, batch_size):
+        h = features[batch_start:batch_start + batch_size].to(device).double()
+        y_onehot = torch.nn.functional.one_hot(
+            labels[batch_start:batch_start + batch_size].to(device).long(),
+            num_classes=num_classes).double()
+        sum_h += h.sum(dim=0)
+        sum_y += y_onehot.sum(dim=0)
+        hTh += h.T @ h
+        hTy += h.T @ y_onehot
+
+    # Center the features and the targets, such that the bias is not regularized.
+    mean_h, mean_y = sum_h / N, sum_y / N
+    hTh_centered = hTh - N * torch.outer(mean_h, mean_h)
+    hTy_centered = hTy - N * torch.outer(mean_h, mean_y)
+
+    # (H^T H + N * lambda * I) W = H^T Y
+    W = torch.linalg.solve(
+        hTh_centered +
+        N * l2_reg * torch.eye(D, dtype=torch.float64, device=device),
+        hTy_centered)
+    b = mean_y - mean_h @ W
+
+    with torch.no_grad():
+        linear.weight.copy_(W.T.to(linear.weight.dtype))
+        linear.bias.copy_(b.to(linear.bias.dtype))
+    return
@@ -1,17 +1,23 @@
+import json
 import os
+from glob import glob
+from typing import Dict, List
+
 import numpy as np
 import torch
 from attribute_hashmap import AttributeHashmap
+from collector import EmbeddingCollector
+
 
 def save_numpy(config: AttributeHashmap, batch_idx: int, numpy_filename: str,
                image_batch: torch.Tensor, label_true_batch: torch.Tensor,
                embedding_batch: torch.Tensor, np_dtype: np.dtype = np.float16):
 
-    image_batch = image_batch.cpu().detach().numpy().astype(np_dtype)
-    label_true_batch = label_true_batch.cpu().detach().numpy().astype(np_dtype)
-    embedding_batch = embedding_batch.cpu().detach().numpy().astype(np_dtype)
-    # channel-first to channel-last
-    image_batch = np.moveaxis(image_batch, 1, -1)
+    image_batch, label_true_batch, embedding_batch = _batches_to_numpy(
+        image_batch=image_batch,
+        label_true_batch=label_true_batch,
+        embedding_batch=embedding_batch,
+        np_dtype=np_dtype)
 
     # Save the images, labels, and predictions as numpy files for future reference.
     save_path_numpy = '%s/embeddings/%s/' % (config.output_save_path,
@@ -27,3 +33,148 @@ def save_numpy(config: AttributeHashmap, batch_idx: int, numpy_filename: str,
                  label_true=label_true_batch,
                  embedding=embedding_batch)
     return
+
+
+def _batches_to_numpy(image_batch: torch.Tensor,
+                      label_true_batch: torch.Tensor,
+                      embedding_batch: torch.Tensor, np_dtype: np.dtype):
+    image_batch = image_batch.cpu().detach().numpy().astype(np_dtype)
+    label_true_batch = label_true_batch.cpu().detach().numpy().astype(np_dtype)
+    embedding_batch = embedding_batch.cpu().detach().numpy().astype(np_dtype)
+    # channel-first to channel-last
+    image_batch = np.moveaxis(image_batch, 1, -1)
+    return image_batch, label_true_batch, embedding_batch
+
+
+class EmbeddingStore(object):
+    '''
+    Checkpoint-level store of the images, labels and embeddings,
+    in place of one `batch_XXXXX.npz` file per batch.
+
+    Each field is one preallocated `[capacity, ...]` `.npy` file, written in place
+    through a memory map. A small `index.json` records the number of rows written
+    and the shape / dtype of each field. Use `load_numpy` to read it back.
+
+    Folder layout:
+        `store_dir`/index.json
+        `store_dir`/image.npy
+        `store_dir`/label_true.npy
+        `store_dir`/embedding.npy
+
+    Usage:
+        store = EmbeddingStore(store_dir, capacity=len(val_loader.dataset))
+        for x, y_true in val_loader:
+            ...
+            save_numpy_to_store(store, image_batch=x, label_true_batch=y_true, embedding_batch=h)
+        store.close()
+
+    args:
+        store_dir: str
+            Folder of the store, e.g., one per checkpoint.
+
+        capacity: int
+            Total number of rows, e.g., `len(val_loader.dataset)`.
+    '''
+
+    index_filename = 'index.json'
+
+    def __init__(self, store_dir: str, capacity: int):
+        self.store_dir = store_dir
+        self.capacity = capacity
+        self.memmaps = {}
+        self.num_rows = 0
+        os.makedirs(self.store_dir, exist_ok=True)
+
+    def append(self, **batches: np.array) -> None:
+        '''
+        Write one batch per field after the rows written so far.
+        '''
+        batch_sizes = set([len(batch) for batch in batches.values()])
+        assert len(batch_sizes) == 1, \
+            '`EmbeddingStore.append`: all fields must have the same batch size.'
+        B = batch_sizes.pop()
+        assert self.num_rows + B <= self.capacity, \
+            '`EmbeddingStore.append`: capacity (%d) exceeded.' % self.capacity
+
+        for name, batch in batches.items():
+            if name not in self.memmaps:
+                self.memmaps[name] = np.lib.format.open_memmap(
+                    '%s/%s.npy' % (self.store_dir, name),
+                    mode='w+',
+                    dtype=batch.dtype,
+                    shape=(self.capacity, *batch.shape[1:]))
+            self.memmaps[name][self.num_rows:self.num_rows + B] = batch
+        self.num_rows += B
+
+    def close(self) -> None:
+        '''
+        Flush the memory maps and write the index.
+        '''
+        index = {'num_rows': self.num_rows, 'fields': {}}
+        for name, memmap in self.memmaps.items():
+            memmap.flush()
+            index['fields'][name] = {
+                'shape': [self.num_rows, *memmap.shape[1:]],
+                'dtype': memmap.dtype.str,
+            }
+        with open('%s/%s' % (self.store_dir, self.index_filename), 'w') as f:
+            json.dump(index, f, indent=2)
+        self.memmaps = {}
+
+
+def save_numpy_to_store(store: EmbeddingStore,
+                        image_batch: torch.Tensor,
+                        label_true_batch: torch.Tensor,
+                        embedding_batch: torch.Tensor,
+                        np_dtype: np.dtype = np.float16):
+    '''
+    Same as `save_numpy`, but appends the batch to an `EmbeddingStore`.
+    '''
+    image_batch, label_true_batch, embedding_batch = _batches_to_numpy(
+        image_batch=image_batch,
+        label_true_batch=label_true_batch,
+        embedding_batch=embedding_batch,
+        np_dtype=np_dtype)
+    store.append(image=image_batch,
+                 label_true=label_true_batch,
+                 embedding=embedding_batch)
+    return
+
+
+def load_numpy(embedding_folder: str,
+               fields: List[str] = ['image', 'label_true', 'embedding'],
+               rows: np.array = None) -> Dict[str, np.array]:
+    '''
+    Load the fields saved by `EmbeddingStore` (or by `save_numpy`) for one checkpoint.
+
+    For an `EmbeddingStore`, the fields are read-only memory-mapped views,
+    so only the rows that are accessed are read from disk.
+    If `rows` is provided, only these rows are loaded.
+
+    For the legacy per-batch `batch_XXXXX.npz` files, all files are loaded and concatenated.
+    '''
+    index_path = '%s/%s' % (embedding_folder, EmbeddingStore.index_filename)
+
+    arrays = {}
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        for name in fields:
+            array = np.load('%s/%s.npy' % (embedding_folder, name),
+                            mmap_mode='r')[:index['num_rows']]
+            if rows is not None:
+                # Reading sorted rows is friendlier to the disk.
+                sorted_rows, inverse = np.unique(rows, return_inverse=True)
+                array = array[sorted_rows][inverse]
+            arrays[name] = array
+
+    else:
+        collector = EmbeddingCollector()
+        for file in sorted(glob('%s/batch_*.npz' % embedding_folder)):
+            np_file = np.load(file)
+            collector.add(**{name: np_file[name] for name in fields})
+        for name in fields:
+            arrays[name] = collector[name] if rows is None else collector[
+                name][rows]
+
+    return arrays